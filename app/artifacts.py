@@ -0,0 +1,360 @@
+import os
+import sys
+import gzip
+import json
+import time
+import uuid
+import shutil
+import hashlib
+import logging
+import threading
+from collections import Counter
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+import metrics
+
+logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+logger = logging.getLogger('artifacts')
+
+ARTIFACTS_PATH = os.getenv('ARTIFACTS_PATH', '/data/artifacts')
+
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ArtifactStore:
+    def __init__(self, root=None, max_bytes=None, grace=None):
+        """
+        Content-addressed store of prepared data on the data volume.
+
+        Files are stored once per content (sha256) as compressed blobs, zstd
+        when `zstandard` is installed else gzip, and each job has a manifest
+        of its files. When blobs exceed `max_bytes`, the least recently used
+        jobs are evicted and blobs no longer referenced are removed.
+
+        Usage example:
+            store = ArtifactStore('/data/artifacts')
+            store.put('name', '/data/jobs/name')
+            store.materialize('name', '/data/jobs/name')
+            store.evict()
+
+        Parameters
+        ----------
+        root: str, directory of the store, default env `ARTIFACTS_PATH` or
+              /data/artifacts
+        max_bytes: int, size budget of blobs,
+                   default env `ARTIFACTS_MAX_BYTES` or 20GiB
+        grace: float, seconds during which a job used recently is never evicted,
+               default env `ARTIFACTS_GRACE` or 600
+        """
+        self.root = root if root is not None else ARTIFACTS_PATH
+        self.max_bytes = max_bytes if max_bytes is not None \
+            else int(os.getenv('ARTIFACTS_MAX_BYTES', 20 * 1024 ** 3))
+        self.grace = grace if grace is not None \
+            else float(os.getenv('ARTIFACTS_GRACE', 600))
+        self.extension = '.zst' if zstandard is not None else '.gz'
+        self.lock = threading.RLock()
+        self.stopped = threading.Event()
+        self.thread = None
+        # Index built from disk on first use
+        self.manifests = None
+        self.refs = Counter()
+        self.blobs = {}
+
+    def _manifest_path(self, name):
+        return os.path.join(self.root, 'manifests', f'{name}.json')
+
+    def _blob_path(self, sha, extension=None):
+        return os.path.join(self.root, 'objects', sha[:2],
+                            sha + (extension or self.extension))
+
+    def _load(self):
+        """
+        Build the index of manifests, references and blobs sizes
+        """
+        if self.manifests is not None:
+            return
+        manifests, refs, blobs = {}, Counter(), {}
+        objects = os.path.join(self.root, 'objects')
+        for prefix in os.listdir(objects) if os.path.isdir(objects) else []:
+            for entry in os.scandir(os.path.join(objects, prefix)):
+                if entry.name.endswith(('.zst', '.gz')):
+                    blobs[entry.name.rsplit('.', 1)[0]] = (entry.path, entry.stat().st_size)
+        directory = os.path.join(self.root, 'manifests')
+        for entry in os.scandir(directory) if os.path.isdir(directory) else []:
+            if not entry.name.endswith('.json'):
+                continue
+            try:
+                with open(entry.path) as f:
+                    files = json.load(f)["files"]
+            except (OSError, ValueError, KeyError) as e:
+                logger.warning(f'Manifest {entry.path} ignored: {e}')
+                continue
+            manifests[entry.name[:-5]] = files
+            refs.update(f["sha"] for f in files.values())
+        self.manifests, self.refs, self.blobs = manifests, refs, blobs
+
+    def _write_blob(self, sha, source):
+        path = self._blob_path(sha)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f'{path}.{uuid.uuid4().hex}.tmp'
+        with open(source, 'rb') as src:
+            if zstandard is not None:
+                with open(tmp, 'wb') as dst:
+                    zstandard.ZstdCompressor(level=3).copy_stream(src, dst)
+            else:
+                with gzip.open(tmp, 'wb', compresslevel=6) as dst:
+                    shutil.copyfileobj(src, dst, 1024 * 1024)
+        os.rename(tmp, path)
+        return path, os.path.getsize(path)
+
+    @staticmethod
+    def _read_blob(path, target):
+        with open(target, 'wb') as dst:
+            if path.endswith('.zst'):
+                if zstandard is None:
+                    raise RuntimeError(f'zstandard is required to read {path}')
+                with open(path, 'rb') as src:
+                    zstandard.ZstdDecompressor().copy_stream(src, dst)
+            else:
+                with gzip.open(path, 'rb') as src:
+                    shutil.copyfileobj(src, dst, 1024 * 1024)
+
+    def put(self, name, directory):
+        """
+        Store the files of a job directory, files already stored (in this
+        job or another one) are not written again.
+        Return {files, bytes, new_files, new_bytes, stored_bytes}
+        """
+        files, report = {}, {"files": 0, "bytes": 0, "new_files": 0,
+                             "new_bytes": 0, "stored_bytes": 0}
+        start = time.perf_counter()
+        try:
+            for root, _, filenames in os.walk(directory):
+                for filename in filenames:
+                    path = os.path.join(root, filename)
+                    sha = file_hash(path)
+                    size = os.path.getsize(path)
+                    files[os.path.relpath(path, directory)] = {"sha": sha, "size": size}
+                    report["files"] += 1
+                    report["bytes"] += size
+                    with self.lock:
+                        self._load()
+                        # Referenced right away so that eviction keeps it
+                        self.refs[sha] += 1
+                        blob = self.blobs.get(sha)
+                    if blob is None:
+                        blob = self._write_blob(sha, path)
+                        with self.lock:
+                            self.blobs[sha] = blob
+                        report["new_files"] += 1
+                        report["new_bytes"] += blob[1]
+                    report["stored_bytes"] += blob[1]
+
+            manifest = self._manifest_path(name)
+            os.makedirs(os.path.dirname(manifest), exist_ok=True)
+            tmp = f'{manifest}.{uuid.uuid4().hex}.tmp'
+            with open(tmp, 'w') as f:
+                json.dump({"files": files, "created_at": time.time()}, f)
+        except Exception:
+            with self.lock:
+                self.refs.subtract(f["sha"] for f in files.values())
+            raise
+        with self.lock:
+            previous = self.manifests.get(name)
+            os.rename(tmp, manifest)
+            self.manifests[name] = files
+            if previous is not None:
+                self.refs.subtract(f["sha"] for f in previous.values())
+        metrics.observe('artifact_put', time.perf_counter() - start)
+        logger.info(f'{name} stored: {report["files"]} files, {report["bytes"]} bytes, '
+                    f'{report["new_bytes"]} new compressed bytes')
+        return report
+
+    def has(self, name):
+        with self.lock:
+            self._load()
+            return name in self.manifests
+
+    def touch(self, name):
+        """
+        Mark a job as used, evicted last
+        """
+        try:
+            os.utime(self._manifest_path(name))
+        except OSError:
+            pass
+
+    def materialize(self, name, path):
+        """
+        Write the files of a job in `path`, written aside and renamed once
+        complete. Return False if the job is not in store
+        """
+        with self.lock:
+            self._load()
+            files = self.manifests.get(name)
+            blobs = {f["sha"]: self.blobs.get(f["sha"]) for f in (files or {}).values()}
+        if files is None or None in blobs.values():
+            return False
+        self.touch(name)
+        if os.path.exists(path):
+            return True
+        start = time.perf_counter()
+        tmp = os.path.join(os.path.dirname(path),
+                           f'.{os.path.basename(path)}.{uuid.uuid4().hex}.tmp')
+        try:
+            for relpath, info in files.items():
+                target = os.path.join(tmp, relpath)
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                self._read_blob(blobs[info["sha"]][0], target)
+            if os.path.exists(path):
+                shutil.rmtree(tmp, ignore_errors=True)
+            else:
+                os.rename(tmp, path)
+        except Exception:
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+        metrics.observe('artifact_materialize', time.perf_counter() - start)
+        return True
+
+    def _remove_unreferenced(self):
+        """
+        Delete blobs not referenced by any manifest, return freed bytes
+        """
+        freed = 0
+        for sha in [s for s in self.blobs if self.refs[s] <= 0]:
+            path, size = self.blobs.pop(sha)
+            self.refs.pop(sha, None)
+            try:
+                os.remove(path)
+                freed += size
+            except FileNotFoundError:
+                pass
+        return freed
+
+    def _drop(self, name):
+        """
+        Remove a job from store, return freed bytes or None if not in store
+        """
+        files = self.manifests.pop(name, None)
+        if files is None:
+            return None
+        try:
+            os.remove(self._manifest_path(name))
+        except FileNotFoundError:
+            pass
+        self.refs.subtract(f["sha"] for f in files.values())
+        return self._remove_unreferenced()
+
+    def delete(self, name):
+        """
+        Remove a job and its blobs not shared with other jobs.
+        Return if the job was in store
+        """
+        with self.lock:
+            self._load()
+            return self._drop(name) is not None
+
+    def size(self):
+        with self.lock:
+            self._load()
+            return sum(size for _, size in self.blobs.values())
+
+    def evict(self):
+        """
+        Evict least recently used jobs until blobs fit in the size budget.
+        Return evicted job names
+        """
+        evicted = []
+        with self.lock:
+            self._load()
+            total = sum(size for _, size in self.blobs.values())
+            if total <= self.max_bytes:
+                return evicted
+            now = time.time()
+            used = {}
+            for name in self.manifests:
+                try:
+                    used[name] = os.path.getmtime(self._manifest_path(name))
+                except OSError:
+                    used[name] = 0
+            for name in sorted(used, key=used.get):
+                if total <= self.max_bytes or now - used[name] < self.grace:
+                    break
+                total -= self._drop(name)
+                evicted.append(name)
+        if evicted:
+            logger.info(f'{len(evicted)} jobs evicted, {total} bytes stored')
+        return evicted
+
+    def last_used(self, name, default=0):
+        """
+        Time a job was stored or last used, `default` if not in store
+        """
+        try:
+            return os.path.getmtime(self._manifest_path(name))
+        except OSError:
+            return default
+
+    def prune(self, directory, ttl, in_use=()):
+        """
+        Remove job directories of `directory` stored here and not used for
+        `ttl` seconds, except jobs of `in_use`, they can be materialized
+        again. Directories not in store are kept.
+        Return removed names
+        """
+        removed = []
+        if not os.path.isdir(directory):
+            return removed
+        now = time.time()
+        for entry in os.scandir(directory):
+            if entry.name.startswith('.') or not entry.is_dir() or \
+                    entry.name in in_use or not self.has(entry.name):
+                continue
+            if now - self.last_used(entry.name) > ttl:
+                shutil.rmtree(entry.path, ignore_errors=True)
+                removed.append(entry.name)
+        return removed
+
+    def stats(self):
+        with self.lock:
+            self._load()
+            return {"jobs": len(self.manifests),
+                    "blobs": len(self.blobs),
+                    "bytes": sum(size for _, size in self.blobs.values()),
+                    "max_bytes": self.max_bytes,
+                    "codec": 'zstd' if zstandard is not None else 'gzip'}
+
+    def _janitor(self, interval, directory, ttl, in_use):
+        while not self.stopped.wait(interval):
+            try:
+                self.evict()
+                if directory is not None:
+                    self.prune(directory, ttl, in_use() if in_use is not None else ())
+            except Exception as f:
+                logger.error(f'Artifact janitor failed: {f}')
+
+    def start_janitor(self, interval=300, directory=None, ttl=3600, in_use=None):
+        """
+        Evict in background every `interval` seconds, and prune job
+        directories of `directory` not used for `ttl` seconds. `in_use` is
+        called before pruning and returns names of jobs to keep
+        """
+        if self.thread is not None:
+            return
+        self.thread = threading.Thread(target=self._janitor, name='artifact-janitor',
+                                       args=(interval, directory, ttl, in_use),
+                                       daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
@@ -0,0 +1,70 @@
+import os
+import asyncio
+import functools
+import contextvars
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Backend:
+    def __init__(self, name, max_concurrency=None, default=8):
+        """
+        Dedicated executor for blocking calls of one backend (kubernetes,
+        s3, disk...), so that the event loop is never blocked and a slow
+        backend can not starve the others
+
+        Usage example:
+            kube = Backend('kube')
+            status = await kube.run(job.get_job_status)
+            future = kube.submit(job.start_job)
+
+        Parameters
+        ----------
+        name: str, name of backend
+        max_concurrency: int, number of calls run at the same time,
+                         default env `{NAME}_CONCURRENCY` or `default`
+        """
+        self.name = name
+        self.max_concurrency = max_concurrency if max_concurrency is not None \
+            else int(os.getenv(f'{name.upper()}_CONCURRENCY', default))
+        self.executor = ThreadPoolExecutor(max_workers=self.max_concurrency,
+                                           thread_name_prefix=name)
+        self.lock = threading.Lock()
+        self.in_flight = 0
+
+    async def run(self, fn, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        with self.lock:
+            self.in_flight += 1
+        try:
+            # Context is copied so that stages timed in the executor are
+            # reported in the timing log of the request
+            context = contextvars.copy_context()
+            return await loop.run_in_executor(
+                self.executor, functools.partial(context.run, fn, *args, **kwargs))
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+    def _call(self, fn, *args, **kwargs):
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        Run a blocking call from a thread without waiting for it,
+        return its future
+        """
+        with self.lock:
+            self.in_flight += 1
+        return self.executor.submit(self._call, fn, *args, **kwargs)
+
+    def stats(self):
+        return {"max_concurrency": self.max_concurrency,
+                "in_flight": self.in_flight}
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
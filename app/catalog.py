@@ -0,0 +1,201 @@
+import os
+import sys
+import time
+import sqlite3
+import logging
+import threading
+
+logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+logger = logging.getLogger('catalog')
+
+CATALOG_PATH = os.getenv('CATALOG_PATH', '/data/catalog.sqlite')
+
+COLUMNS = ['name', 'x1', 'y1', 'x2', 'y2', 'crs', 'xmin', 'ymin', 'xmax', 'ymax',
+           'state', 'size_bytes', 'files', 'created_at', 'updated_at',
+           'prepare_seconds', 'url', 'error', 'run_seconds']
+ORDERS = ['created_at', 'updated_at', 'size_bytes', 'prepare_seconds', 'run_seconds',
+          'name']
+
+
+def dir_size(path):
+    """
+    Return (number of files, bytes) of a directory
+    """
+    files, size = 0, 0
+    for root, _, filenames in os.walk(path):
+        for filename in filenames:
+            files += 1
+            size += os.path.getsize(os.path.join(root, filename))
+    return files, size
+
+
+class Catalog:
+    def __init__(self, path=None):
+        """
+        Embedded SQLite catalog of generated jobs: bbox, state, sizes and
+        durations, with an R-tree index on LAMBERT bbox for spatial lookups
+
+        Usage example:
+            catalog = Catalog('/data/catalog.sqlite')
+            catalog.upsert('name', x1=649985, y1=6864006, x2=650266,
+                           y2=6864226, crs='EPSG:2154', state='QUEUED',
+                           xmin=649985, ymin=6864006, xmax=650266, ymax=6864226)
+            catalog.covering(650000, 6864100, 650000, 6864100)
+
+        Parameters
+        ----------
+        path: str, sqlite file, default env `CATALOG_PATH` or /data/catalog.sqlite
+        """
+        self.path = path if path is not None else CATALOG_PATH
+        self.lock = threading.Lock()
+        self._conn = None
+        self.rtree = True
+
+    @property
+    def conn(self):
+        """
+        Connection opened and schema created on first use
+        """
+        if self._conn is None:
+            if self.path != ':memory:':
+                os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False,
+                                   isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('''CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY, name TEXT UNIQUE NOT NULL,
+                x1 REAL, y1 REAL, x2 REAL, y2 REAL, crs TEXT,
+                xmin REAL, ymin REAL, xmax REAL, ymax REAL,
+                state TEXT, size_bytes INTEGER, files INTEGER,
+                created_at REAL, updated_at REAL, prepare_seconds REAL,
+                url TEXT, error TEXT, run_seconds REAL)''')
+            conn.execute('CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, created_at)')
+            conn.execute('CREATE INDEX IF NOT EXISTS jobs_created ON jobs (created_at)')
+            try:
+                conn.execute('CREATE VIRTUAL TABLE IF NOT EXISTS jobs_rtree '
+                             'USING rtree(id, xmin, xmax, ymin, ymax)')
+            except sqlite3.OperationalError:
+                logger.warning('SQLite built without R-tree, spatial lookups are scans')
+                self.rtree = False
+            self._conn = conn
+        return self._conn
+
+    def _index(self, conn, name):
+        """
+        Update R-tree entry of a job from its bbox
+        """
+        row = conn.execute('SELECT id, xmin, xmax, ymin, ymax FROM jobs WHERE name = ?',
+                           (name,)).fetchone()
+        if row is None or not self.rtree:
+            return
+        conn.execute('DELETE FROM jobs_rtree WHERE id = ?', (row["id"],))
+        if row["xmin"] is not None:
+            conn.execute('INSERT INTO jobs_rtree VALUES (?, ?, ?, ?, ?)', tuple(row))
+
+    def upsert(self, name, **fields):
+        """
+        Insert or update a job
+        """
+        fields = {k: v for k, v in fields.items() if k in COLUMNS and k != 'name'}
+        now = time.time()
+        fields["updated_at"] = now
+        with self.lock:
+            conn = self.conn
+            conn.execute('BEGIN')
+            try:
+                conn.execute('INSERT OR IGNORE INTO jobs (name, created_at) VALUES (?, ?)',
+                             (name, now))
+                conn.execute(f'UPDATE jobs SET {", ".join(f"{k} = ?" for k in fields)} '
+                             'WHERE name = ?', (*fields.values(), name))
+                if {'xmin', 'ymin', 'xmax', 'ymax'} & set(fields):
+                    self._index(conn, name)
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+
+    def update(self, name, **fields):
+        """
+        Update fields of a job already in catalog, return if it exists
+        """
+        fields = {k: v for k, v in fields.items() if k in COLUMNS and k != 'name'}
+        fields["updated_at"] = time.time()
+        with self.lock:
+            cursor = self.conn.execute(
+                f'UPDATE jobs SET {", ".join(f"{k} = ?" for k in fields)} WHERE name = ?',
+                (*fields.values(), name))
+            return cursor.rowcount > 0
+
+    def get(self, name):
+        with self.lock:
+            row = self.conn.execute(f'SELECT {", ".join(COLUMNS)} FROM jobs WHERE name = ?',
+                                    (name,)).fetchone()
+        return dict(row) if row is not None else None
+
+    def delete(self, name):
+        with self.lock:
+            conn = self.conn
+            row = conn.execute('SELECT id FROM jobs WHERE name = ?', (name,)).fetchone()
+            if row is None:
+                return False
+            if self.rtree:
+                conn.execute('DELETE FROM jobs_rtree WHERE id = ?', (row["id"],))
+            conn.execute('DELETE FROM jobs WHERE id = ?', (row["id"],))
+            return True
+
+    def states(self):
+        """
+        Return {name: (state, updated_at)} of all jobs
+        """
+        with self.lock:
+            rows = self.conn.execute('SELECT name, state, updated_at FROM jobs').fetchall()
+        return {r["name"]: (r["state"], r["updated_at"]) for r in rows}
+
+    def list(self, offset=0, limit=100, state=None, order='created_at', desc=True):
+        """
+        Paginated list of jobs, filtered by state.
+        Return (total number of matching jobs, jobs of the page)
+        """
+        if order not in ORDERS:
+            raise ValueError(f'order must be one of {ORDERS}')
+        where, params = ('WHERE state = ?', (state,)) if state is not None else ('', ())
+        with self.lock:
+            total = self.conn.execute(f'SELECT COUNT(*) FROM jobs {where}',
+                                      params).fetchone()[0]
+            rows = self.conn.execute(
+                f'SELECT {", ".join(COLUMNS)} FROM jobs {where} '
+                f'ORDER BY {order} {"DESC" if desc else "ASC"} LIMIT ? OFFSET ?',
+                (*params, limit, offset)).fetchall()
+        return total, [dict(r) for r in rows]
+
+    def covering(self, xmin, ymin, xmax, ymax, contains=True, limit=100):
+        """
+        Jobs whose LAMBERT bbox contains (or intersects if not `contains`)
+        the given LAMBERT bbox. A point is a bbox with xmin == xmax, ymin == ymax
+        """
+        params = (xmin, xmax, ymin, ymax) if contains else (xmax, xmin, ymax, ymin)
+        # Without R-tree, the bbox columns of jobs are scanned
+        table = 'jobs_rtree' if self.rtree else 'jobs'
+        query = (f'SELECT {", ".join(f"j.{c}" for c in COLUMNS)} '
+                 f'FROM {table} r JOIN jobs j ON j.id = r.id '
+                 'WHERE r.xmin <= ? AND r.xmax >= ? AND r.ymin <= ? AND r.ymax >= ? '
+                 'LIMIT ?')
+        with self.lock:
+            rows = self.conn.execute(query, (*params, limit)).fetchall()
+        return [dict(r) for r in rows]
+
+    def sync(self, directory):
+        """
+        Add prepared job directories missing from catalog, return their number
+        """
+        if not os.path.isdir(directory):
+            return 0
+        with self.lock:
+            known = {r[0] for r in self.conn.execute('SELECT name FROM jobs')}
+        missing = [d for d in os.listdir(directory)
+                   if not d.startswith('.') and d not in known]
+        for name in missing:
+            files, size = dir_size(os.path.join(directory, name))
+            self.upsert(name, state='PREPARED', files=files, size_bytes=size)
+        return len(missing)
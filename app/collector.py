@@ -0,0 +1,413 @@
+import os
+import re
+import sys
+import time
+import shutil
+import sqlite3
+import logging
+import functools
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from botocore.exceptions import ClientError
+
+import kube
+import metrics
+from configmap import ConfigMapSecrets, SHARD_OF
+from informer import MANAGED_BY
+
+logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+logger = logging.getLogger('collector')
+
+# Catalog states of jobs being prepared, never expired. Launched jobs are
+# finished by the informer, or expire once their kubernetes job is gone
+ACTIVE_STATES = ('QUEUED', 'PREPARING')
+# Deletions calling an API, rate limited
+REMOTE_KINDS = ('job', 'configmap', 'shards', 'input', 'bucket')
+# Names of jobs: sha1 of their bbox, or DNS labels
+JOB_NAME = re.compile(r'[0-9a-f]{40}|[a-z0-9]([-a-z0-9]{0,61}[a-z0-9])?')
+
+
+def valid_name(name):
+    """
+    Whether `name` is a job name, so that it can be used in paths and keys
+    """
+    return isinstance(name, str) and JOB_NAME.fullmatch(name) is not None
+
+
+def _errors():
+    """
+    Errors of a deletion, the kubernetes client being imported on first use
+    """
+    return kube.client.rest.ApiException, ClientError, OSError, sqlite3.Error
+
+
+class RateLimiter:
+    def __init__(self, rate):
+        """
+        At most `rate` calls per second across threads, unlimited if `rate`
+        is not positive
+        """
+        self.interval = 1 / rate if rate > 0 else 0
+        self.lock = threading.Lock()
+        self.next = 0.0
+
+    def acquire(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            wait = self.next - now
+            self.next = max(now, self.next) + self.interval
+        if wait > 0:
+            time.sleep(wait)
+
+
+class Collector:
+    def __init__(self, namespace, jobs_path, catalog, store=None, s3=None,
+                 input_bucket=None, ttl=None, grace=None, rate=None, concurrency=None,
+                 tiles_path=None, tiles_ttl=None, temp_ttl=None, preparing=None):
+        """
+        Garbage collection of the resources of jobs. Jobs, configmaps, job
+        directories, job inputs in object storage and buckets are listed
+        once per run and compared to find:
+            - orphans: input configmaps and input objects of jobs that no
+              longer exist, temporary directories left by interrupted
+              preparations and copies
+            - expired jobs: jobs of catalog not updated for `ttl` seconds,
+              all their resources are deleted, website bucket included
+            - tiles not composed for `tiles_ttl` seconds
+        Deletions run concurrently and calls to APIs are rate limited.
+
+        Usage example:
+            collector = Collector('twincity', '/data/jobs', catalog, store, s3,
+                                  input_bucket='twincity-job-inputs')
+            collector.collect(dry_run=True)
+            collector.delete(['name'])
+            collector.start(3600)
+
+        Parameters
+        ----------
+        namespace: str, namespace of jobs and configmaps
+        jobs_path: str, directory of prepared data of jobs
+        catalog: Catalog, catalog of jobs
+        store: ArtifactStore, store of prepared data
+        s3: S3, connector of website buckets and job inputs
+        input_bucket: str, bucket of job inputs, stored under `inputs/{name}/`
+        ttl: float, seconds after which a job is expired, default env
+             `GC_JOB_TTL` or 0 (jobs never expire)
+        grace: float, age in seconds of orphans before they are deleted, so
+               that resources of jobs being launched are kept,
+               default env `GC_GRACE` or 600
+        rate: float, API calls per second, default env `GC_RATE` or 20
+        concurrency: int, deletions at the same time,
+                     default env `GC_CONCURRENCY` or 8
+        tiles_path: str, directory of prepared tiles
+        tiles_ttl: float, seconds after which an unused tile is deleted,
+                   default env `GC_TILE_TTL` or 604800 (a week), 0 to keep them
+        temp_ttl: float, age in seconds of temporary directories before they
+                  are deleted, longer than the longest preparation,
+                  default env `GC_TEMP_TTL` or 21600
+        preparing: callable returning names of jobs being prepared, their
+                   temporary directories are kept
+        """
+        self.namespace = namespace
+        self.jobs_path = jobs_path
+        self.catalog = catalog
+        self.store = store
+        self.s3 = s3
+        self.input_bucket = input_bucket
+        self.ttl = ttl if ttl is not None else float(os.getenv('GC_JOB_TTL', 0))
+        self.grace = grace if grace is not None else float(os.getenv('GC_GRACE', 600))
+        self.limiter = RateLimiter(rate if rate is not None
+                                   else float(os.getenv('GC_RATE', 20)))
+        self.concurrency = concurrency if concurrency is not None \
+            else int(os.getenv('GC_CONCURRENCY', 8))
+        self.tiles_path = tiles_path
+        self.tiles_ttl = tiles_ttl if tiles_ttl is not None \
+            else float(os.getenv('GC_TILE_TTL', 7 * 24 * 3600))
+        self.temp_ttl = temp_ttl if temp_ttl is not None \
+            else float(os.getenv('GC_TEMP_TTL', 6 * 3600))
+        self.preparing = preparing
+        self.running = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.last_run = None
+
+    def _list_configmaps(self):
+        """
+        Return {name: (owner job, created_at, managed)} of configmaps
+        """
+        configmaps = {}
+        for name, obj in ConfigMapSecrets.list_existing(
+                kind='configmap', namespace=self.namespace).items():
+            labels = obj.metadata.labels or {}
+            created = obj.metadata.creation_timestamp
+            configmaps[name] = (labels.get(SHARD_OF, name),
+                                created.timestamp() if created is not None else time.time(),
+                                MANAGED_BY.items() <= labels.items())
+        return configmaps
+
+    @staticmethod
+    def _directories(path):
+        """
+        Return {name: mtime} of the directories of `path`
+        """
+        directories = {}
+        if path is not None and os.path.isdir(path):
+            for entry in os.scandir(path):
+                if entry.is_dir():
+                    directories[entry.name] = entry.stat().st_mtime
+        return directories
+
+    def snapshot(self):
+        """
+        List every resource once.
+        Return a dict of `jobs` (names), `in_use` (names of districts of
+        existing jobs), `configmaps`, `directories` and `tiles`
+        ({name: mtime}), `inputs` ({name: last modified}), `buckets`,
+        `catalog` and `preparing` (names)
+        """
+        # Every job of the namespace, jobs created before they were labelled
+        # still use their configmaps
+        jobs = kube.batch_api().list_namespaced_job(namespace=self.namespace).items
+        in_use = set()
+        for job in jobs:
+            in_use.add(job.metadata.name)
+            if job.spec is None:
+                continue
+            pod = job.spec.template.spec
+            for container in (pod.containers or []) + (pod.init_containers or []):
+                for env in container.env or []:
+                    if env.name in ('BUCKET_NAME', 'BUCKET_NAMES') and env.value:
+                        in_use.update(env.value.split())
+
+        directories = self._directories(self.jobs_path)
+
+        inputs = {}
+        if self.s3 is not None and self.input_bucket is not None:
+            for key, modified in self.s3.list_keys(self.input_bucket, 'inputs/'):
+                name = key.split('/')[1]
+                inputs[name] = max(modified, inputs.get(name, 0))
+
+        buckets = set(self.s3.list_bucket_names()) \
+            if self.s3 is not None and self.ttl else set()
+
+        return {"jobs": {job.metadata.name for job in jobs},
+                "in_use": in_use,
+                "configmaps": self._list_configmaps(),
+                "directories": directories,
+                "tiles": self._directories(self.tiles_path) if self.tiles_ttl else {},
+                "inputs": inputs,
+                "buckets": buckets,
+                "catalog": self.catalog.states(),
+                "preparing": set(self.preparing()) if self.preparing is not None else set()}
+
+    def plan(self, snapshot, now=None):
+        """
+        Resources to delete from a snapshot, return {kind: [names]}
+        """
+        now = now if now is not None else time.time()
+        in_use, catalog = snapshot["in_use"], snapshot["catalog"]
+        expired = set()
+        if self.ttl:
+            expired = {name for name, (state, updated_at) in catalog.items()
+                       if state not in ACTIVE_STATES and name not in in_use
+                       and not (state == 'LAUNCHED' and name in snapshot["jobs"])
+                       and updated_at is not None and now - updated_at > self.ttl}
+
+        def _orphan(name, since):
+            return name in expired or (name not in in_use and now - since > self.grace)
+
+        # Configmaps of other applications are never touched
+        known = set(catalog) | set(snapshot["directories"])
+        configmaps = [name for name, (owner, created, managed)
+                      in snapshot["configmaps"].items()
+                      if (managed or owner in known) and _orphan(owner, created)]
+        # Temporary directories are named `.{name}.{id}.tmp`
+        temporary = [name for name, mtime in snapshot["directories"].items()
+                     if name.startswith('.') and name.endswith('.tmp')
+                     and name[1:].rsplit('.', 2)[0] not in snapshot["preparing"]
+                     and now - mtime > self.temp_ttl]
+        return {"configmap": sorted(configmaps),
+                "input": sorted(name for name, modified in snapshot["inputs"].items()
+                                if _orphan(name, modified)),
+                "directory": sorted(expired & set(snapshot["directories"])) + temporary,
+                "artifact": sorted(expired) if self.store is not None else [],
+                "bucket": sorted(expired & snapshot["buckets"]),
+                "tile": sorted(name for name, mtime in snapshot["tiles"].items()
+                               if not name.startswith('.') and now - mtime > self.tiles_ttl),
+                "catalog": sorted(expired)}
+
+    def _delete_job(self, name):
+        try:
+            kube.batch_api().delete_namespaced_job(
+                name=name, namespace=self.namespace,
+                body=kube.client.V1DeleteOptions(propagation_policy='Foreground',
+                                                 grace_period_seconds=5))
+        except kube.client.rest.ApiException as e:
+            if e.status == 404:
+                return False
+            metrics.error('kube', 'delete_job')
+            raise
+        return True
+
+    def _delete_directory(self, name, parent=None):
+        parent = parent if parent is not None else self.jobs_path
+        root = os.path.realpath(parent)
+        path = os.path.realpath(os.path.join(parent, name))
+        if os.path.dirname(path) != root:
+            logger.warning(f'Directory {name} is not in {parent}, kept')
+            return False
+        if not os.path.isdir(path):
+            return False
+        shutil.rmtree(path)
+        return True
+
+    def _delete_shards(self, name):
+        """
+        Delete configmaps holding shards of the input of a job
+        """
+        shards = ConfigMapSecrets.list_existing(
+            kind='configmap', namespace=self.namespace,
+            label_selector=f'{SHARD_OF}={name}')
+        deleted = False
+        for shard in sorted(shards):
+            self.limiter.acquire()
+            deleted = ConfigMapSecrets.delete_existing(
+                shard, kind='configmap', namespace=self.namespace) or deleted
+        return deleted
+
+    def _task(self, kind, name):
+        """
+        Deletion of one resource, returning if something was deleted
+        """
+        if kind == 'job':
+            return functools.partial(self._delete_job, name)
+        if kind == 'configmap':
+            return functools.partial(ConfigMapSecrets.delete_existing, name,
+                                     kind='configmap', namespace=self.namespace)
+        if kind == 'shards':
+            return functools.partial(self._delete_shards, name)
+        if kind == 'input':
+            return lambda: self.s3.delete_prefix(self.input_bucket, f'inputs/{name}/') > 0
+        if kind == 'directory':
+            return functools.partial(self._delete_directory, name)
+        if kind == 'tile':
+            return functools.partial(self._delete_directory, name, self.tiles_path)
+        if kind == 'artifact':
+            return functools.partial(self.store.delete, name)
+        if kind == 'bucket':
+            return functools.partial(self.s3.delete_bucket, name)
+        if kind == 'catalog':
+            return functools.partial(self.catalog.delete, name)
+        raise ValueError(f'unknown kind {kind}')
+
+    def _call(self, item):
+        kind, name = item
+        if kind in REMOTE_KINDS:
+            self.limiter.acquire()
+        try:
+            return kind, name, self._task(kind, name)(), None
+        except _errors() as f:
+            logger.error(f'Deletion of {kind} {name} failed: {f}')
+            return kind, name, False, str(f)
+
+    def execute(self, plan):
+        """
+        Delete resources of a plan concurrently. Catalog entries are deleted
+        last, only for jobs whose other resources were all deleted, so that
+        failed deletions are retried by the next run.
+        Return {deleted: {kind: [names]}, errors: [{kind, name, error}]}
+        """
+        report = {"deleted": defaultdict(list), "errors": []}
+        items = [(kind, name) for kind, names in plan.items() if kind != 'catalog'
+                 for name in names]
+        with ThreadPoolExecutor(max_workers=self.concurrency,
+                                thread_name_prefix='collector') as executor:
+            for kind, name, deleted, error in executor.map(self._call, items):
+                if error is not None:
+                    report["errors"].append({"kind": kind, "name": name, "error": error})
+                elif deleted:
+                    report["deleted"][kind].append(name)
+                    metrics.GC_DELETED.labels(kind).inc()
+            failed = {e["name"] for e in report["errors"]}
+            catalog = [('catalog', n) for n in plan.get("catalog", []) if n not in failed]
+            for kind, name, deleted, error in executor.map(self._call, catalog):
+                if error is not None:
+                    report["errors"].append({"kind": kind, "name": name, "error": error})
+                elif deleted:
+                    report["deleted"][kind].append(name)
+        report["deleted"] = dict(report["deleted"])
+        return report
+
+    def collect(self, dry_run=False):
+        """
+        Run a garbage collection, return its report or None if another one
+        is running. With `dry_run`, only the plan is returned
+        """
+        if not self.running.acquire(blocking=False):
+            return None
+        try:
+            with metrics.timed('gc'):
+                start = time.time()
+                plan = self.plan(self.snapshot())
+                report = {"dry_run": dry_run, "plan": plan} if dry_run \
+                    else self.execute(plan)
+                report["seconds"] = round(time.time() - start, 3)
+            if not dry_run:
+                self.last_run = {"at": start, "seconds": report["seconds"],
+                                 "deleted": {k: len(v) for k, v in report["deleted"].items()},
+                                 "errors": len(report["errors"])}
+                logger.info(f'Garbage collection: {self.last_run["deleted"]} deleted, '
+                            f'{self.last_run["errors"]} errors in {report["seconds"]}s')
+            return report
+        finally:
+            self.running.release()
+
+    def delete(self, names):
+        """
+        Delete jobs and their resources (job, configmaps, directory, inputs,
+        artifacts and catalog entry), website buckets are kept.
+        Configmaps are deleted by name, their shards found by label.
+        Raise ValueError if a name is not a job name
+        """
+        names = set(names)
+        invalid = sorted(n for n in names if not valid_name(n))
+        if invalid:
+            raise ValueError(f'invalid job names: {invalid}')
+        plan = {"job": sorted(names),
+                "configmap": sorted(names),
+                "shards": sorted(names),
+                "input": sorted(names) if self.s3 is not None and self.input_bucket else [],
+                "directory": sorted(names),
+                "artifact": sorted(names) if self.store is not None else [],
+                "catalog": sorted(names)}
+        return self.execute(plan)
+
+    def _run(self, interval):
+        while not self.stopped.wait(interval):
+            try:
+                self.collect()
+            except Exception as f:
+                logger.error(f'Garbage collection failed: {f}')
+
+    def start(self, interval=3600):
+        """
+        Collect in background every `interval` seconds
+        """
+        if self.thread is not None or interval <= 0:
+            return
+        self.thread = threading.Thread(target=self._run, name='collector',
+                                       args=(interval,), daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def stats(self):
+        return {"running": self.running.locked(),
+                "ttl": self.ttl,
+                "grace": self.grace,
+                "last_run": self.last_run}
@@ -1,22 +1,65 @@
 import os
+import sys
+import json
+import logging
+import codecs
 import pathlib
 import base64
-from kubernetes import client
+import hashlib
+
+import kube
+import metrics
+
+logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+logger = logging.getLogger('configmap')
+
+CONTENT_HASH = 'twincity.fr/content-hash'
+SHARD_OF = 'twincity.fr/shard-of'
+# etcd objects are limited to 1MiB, keep room for metadata
+MAX_BYTES = int(os.getenv('CONFIGMAP_MAX_BYTES', 1000000))
+# Multiple of 3 so that base64 of chunks can be concatenated
+CHUNK_SIZE = 3 * 256 * 1024
 
 
 class ConfigMapSecrets:
+    dict_values = {'secret': {'list': 'list_namespaced_secret',
+                              'read': 'read_namespaced_secret',
+                              'object': 'V1Secret',
+                              'resource': 'Secret',
+                              'create': 'create_namespaced_secret',
+                              'patch': 'patch_namespaced_secret',
+                              'delete': 'delete_namespaced_secret'},
+                   'configmap': {'list': 'list_namespaced_config_map',
+                                 'read': 'read_namespaced_config_map',
+                                 'object': 'V1ConfigMap',
+                                 'create': 'create_namespaced_config_map',
+                                 'patch': 'patch_namespaced_config_map',
+                                 'resource': 'ConfigMap',
+                                 'delete': 'delete_namespaced_config_map'}
+                   }
+
     def __init__(
             self,
             name,
             kind='secret',
             from_path=None,
             namespace='default',
-            metadata=None):
+            metadata=None,
+            max_bytes=None):
         """
         Create configmap or secret from filepath: by a directory, \
             a list of files or a specific file (note: if kind is \
                 secret, data be encoded in base64)
 
+        If it already exists, it is left untouched when its content hash
+        annotation matches the files, else only changed keys are patched
+
+        Files are streamed: text files go to `data`, binary ones to
+        `binary_data` (base64). When the payload is larger than `max_bytes`
+        (default env `CONFIGMAP_MAX_BYTES`), files are sharded across several
+        objects `{name}-{i}` labeled with `twincity.fr/shard-of`, whose names
+        are in `names` (mount them with a projected volume)
+
         Usage example:
             a = ConfigMapSecrets(name='test', kind='secret', from_path='./configmap.py')
             print(a)
@@ -26,38 +69,81 @@ class ConfigMapSecrets:
         self.name = name
         self.ns = namespace
         self.metadata = metadata
-        self.api_instance = client.CoreV1Api()
+        self.api_instance = kube.core_api()
         self.kind = kind
         self.encode = True if self.kind == 'secret' else False
-        self.dict_values = {'secret': {'list': 'list_namespaced_secret',
-                                       'object': 'V1Secret',
-                                       'resource': 'Secret',
-                                       'create': 'create_namespaced_secret',
-                                       'delete': 'delete_namespaced_secret'},
-                            'configmap': {'list': 'list_namespaced_config_map',
-                                          'object': 'V1ConfigMap',
-                                          'create': 'create_namespaced_config_map',
-                                          'resource': 'ConfigMap',
-                                          'delete': 'delete_namespaced_config_map'}
-                            }
+        self.max_bytes = max_bytes if max_bytes is not None else MAX_BYTES
+        shards = self.plan_shards(self._check_type(from_path) or [],
+                                  self.max_bytes, self.encode)
+        self.shards = []
+        self.names = [name]
+        if len(shards) > 1:
+            self._create_shards(shards)
+            return
         self.obj = self._get_if_exist()
-        if self.obj is not None:
-            self.delete(msg='replace')
-        data_conf = self._create_object(path=from_path)
-        self.obj = self._create(data_conf)
+        data_conf = self._create_object(path=shards[0] if shards else from_path)
+        if self.obj is None:
+            # Data could have been sharded before
+            self._delete_shards()
+            self.obj = self._create(data_conf)
+        else:
+            self.obj = self._apply(data_conf)
         #self.metadata = self.obj.metadata
 
     def __repr__(self):
         return str(self.obj)
 
     def _get_if_exist(self):
-        cm = getattr(self.api_instance, self.dict_values[self.kind][
-            "list"])(namespace=self.ns)
-        all_cm = [{"name": c["metadata"]["name"], 'index': n
-                   } for n, c in enumerate(cm.to_dict()["items"])]
-        for k in all_cm:
-            if self.name == k["name"]:
-                return cm.items[k["index"]]
+        """
+        Read configmap/secret by name, None if it does not exist
+        """
+        try:
+            return getattr(self.api_instance, self.dict_values[self.kind][
+                "read"])(name=self.name, namespace=self.ns)
+        except kube.client.rest.ApiException as e:
+            if e.status == 404:
+                return None
+            raise
+
+    @classmethod
+    def list_existing(cls, names=None, kind='secret', namespace='default',
+                      label_selector=None, field_selector=None):
+        """
+        Get many configmaps/secrets in one list call, filtered server side by
+        selectors and locally by `names` if given.
+        Return a dict of objects by name
+
+        Usage example:
+            ConfigMapSecrets.list_existing(['a', 'b'], kind='configmap',
+                                           namespace='twincity')
+        """
+        items = getattr(kube.core_api(), cls.dict_values[kind]["list"])(
+            namespace=namespace, label_selector=label_selector,
+            field_selector=field_selector).items
+        names = set(names) if names is not None else None
+        return {i.metadata.name: i for i in items
+                if names is None or i.metadata.name in names}
+
+    @classmethod
+    def delete_existing(cls, name, kind='secret', namespace='default'):
+        """
+        Delete a configmap/secret by name without reading it first.
+        Return False if it does not exist
+
+        Usage example:
+            ConfigMapSecrets.delete_existing('name', kind='configmap',
+                                             namespace='twincity')
+        """
+        try:
+            getattr(kube.core_api(), cls.dict_values[kind]["delete"])(
+                namespace=namespace, name=name)
+        except kube.client.rest.ApiException as e:
+            if e.status == 404:
+                return False
+            metrics.error('kube', f'delete_{kind}')
+            raise
+        logger.info(f'{name} {kind} was deleted sucessfully')
+        return True
 
     @staticmethod
     def _check_type(path):
@@ -73,43 +159,153 @@ class ConfigMapSecrets:
                 return [os.path.join(path, i) for i in os.listdir(path)]
             return [path]
 
+    @staticmethod
+    def _is_text(file):
+        """
+        Stream a whole file to check it is utf-8 text, as `_read_file` does
+        """
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        try:
+            with open(file, 'rb') as f:
+                for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                    decoder.decode(chunk)
+            decoder.decode(b'', final=True)
+            return True
+        except UnicodeDecodeError:
+            return False
+
+    @classmethod
+    def payload_size(cls, file, encode: bool=False):
+        """
+        Size of a file once in the payload: base64 length when it is
+        encoded or not text, else its size
+        """
+        size = os.path.getsize(file)
+        if encode or not cls._is_text(file):
+            size = 4 * -(-size // 3)
+        return size + len(pathlib.Path(file).name)
+
+    @classmethod
+    def plan_shards(cls, files, max_bytes, encode: bool=False):
+        """
+        Split files in groups whose payload fits in `max_bytes`
+        """
+        sizes = {f: cls.payload_size(f, encode) for f in files}
+        if sum(sizes.values()) <= max_bytes:
+            return [files] if files else []
+        shards, current, total = [], [], 0
+        for file in sorted(files):
+            if sizes[file] > max_bytes:
+                raise ValueError(f'{file} is too large to fit in a configmap/secret: '
+                                 f'{sizes[file]} > {max_bytes} bytes')
+            if total + sizes[file] > max_bytes:
+                shards.append(current)
+                current, total = [], 0
+            current.append(file)
+            total += sizes[file]
+        shards.append(current)
+        return shards
+
+    @staticmethod
+    def _read_file(file, encode: bool=False):
+        """
+        Stream a file, return (text, None) for utf-8 text read as is,
+        else (None, base64 content)
+        """
+        if not encode:
+            decoder = codecs.getincrementaldecoder('utf-8')()
+            try:
+                with open(file, 'rb') as f:
+                    text = ''.join(decoder.decode(chunk) for chunk in
+                                   iter(lambda: f.read(CHUNK_SIZE), b''))
+                return text + decoder.decode(b'', final=True), None
+            except UnicodeDecodeError:
+                pass
+        with open(file, 'rb') as f:
+            return None, ''.join(base64.b64encode(chunk).decode('utf-8') for chunk in
+                                 iter(lambda: f.read(CHUNK_SIZE), b''))
+
     @classmethod
     def read_data_from_file(cls, path, encode: bool=False):
         """
-        Read data from file. For secret it's possible to encode them
+        Read data from file. For secret it's possible to encode them.
+        Return (data, binary_data), binary files being base64 encoded in
+        binary_data (all files are in data when encoded)
         """
-        data = {}
+        data, binary_data = {}, {}
         list_path = cls._check_type(path)
         if list_path is not None:
             for file in list_path:
-                with open(file, 'r') as f:
-                    filename = pathlib.Path(file).name
-                    data[filename] = f.read() if not encode else base64.b64encode(
-                        str.encode(f.read())).decode('utf-8')
-        return data
+                filename = pathlib.Path(file).name
+                text, encoded = cls._read_file(file, encode)
+                if text is not None:
+                    data[filename] = text
+                elif encode:
+                    data[filename] = encoded
+                else:
+                    binary_data[filename] = encoded
+        return data, binary_data
 
     def _create_object(self, path):
         """
         Prepare kubernetes object
         """
-        metadata = client.V1ObjectMeta(
+        metadata = kube.client.V1ObjectMeta(
             deletion_grace_period_seconds=5,
             #deletion_timestamp=10,
             name=self.name)
 
         if self.metadata is not None:
-            metadata = metadata | self.metadata
+            for key, value in self.metadata.items():
+                setattr(metadata, key, value)
 
-        data = self.read_data_from_file(path, self.encode)
+        data, binary_data = self.read_data_from_file(path, self.encode)
+        metadata.annotations = {**(metadata.annotations or {}),
+                                CONTENT_HASH: self.content_hash(data, binary_data)}
+        expand = {"binary_data": binary_data} if binary_data else {}
 
-        yaml = getattr(client, self.dict_values[self.kind]["object"])(
+        yaml = getattr(kube.client, self.dict_values[self.kind]["object"])(
             api_version="v1",
             kind=self.dict_values[self.kind]["resource"],
             data=data,
-            metadata=metadata
+            metadata=metadata,
+            **expand
         )
         return yaml
 
+    def _create_shards(self, shards):
+        """
+        Create one configmap/secret per group of files
+        """
+        self.names = [f'{self.name}-{i}' for i in range(len(shards))]
+        metadata = dict(self.metadata or {})
+        metadata["labels"] = {**(metadata.get("labels") or {}), SHARD_OF: self.name}
+        self.shards = [ConfigMapSecrets(name=name,
+                                        kind=self.kind,
+                                        from_path=files,
+                                        namespace=self.ns,
+                                        metadata=metadata,
+                                        max_bytes=float('inf'))
+                       for name, files in zip(self.names, shards)]
+        self.obj = [shard.obj for shard in self.shards]
+        # Remove unsharded object and shards left from a bigger payload
+        if self._get_if_exist() is not None:
+            self.delete(msg='replace', shards=False)
+        self._delete_shards(keep=self.names)
+        logger.info(f'{self.name} {self.kind} sharded in {len(shards)} objects')
+
+    def _delete_shards(self, keep=()):
+        for name in self.list_existing(kind=self.kind, namespace=self.ns,
+                                       label_selector=f'{SHARD_OF}={self.name}'):
+            if name in keep:
+                continue
+            try:
+                getattr(self.api_instance, self.dict_values[self.kind]["delete"])(
+                    namespace=self.ns, name=name)
+            except kube.client.rest.ApiException as e:
+                metrics.error('kube', f'delete_{self.kind}')
+                logger.error(f"Error when calling delete {self.kind} {name}: {e}")
+
     def _create(self, yaml_object):
         """
         Create configmap/secret
@@ -122,16 +318,67 @@ class ConfigMapSecrets:
             )
             return api_response
 
-        except client.rest.ApiException as e:
+        except kube.client.rest.ApiException as e:
+            metrics.error('kube', f'create_{self.kind}')
             return f"Error when calling create {self.kind}: {e}\n"
 
-    def delete(self, msg='delete'):
+    @staticmethod
+    def content_hash(data, binary_data=None):
+        return hashlib.sha256(json.dumps([data, binary_data or {}],
+                                         sort_keys=True).encode()).hexdigest()
+
+    @staticmethod
+    def _diff(current, new):
+        """
+        Changed keys, with null values to remove keys absent from new
+        """
+        current, new = current or {}, new or {}
+        diff = {k: v for k, v in new.items() if current.get(k) != v}
+        diff.update({k: None for k in current if k not in new})
+        return diff
+
+    def _apply(self, yaml_object):
+        """
+        Patch existing configmap/secret with changed keys only,
+        skip the call if its content hash is unchanged
+        """
+        content_hash = yaml_object.metadata.annotations[CONTENT_HASH]
+        annotations = self.obj.metadata.annotations or {}
+        if annotations.get(CONTENT_HASH) == content_hash:
+            logger.info(f'{self.name} {self.kind} is unchanged')
+            return self.obj
+
+        data = self._diff(self.obj.data, yaml_object.data)
+        body = {"metadata": {"annotations": {CONTENT_HASH: content_hash}},
+                "data": data}
+        if self.kind == 'configmap':
+            binary_data = self._diff(self.obj.binary_data, yaml_object.binary_data)
+            body["binaryData"] = binary_data
+            data = {**data, **binary_data}
+        try:
+            api_response = getattr(self.api_instance,
+                                   self.dict_values[self.kind]["patch"])(
+                name=self.name,
+                namespace=self.ns,
+                body=body
+            )
+            logger.info(f'{self.name} {self.kind} was patched sucessfully ({len(data)} keys)')
+            return api_response
+
+        except kube.client.rest.ApiException as e:
+            metrics.error('kube', f'patch_{self.kind}')
+            return f"Error when calling patch {self.kind}: {e}\n"
+
+    def delete(self, msg='delete', shards=True):
         """
-        Delete current configmap/secret
+        Delete current configmap/secret, and its shards
         """
+        if shards:
+            self._delete_shards()
         try:
             getattr(self.api_instance, self.dict_values[self.kind]["delete"])(
                 namespace=self.ns, name=self.name)
-            print(f'{self.name} {self.kind} was {msg}d sucessfully')
-        except client.rest.ApiException as e:
+            logger.info(f'{self.name} {self.kind} was {msg}d sucessfully')
+        except kube.client.rest.ApiException as e:
+            metrics.error('kube', f'{msg}_{self.kind}')
             return f"Error when calling {msg} {self.kind}: {e}\n"
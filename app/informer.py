@@ -0,0 +1,200 @@
+import os
+import sys
+import time
+import asyncio
+import logging
+import threading
+
+import kube
+
+logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+logger = logging.getLogger('informer')
+
+MANAGED_BY = {"app.kubernetes.io/managed-by": "twincity-backend"}
+
+
+class JobInformer:
+    def __init__(self, namespace="default", label_selector=None, resync=300):
+        """
+        Keep a local cache of jobs status up to date by watching jobs of a
+        namespace, so status can be served without calling the API server
+
+        Usage example:
+            informer = JobInformer(namespace='twincity')
+            informer.start()
+            informer.get('name')
+
+        Parameters
+        ----------
+        namespace: str, namespace of watched jobs
+        label_selector: str, selector of watched jobs,
+                        default env `JOB_LABEL_SELECTOR` or jobs created by backend
+        resync: int, seconds after which the watch is restarted
+        """
+        self.namespace = namespace
+        self.label_selector = label_selector if label_selector is not None \
+            else os.getenv('JOB_LABEL_SELECTOR', ','.join(
+                f'{k}={v}' for k, v in MANAGED_BY.items()))
+        self.resync = resync
+        self.condition = threading.Condition()
+        self.cache = {}
+        self.versions = {}
+        self.version = 0
+        self.async_waiters = []
+        self.listeners = []
+        self.synced = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    @staticmethod
+    def _status(job):
+        info = job.status.to_dict()
+        info["name"] = job.metadata.name
+        info["labels"] = job.metadata.labels or {}
+        # Environment of the job container, districts of Indexed Jobs
+        info["env"] = {}
+        if job.spec is not None and job.spec.template.spec is not None:
+            for container in job.spec.template.spec.containers[:1]:
+                info["env"] = {e.name: e.value for e in container.env or []
+                               if e.value is not None}
+        return info
+
+    def _set(self, name, info):
+        """
+        Update cache and wake up waiters if status changed
+        """
+        with self.condition:
+            if info is None:
+                if self.cache.pop(name, None) is None:
+                    return
+            elif self.cache.get(name) == info:
+                return
+            else:
+                self.cache[name] = info
+            self.version += 1
+            if info is None:
+                # Version 0 of missing jobs, waiters see the deletion
+                self.versions.pop(name, None)
+            else:
+                self.versions[name] = self.version
+            self.condition.notify_all()
+            for loop, event in self.async_waiters:
+                loop.call_soon_threadsafe(event.set)
+        for listener in self.listeners:
+            try:
+                listener(name, info)
+            except Exception as f:
+                logger.error(f'Listener failed for {name}: {f}')
+
+    def add_listener(self, listener):
+        """
+        Call `listener` with (name, status) on each change of a job status,
+        status is None when the job is deleted
+        """
+        self.listeners.append(listener)
+
+    def _list(self, api):
+        """
+        List all jobs to (re)build the cache, return resource version
+        """
+        jobs = api.list_namespaced_job(namespace=self.namespace,
+                                       label_selector=self.label_selector)
+        listed = {j.metadata.name: self._status(j) for j in jobs.items}
+        for name in set(self.cache) - set(listed):
+            self._set(name, None)
+        for name, info in listed.items():
+            self._set(name, info)
+        self.synced.set()
+        return jobs.metadata.resource_version
+
+    def _run(self):
+        resource_version, backoff = None, 1
+        while not self.stopped.is_set():
+            try:
+                api = kube.batch_api()
+                if resource_version is None:
+                    resource_version = self._list(api)
+                for event in kube.watch.Watch().stream(
+                        api.list_namespaced_job,
+                        namespace=self.namespace,
+                        label_selector=self.label_selector,
+                        resource_version=resource_version,
+                        timeout_seconds=self.resync):
+                    if event["type"] == "ERROR":
+                        # Resource version too old: list again
+                        resource_version = None
+                        break
+                    job = event["object"]
+                    resource_version = job.metadata.resource_version
+                    self._set(job.metadata.name, None if event["type"] == "DELETED"
+                              else self._status(job))
+                    if self.stopped.is_set():
+                        break
+                backoff = 1
+            except kube.client.rest.ApiException as f:
+                if f.status == 410:
+                    resource_version = None
+                    continue
+                logger.warning(f'Job watch failed: {f.reason}, retry in {backoff}s')
+                self.stopped.wait(backoff)
+                backoff = min(backoff * 2, 60)
+            except Exception as f:
+                logger.warning(f'Job watch failed: {f}, retry in {backoff}s')
+                resource_version = None
+                self.synced.clear()
+                self.stopped.wait(backoff)
+                backoff = min(backoff * 2, 60)
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self.thread = threading.Thread(target=self._run, name='job-informer',
+                                       daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def get(self, name):
+        """
+        Return (status, version) of a job from cache, status is None if
+        the job does not exist
+        """
+        with self.condition:
+            return self.cache.get(name), self.versions.get(name, 0)
+
+    def wait(self, name, version=0, timeout=30):
+        """
+        Long poll: wait until status of a job changes from `version`,
+        at most `timeout` seconds. Return (status, version), version is 0
+        while the job does not exist
+        """
+        deadline = time.time() + timeout
+        with self.condition:
+            while self.versions.get(name, 0) == version:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            return self.cache.get(name), self.versions.get(name, 0)
+
+    async def async_wait(self, name, version=0, timeout=30):
+        """
+        Same as `wait` without holding a thread, for async endpoints
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while True:
+            with self.condition:
+                remaining = deadline - loop.time()
+                if self.versions.get(name, 0) != version or remaining <= 0:
+                    return self.cache.get(name), self.versions.get(name, 0)
+                waiter = (loop, asyncio.Event())
+                self.async_waiters.append(waiter)
+            try:
+                await asyncio.wait_for(waiter[1].wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                with self.condition:
+                    self.async_waiters.remove(waiter)
@@ -1,7 +1,11 @@
+import re
 import sys
+import copy
 import json
 import logging
-from kubernetes import client
+
+import kube
+import metrics
 
 logging.basicConfig(stream=sys.stdout, level=logging.INFO)
 logger = logging.getLogger('jobs')
@@ -18,8 +22,7 @@ class Job:
                  mount_path=None,
                  **kwargs):
         """
-        Make a job in a kubernetes cluster
-        WARNING: must run command `config.load_kube_config()`
+        Make a job in a kubernetes cluster, with the shared client of `kube`
 
         Parameters
         ----------
@@ -27,7 +30,8 @@ class Job:
         namespace : str, namespace where job is launch
         cmd: list or str, entrypoint command
         args: list or str, args of entrypoint command
-        config: list or str, name of configmap or secrets available in cluster
+        config: list or str, name of configmap or secrets available in cluster,
+                an item can be a list of names mounted as one projected volume
         mount_path: list or str, path where config is mounted (evaluated by index)
         kwargs:
             - retry: int, default 1, number of retry if job failed
@@ -37,10 +41,17 @@ class Job:
             - read_only: bool, default None, mounted volumes are in read only
             - ttl_deletion: int, time in seconds to delete automatically the job
                             after finish, default 3600
-            - type_volume: str or list, type of mount for config `secret` or `configmap`
+            - type_volume: str or list, type of mount for config `secret`, `configmap`,
+                           `emptydir` (empty directory, config is only its name),
+                           `pvc` (config is a persistent volume claim) or
+                           `hostpath` (config is a directory of the node)
+            - init_containers: list of dict, containers run before the job container,
+                               with keys `name`, `image`, `cmd`, `args`, `env` and
+                               `mount_path` (list of mount_path of job volumes to mount)
             - env: dict, each key value of env vars to mount in pod
+            - labels: dict, labels added to job and pod
         """
-        self.api_instance = client.BatchV1Api()
+        self._api_instance = None
         self.image = image
         self.job_name = name
         self.cmd = cmd
@@ -56,15 +67,25 @@ class Job:
     def __repr__(self):
         return str(self.job)
 
-    def _add_env_vars(self):
+    @property
+    def api_instance(self):
+        """
+        Client fetched on first API call, building a job object needs none
+        """
+        if self._api_instance is None:
+            self._api_instance = kube.batch_api()
+        return self._api_instance
+
+    def _add_env_vars(self, env=None):
         """
         Add envs var to container spec
         """
-        env = self.kwargs["env"] if "env" \
-            in self.kwargs else None
+        if env is None:
+            env = self.kwargs["env"] if "env" \
+                in self.kwargs else None
 
         if env is not None:
-            env = [client.V1EnvVar(name=k, value=v) for k, v in env.items()]
+            env = [kube.client.V1EnvVar(name=k, value=v) for k, v in env.items()]
         return env
 
     def _create_volumes(self):
@@ -80,7 +101,7 @@ class Job:
             self.mount_path, str) else self.mount_path
 
         if len(self.config) != len(self.mount_path):
-            print('Mismatch configmaps and volumes mounts')
+            logger.warning('Mismatch configmaps and volumes mounts')
             return None, None
 
         self.type_volumes = self.kwargs["type_volume"] if "type_volume" \
@@ -92,30 +113,83 @@ class Job:
             self.type_volumes, str) else self.type_volumes
 
         if len(self.type_volumes) != len(self.mount_path):
-            print('Mismatch types volumes, all types are converted to configmap')
+            logger.warning('Mismatch types volumes, all types are converted to configmap')
             return None, None
 
         l_volume, l_volumemount = [], []
 
         for cm, vm, tm in zip(self.config, self.mount_path, self.type_volumes):
+            volume, volume_mount = self._create_volume(cm, vm, tm)
+            l_volume.append(volume), l_volumemount.append(volume_mount)
+
+        return l_volume, l_volumemount
+
+    def _create_volume(self, cm, vm, tm):
+        """
+        Create volume and volume mount of one config mounted at `vm`
+        """
+        if isinstance(cm, list):
+            # Shards of a configmap/secret are mounted in the same directory
             if tm == 'secret':
-                expand = {"secret": client.V1SecretVolumeSource(secret_name=cm)}
+                sources = [kube.client.V1VolumeProjection(
+                    secret=kube.client.V1SecretProjection(name=c)) for c in cm]
             else:
-                expand = {"config_map": client.V1ConfigMapVolumeSource(name=cm)}
+                sources = [kube.client.V1VolumeProjection(
+                    config_map=kube.client.V1ConfigMapProjection(name=c)) for c in cm]
+            expand = {"projected": kube.client.V1ProjectedVolumeSource(sources=sources)}
+            cm = cm[0]
+        elif tm == 'secret':
+            expand = {"secret": kube.client.V1SecretVolumeSource(secret_name=cm)}
+        elif tm == 'emptydir':
+            expand = {"empty_dir": kube.client.V1EmptyDirVolumeSource()}
+        elif tm == 'pvc':
+            expand = {"persistent_volume_claim":
+                      kube.client.V1PersistentVolumeClaimVolumeSource(claim_name=cm)}
+        elif tm == 'hostpath':
+            expand = {"host_path": kube.client.V1HostPathVolumeSource(
+                path=cm, type='DirectoryOrCreate')}
+            cm = re.sub('[^a-z0-9]+', '-', cm.lower()).strip('-')
+        else:
+            expand = {"config_map": kube.client.V1ConfigMapVolumeSource(name=cm)}
 
-            volume = client.V1Volume(
-                name=f'volume-{cm}',
-                **expand
-            )
-            volume_mount = client.V1VolumeMount(
-                mount_path=vm,
-                name=f'volume-{cm}',
-                read_only=self.kwargs["read_only"] if
-                "read_only" in self.kwargs else None
-            )
-            l_volume.append(volume), l_volumemount.append(volume_mount)
+        volume = kube.client.V1Volume(
+            name=f'volume-{cm}',
+            **expand
+        )
+        volume_mount = kube.client.V1VolumeMount(
+            mount_path=vm,
+            name=f'volume-{cm}',
+            read_only=self.kwargs["read_only"] if "read_only" in self.kwargs
+            and tm not in ('emptydir', 'pvc', 'hostpath') else None
+        )
+        return volume, volume_mount
 
-        return l_volume, l_volumemount
+    def _create_init_containers(self, volume_mount, init_containers=None):
+        """
+        Create init containers, mounting job volumes by mount path
+        """
+        if init_containers is None:
+            init_containers = self.kwargs["init_containers"] if "init_containers" \
+                in self.kwargs else None
+        if not init_containers:
+            return None
+
+        l_container = []
+        for init in init_containers:
+            env = init["env"] if "env" in init else None
+            args = init["args"] if "args" in init else None
+            l_container.append(kube.client.V1Container(
+                name=init["name"],
+                image=init["image"],
+                command=init["cmd"] if isinstance(init["cmd"], list) else [init["cmd"]],
+                args=[args] if isinstance(args, str) else args,
+                volume_mounts=[vm for vm in volume_mount or []
+                               if vm.mount_path in init["mount_path"]]
+                if "mount_path" in init else None,
+                env=[kube.client.V1EnvVar(name=k, value=v) for k, v in env.items()]
+                if env is not None else None
+            ))
+        return l_container
 
     def _create_affinity(self):
         """
@@ -124,15 +198,15 @@ class Job:
         self.pool_name = self.kwargs["pool_name"] if "pool_name" in self.kwargs else None
         if self.pool_name is not None:
             #operator = 'In' if self.gpu_node else 'NotIn'
-            nodeselector_requirement = client.V1NodeSelectorRequirement(
+            nodeselector_requirement = kube.client.V1NodeSelectorRequirement(
                 key='k8s.scaleway.com/pool-name', values=[self.pool_name], operator='In')
-            nodeselector_terms = client.V1NodeSelectorTerm(
+            nodeselector_terms = kube.client.V1NodeSelectorTerm(
                 match_expressions=[nodeselector_requirement])
-            nodeselector = client.V1NodeSelector(
+            nodeselector = kube.client.V1NodeSelector(
                 node_selector_terms=[nodeselector_terms])
-            nodeaffinity = client.V1NodeAffinity(
+            nodeaffinity = kube.client.V1NodeAffinity(
                 required_during_scheduling_ignored_during_execution=nodeselector)
-            affinity = client.V1Affinity(node_affinity=nodeaffinity)
+            affinity = kube.client.V1Affinity(node_affinity=nodeaffinity)
             return affinity
 
     def _create_job_object(self):
@@ -154,11 +228,14 @@ class Job:
         # Mount volume
         volume, volume_mount = self._create_volumes()
 
+        # Init containers
+        init_containers = self._create_init_containers(volume_mount)
+
         # Affinity
         affinity = self._create_affinity()
 
         # Configureate Pod template container
-        container = client.V1Container(
+        container = kube.client.V1Container(
             name=self.job_name,
             image=self.image,
             command=self.cmd if isinstance(self.cmd, list) else [self.cmd],
@@ -167,29 +244,32 @@ class Job:
             env=env
         )
 
+        labels = self.kwargs["labels"] if "labels" in self.kwargs else {}
+
         # Create and configure a spec section
-        template = client.V1PodTemplateSpec(
-            metadata=client.V1ObjectMeta(labels={"app": self.job_name}),
-            spec=client.V1PodSpec(
+        template = kube.client.V1PodTemplateSpec(
+            metadata=kube.client.V1ObjectMeta(labels={"app": self.job_name, **labels}),
+            spec=kube.client.V1PodSpec(
                 restart_policy="Never",
                 containers=[container],
+                init_containers=init_containers,
                 volumes=volume,
                 affinity=affinity
             )
         )
 
         # Create the specification of deployment
-        spec = client.V1JobSpec(
+        spec = kube.client.V1JobSpec(
             template=template,
             backoff_limit=self.kwargs["retry"] if "retry" in self.kwargs else 1,
             ttl_seconds_after_finished=self.kwargs["ttl_deletion"]
             if "ttl_deletion" in self.kwargs else None)
 
         # Instantiate the job object
-        job = client.V1Job(
+        job = kube.client.V1Job(
             api_version="batch/v1",
             kind="Job",
-            metadata=client.V1ObjectMeta(name=self.job_name),
+            metadata=kube.client.V1ObjectMeta(name=self.job_name, labels=labels or None),
             spec=spec
         )
         return job
@@ -199,10 +279,12 @@ class Job:
         Start kubernetes job. It's possible before to see template with `job` attribute
         """
         try:
-            api_response = self.api_instance.create_namespaced_job(
-                body=self.job,
-                namespace=self.namespace)
-        except client.rest.ApiException as f:
+            with metrics.timed('job_submit'):
+                api_response = self.api_instance.create_namespaced_job(
+                    body=self.job,
+                    namespace=self.namespace)
+        except kube.client.rest.ApiException as f:
+            metrics.error('kube', 'create_job')
             return json.loads(f.body)
         return api_response.status
 
@@ -214,7 +296,9 @@ class Job:
             api_response = self.api_instance.read_namespaced_job_status(
                 name=self.job_name,
                 namespace=self.namespace)
-        except client.rest.ApiException as f:
+        except kube.client.rest.ApiException as f:
+            if f.status != 404:
+                metrics.error('kube', 'read_job')
             return json.loads(f.body)
         info = api_response.status.to_dict()
         info["name"] = self.job_name
@@ -227,10 +311,110 @@ class Job:
         try:
             api_response = self.api_instance.delete_namespaced_job(
                 name=self.job_name, namespace=self.namespace,
-                body=client.V1DeleteOptions(
+                body=kube.client.V1DeleteOptions(
                     propagation_policy='Foreground',
                     grace_period_seconds=self.kwargs["grace_period"]
                     if "grace_period" in self.kwargs else 5))
-        except client.rest.ApiException as f:
+        except kube.client.rest.ApiException as f:
+            metrics.error('kube', 'delete_job')
             return json.loads(f.body)
         return api_response.status
+
+
+class JobTemplate(Job):
+    def __init__(self,
+                 image,
+                 cmd=None,
+                 namespace="default",
+                 args=None,
+                 config=None,
+                 mount_path=None,
+                 **kwargs):
+        """
+        Job object built once from the same parameters as `Job` and cloned for
+        each job, substituting only name, env, volumes and init containers.
+        Unchanged parts (affinity, command, shared volumes, ...) are shared by
+        the clones, so they must not be modified in place.
+
+        Usage example:
+            template = JobTemplate(image='busybox', cmd='sh', args=['-c', 'ls /input'],
+                                   config=['input', 'licence'],
+                                   mount_path=['/input', '/licence'],
+                                   type_volume=['emptydir', 'secret'],
+                                   pool_name='pool-gpu-3070-s')
+            job = template.render('name', env={'BUCKET_NAME': 'name'},
+                                  volumes={'/input': (['name'], 'configmap')})
+            job.start_job()
+
+        Parameters
+        ----------
+        Same as `Job`, without name
+        """
+        super().__init__('template', image=image, cmd=cmd, namespace=namespace,
+                         args=args, config=config, mount_path=mount_path, **kwargs)
+
+    def render(self, name, env=None, volumes=None, init_containers=None,
+               completions=None, parallelism=None):
+        """
+        Clone the template into a job ready to be started
+
+        Parameters
+        ----------
+        name: str, name of job
+        env: dict, env vars added to (or replacing) template env vars
+        volumes: dict, mount path of a template volume: (config, type_volume)
+                 replacing it
+        init_containers: list of dict, replace init containers of template
+        completions: int, run an Indexed Job of `completions` pods, each one
+                     gets its index in env var `JOB_COMPLETION_INDEX` and
+                     the retries of the template, a failed index does not
+                     stop the others
+        parallelism: int, number of pods of an Indexed Job running at the same time
+
+        Returns
+        -------
+        Job: job with its `job` object set
+        """
+        job = copy.copy(self.job)
+        job.metadata = kube.client.V1ObjectMeta(name=name, labels=self.job.metadata.labels)
+        spec = job.spec = copy.copy(self.job.spec)
+        template = spec.template = copy.copy(spec.template)
+        template.metadata = kube.client.V1ObjectMeta(
+            labels={**template.metadata.labels, "app": name})
+        pod = template.spec = copy.copy(template.spec)
+        container = copy.copy(pod.containers[0])
+        container.name = name
+        pod.containers = [container]
+
+        if env:
+            base = self.kwargs["env"] if "env" in self.kwargs else {}
+            container.env = self._add_env_vars({**base, **env})
+
+        if volumes:
+            pod.volumes = list(pod.volumes)
+            container.volume_mounts = list(container.volume_mounts)
+            for path, (config, type_volume) in volumes.items():
+                i = self.mount_path.index(path)
+                pod.volumes[i], container.volume_mounts[i] = self._create_volume(
+                    config, path, type_volume)
+            if init_containers is None and pod.init_containers:
+                # Init containers mount volumes by name
+                pod.init_containers = self._create_init_containers(
+                    container.volume_mounts)
+
+        if init_containers is not None:
+            pod.init_containers = self._create_init_containers(
+                container.volume_mounts, init_containers) or None
+
+        if completions is not None:
+            spec.completion_mode = "Indexed"
+            spec.completions = completions
+            spec.parallelism = parallelism if parallelism is not None else completions
+            # Retries are counted per index (kubernetes >= 1.28), older
+            # clusters fall back to the global limit scaled by completions
+            spec.backoff_limit_per_index = self.job.spec.backoff_limit
+            spec.backoff_limit = self.job.spec.backoff_limit * completions
+
+        rendered = Job(name=name, namespace=self.namespace, **self.kwargs)
+        rendered.job = job
+        return rendered
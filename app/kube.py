@@ -0,0 +1,62 @@
+import os
+import sys
+import logging
+import importlib
+import threading
+
+logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+logger = logging.getLogger('kube')
+
+_lock = threading.Lock()
+_clients = {}
+
+
+def __getattr__(name):
+    """
+    `kube.client`, `kube.config` and `kube.watch` are the kubernetes modules,
+    imported on first use: importing them takes longer than the rest of the
+    app startup
+    """
+    if name in ('client', 'config', 'watch'):
+        return importlib.import_module(f'kubernetes.{name}')
+    raise AttributeError(f"module 'kube' has no attribute {name!r}")
+
+
+def api_client():
+    """
+    Process-wide kubernetes ApiClient, created on first call.
+    In-cluster config is used when running in a pod, else the kubeconfig.
+    Its connection pool is shared by all api instances, sized with
+    env `KUBE_POOL_MAXSIZE` (default 32)
+    """
+    with _lock:
+        if "api" not in _clients:
+            from kubernetes import client, config
+            configuration = client.Configuration()
+            try:
+                config.load_incluster_config(client_configuration=configuration)
+                logger.info('In-cluster kubernetes config loaded')
+            except config.ConfigException:
+                config.load_kube_config(client_configuration=configuration)
+                logger.info('Kubeconfig loaded')
+            configuration.connection_pool_maxsize = int(
+                os.getenv('KUBE_POOL_MAXSIZE', 32))
+            _clients["api"] = client.ApiClient(configuration)
+        return _clients["api"]
+
+
+def _api(kind):
+    from kubernetes import client
+    shared = api_client()
+    with _lock:
+        if kind not in _clients:
+            _clients[kind] = getattr(client, kind)(shared)
+        return _clients[kind]
+
+
+def batch_api():
+    return _api('BatchV1Api')
+
+
+def core_api():
+    return _api('CoreV1Api')
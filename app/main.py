@@ -1,22 +1,41 @@
-from typing import Optional
+import time
+# Startup is measured from here, imports are most of it
+START = time.perf_counter()
+
+from typing import List, Optional, Tuple
+import asyncio
+import functools
 import pathlib
 import hashlib
+import json
 import sys
 import os
-import shutil
-import subprocess
+import logging
+import threading
 
 sys.path.insert(0, "/backend/app")
 
-from job import Job
-from configmap import ConfigMapSecrets
-from pyproj import Proj, transform
-from prepare_data import utils
-from prepare_data.main import main
-from fastapi import FastAPI
-from kubernetes import config
+from job import Job, JobTemplate
+from configmap import ConfigMapSecrets, MAX_BYTES
+from fastapi import FastAPI, Request, Response
+from fastapi.responses import StreamingResponse
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+from pydantic import BaseModel
 
 from s3 import S3
+import kube
+from informer import JobInformer, MANAGED_BY
+from worker import PrepareQueue
+from singleflight import SingleFlight
+from backends import Backend
+from catalog import Catalog, dir_size
+from artifacts import ArtifactStore
+from collector import Collector, valid_name
+from progress import Progress, MARKER, job_stage
+from scheduler import PoolScheduler, POOL_LABEL, INTERACTIVE, BATCH
+import tiles
+import projection
+import metrics
 
 description = """
 Backend to serve [prepare_data](https://github.com/twin-city/prepare-data)
@@ -46,146 +65,1095 @@ app = FastAPI(
     },
 )
 
+# Prepared data of jobs, kept in the artifact store. Job directories not
+# used for `JOBS_TTL` seconds are removed and materialized again when used
+JOBS_PATH = os.getenv('JOBS_PATH', '/data/jobs')
+JOBS_TTL = float(os.getenv('JOBS_TTL', 3600))
+ARTIFACTS_JANITOR_INTERVAL = float(os.getenv('ARTIFACTS_JANITOR_INTERVAL', 300))
+
+# Prepared data is handed to unity jobs by configmap, or by object storage
+# (`s3`) for large inputs when mode is `auto`
+JOB_INPUT_MODE = os.getenv('JOB_INPUT_MODE', 'auto')
+JOB_INPUT_BUCKET = os.getenv('JOB_INPUT_BUCKET', 'twincity-job-inputs')
+JOB_INPUT_IMAGE = os.getenv('JOB_INPUT_IMAGE', 'amazon/aws-cli')
+
+# Unity build environment of jobs: `cold` installs tools and clones the
+# project in each job, `warm` uses a prebuilt image and reuses checkouts and
+# Unity Library of a cache volume, a persistent volume claim or a directory
+# of the node if `UNITY_CACHE_HOSTPATH` is set. No warm image is built
+# here: `UNITY_WARM_IMAGE` must name one with the tools of the cold profile
+# installed, the warm profile is refused while it is unset
+PROFILES = ('cold', 'warm')
+UNITY_PROFILE = os.getenv('UNITY_PROFILE', 'cold')
+UNITY_WARM_IMAGE = os.getenv('UNITY_WARM_IMAGE')
+UNITY_CACHE_CLAIM = os.getenv('UNITY_CACHE_CLAIM', 'unity-cache')
+UNITY_CACHE_HOSTPATH = os.getenv('UNITY_CACHE_HOSTPATH')
+# Checkouts of the cache, each one is used by one build at a time
+UNITY_CACHE_SLOTS = int(os.getenv('UNITY_CACHE_SLOTS', 4))
+
 s3 = S3()
+prepare_queue = PrepareQueue()
+launches = SingleFlight()
+informer = JobInformer(namespace="twincity")
+# Blocking calls are offloaded to one executor per backend, sized with env
+# `KUBE_CONCURRENCY`, `S3_CONCURRENCY` and `DISK_CONCURRENCY`
+kube_backend = Backend('kube', default=32)
+s3_backend = Backend('s3', default=16)
+disk_backend = Backend('disk', default=4)
+# Unity jobs are admitted on the GPU pool by the scheduler, see env
+# `{GPU_POOL}_MAX_JOBS` and `{GPU_POOL}_JOB_SECONDS`
+GPU_POOL = os.getenv('GPU_POOL', 'pool-gpu-3070-s')
+scheduler = PoolScheduler(GPU_POOL, informer, executor=kube_backend.executor)
+BATCH_MAX_ITEMS = int(os.getenv('BATCH_MAX_ITEMS', 500))
+# Pods of an Indexed Job of a batch running at the same time
+INDEXED_PARALLELISM = int(os.getenv('INDEXED_PARALLELISM', 4))
+catalog = Catalog()
+store = ArtifactStore()
+# Orphan and expired resources of jobs are collected every `GC_INTERVAL`
+# seconds, see env `GC_JOB_TTL`, `GC_TILE_TTL`, `GC_TEMP_TTL`, `GC_GRACE` and
+# `GC_RATE`
+GC_INTERVAL = float(os.getenv('GC_INTERVAL', 3600))
+collector = Collector("twincity", JOBS_PATH, catalog, store=store, s3=s3,
+                      input_bucket=JOB_INPUT_BUCKET, tiles_path=tiles.TILES_PATH,
+                      preparing=prepare_queue.names)
+# Stages of jobs streamed to clients by `/events/{job_name}`
+progress = Progress()
+
+logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+logger = logging.getLogger('main')
+
+# Tasks running in background, referenced until done
+_background = set()
+
+# Jobs not found on API server are not read again for `STATUS_MISSING_TTL`
+# seconds, see `_unwatched_status`
+STATUS_MISSING_TTL = float(os.getenv('STATUS_MISSING_TTL', 10))
+_missing = {}
+_missing_lock = threading.Lock()
+
+metrics.IN_FLIGHT.labels('prepare_queued').set_function(
+    lambda: prepare_queue.stats()["queued"])
+metrics.IN_FLIGHT.labels('prepare_running').set_function(
+    lambda: prepare_queue.stats()["running"])
+metrics.IN_FLIGHT.labels('unity_queued').set_function(
+    lambda: scheduler.stats()["queued"])
+metrics.IN_FLIGHT.labels('unity_running').set_function(
+    lambda: scheduler.stats()["running"])
+for _backend in (kube_backend, s3_backend, disk_backend):
+    metrics.IN_FLIGHT.labels(f'{_backend.name}_calls').set_function(
+        functools.partial(lambda b: b.in_flight, _backend))
+
+
+def _completed_indexes(indexes):
+    """
+    Completion indexes of an Indexed Job from their ranges, as '0-2,4'
+    """
+    completed = set()
+    for part in (indexes or '').split(','):
+        if part:
+            start, _, end = part.partition('-')
+            completed.update(range(int(start), int(end or start) + 1))
+    return completed
+
+
+def _observe_job(name, info):
+    """
+    Count finished unity jobs, observe their run time and record their end
+    in catalog. The districts of an Indexed Job are finished if their index
+    completed
+    """
+    if info is None or info["labels"].get(POOL_LABEL) is None:
+        return
+    for condition in info.get("conditions") or []:
+        if condition["type"] not in ('Complete', 'Failed') or condition["status"] != 'True':
+            continue
+        complete = condition["type"] == 'Complete'
+        metrics.JOBS.labels(condition["type"].lower()).inc()
+        run_seconds = None
+        if info.get("start_time") and info.get("completion_time"):
+            run_seconds = (info["completion_time"] - info["start_time"]).total_seconds()
+            metrics.observe('job_run', run_seconds, 'ok' if complete else 'error')
+        districts = (info.get("env") or {}).get("BUCKET_NAMES", '').split()
+        if districts:
+            completed = _completed_indexes(info.get("completed_indexes"))
+            ends = [(d, 'FINISHED' if i in completed else 'FAILED')
+                    for i, d in enumerate(districts)]
+        else:
+            ends = [(name, 'FINISHED' if complete else 'FAILED')]
+        for district, state in ends:
+            entry = catalog.get(district)
+            # Jobs listed again by the informer are already recorded
+            if entry is None or entry["state"] == state:
+                continue
+            catalog.update(district, state=state, run_seconds=run_seconds,
+                           error=_failure_reason(info) if state == 'FAILED' else None)
+        return
+
+
+informer.add_listener(_observe_job)
+
+
+def _job_progress(name, info):
+    """
+    Publish stages of unity jobs, and follow the log of running jobs
+    watched by a client for the stages of the build
+    """
+    if info is None or info["labels"].get(POOL_LABEL) is None:
+        return
+    stage = job_stage(info)
+    if stage == 'failed':
+        progress.publish(name, stage, reason=_failure_reason(info))
+    else:
+        progress.publish(name, stage)
+    if stage == 'running' and progress.watched(name):
+        progress.tail(name, namespace="twincity")
+
+
+informer.add_listener(_job_progress)
+
+
+@app.middleware("http")
+async def time_request(request: Request, call_next):
+    """
+    Observe requests and log their duration with the stages they went through
+    """
+    token = metrics.start_request()
+    start = time.perf_counter()
+    code = 500
+    try:
+        response = await call_next(request)
+        code = response.status_code
+        return response
+    finally:
+        route = request.scope.get("route")
+        metrics.end_request(token, route.path if route is not None else 'unmatched',
+                            request.method, code, time.perf_counter() - start)
+
+
+@app.get('/metrics')
+async def prometheus_metrics():
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
+def _spawn(coroutine):
+    task = asyncio.create_task(coroutine)
+    _background.add(task)
+    task.add_done_callback(_background.discard)
+    return task
+
+
+async def _startup_task(backend, fn):
+    """
+    Run a slow startup task in background and observe its duration
+    """
+    start = time.perf_counter()
+    await backend.run(fn)
+    metrics.observe(f'startup_{fn.__name__}', time.perf_counter() - start)
+
+
+@app.on_event("startup")
+def start_workers():
+    prepare_queue.start()
+
+
+def load_kube_config():
+    try:
+        kube.api_client()
+    except Exception as f:
+        logger.warning(f"Kubernetes config not loaded: {f}")
+
+
+def sync_catalog():
+    try:
+        logger.info(f"{catalog.sync(JOBS_PATH)} prepared jobs added to catalog")
+    except Exception as f:
+        logger.warning(f"Catalog not synchronized: {f}")
+
+
+def warm_up_bucket_cache():
+    try:
+        logger.info(f"{s3.warm_up()} buckets cached")
+    except Exception as f:
+        logger.warning(f"Bucket cache not warmed up: {f}")
+
+
+def create_input_bucket():
+    """
+    Bucket of job inputs, created if missing unless inputs are configmaps
+    """
+    if JOB_INPUT_MODE == 'configmap':
+        return
+    try:
+        if not s3.check_buckets([JOB_INPUT_BUCKET])[JOB_INPUT_BUCKET]:
+            s3.create_bucket(JOB_INPUT_BUCKET)
+    except Exception as f:
+        logger.warning(f"Input bucket {JOB_INPUT_BUCKET} not checked: {f}")
+
+
+@app.on_event("startup")
+async def start_background_tasks():
+    """
+    Clients are created and caches filled in background, requests are
+    served meanwhile
+    """
+    _spawn(_startup_task(kube_backend, load_kube_config))
+    _spawn(_startup_task(disk_backend, sync_catalog))
+    _spawn(_startup_task(s3_backend, warm_up_bucket_cache))
+    _spawn(_startup_task(s3_backend, create_input_bucket))
+
+
+@app.on_event("startup")
+def start_informer():
+    informer.start()
+
+
+def _jobs_in_use():
+    """
+    Jobs being launched or on the GPU pool, their directories are kept
+    """
+    return launches.keys() | scheduler.names()
+
+
+@app.on_event("startup")
+def start_janitor():
+    store.start_janitor(ARTIFACTS_JANITOR_INTERVAL, directory=JOBS_PATH, ttl=JOBS_TTL,
+                        in_use=_jobs_in_use)
+
+
+@app.on_event("startup")
+def start_collector():
+    collector.start(GC_INTERVAL)
+
+
+@app.on_event("startup")
+def record_startup():
+    """
+    Registered last: the app is ready to serve requests
+    """
+    seconds = time.perf_counter() - START
+    metrics.STARTUP_SECONDS.labels('ready').set(seconds)
+    logger.info(f"Started in {seconds:.3f}s (imports {IMPORT_SECONDS:.3f}s)")
+
+
+@app.on_event("shutdown")
+def stop_janitor():
+    store.stop()
+
+
+@app.on_event("shutdown")
+def stop_collector():
+    collector.stop()
+
+
+@app.on_event("shutdown")
+def stop_workers():
+    prepare_queue.shutdown(wait=False)
+
+
+@app.on_event("shutdown")
+def stop_informer():
+    informer.stop()
+
+
+@app.on_event("shutdown")
+def stop_backends():
+    for backend in (kube_backend, s3_backend, disk_backend):
+        backend.shutdown(wait=False)
+
+
+@app.on_event("shutdown")
+def save_bucket_cache():
+    s3.save_cache()
+
 
 @app.get("/")
-def read_root():
+async def read_root():
     return {"status": "listen"}
 
 
 @app.get('/list')
-def list_job():
-    if pathlib.Path('/data/jobs').is_dir():
-        return os.listdir('/data/jobs')
+async def list_job(offset: int = 0, limit: int = 100, state: Optional[str] = None,
+                   order: str = 'created_at', desc: bool = True):
+    """
+    Paginated list of jobs from catalog, filtered by state
+    """
+    try:
+        total, items = await disk_backend.run(
+            catalog.list, offset=offset, limit=min(limit, 1000), state=state,
+            order=order, desc=desc)
+    except ValueError as f:
+        return {"status": "KO", "reason": str(f), "code": 400}
+    return {"total": total, "offset": offset, "items": items}
+
+
+@app.get('/list/covering')
+async def list_covering(x1: float, y1: float, x2: Optional[float] = None,
+                        y2: Optional[float] = None, crs: Optional[str] = None,
+                        contains: bool = True, limit: int = 100):
+    """
+    Jobs covering a point (x1, y1) or a bbox, or intersecting it if not `contains`
+    """
+    crs = crs if crs is not None else "EPSG:4326"
+    x2, y2 = x2 if x2 is not None else x1, y2 if y2 is not None else y1
+    try:
+        bbox = await disk_backend.run(tiles.canonical_bbox, x1, y1, x2, y2, crs)
+    except Exception as f:
+        return {"status": "KO", "reason": str(f), "code": 400}
+    return await disk_backend.run(catalog.covering, *bbox, contains=contains,
+                                  limit=min(limit, 1000))
+
+
+class DeleteRequest(BaseModel):
+    names: List[str]
 
 
 @app.get('/delete/{job_name}')
-def delete_job(job_name: str):
-    info = {}
-    path = f"/data/jobs/{job_name}"
-    try:
-        job = Job(name=job_name, namespace="twincity")
-        info = job.delete_job()
-    except:
-        info['error_deletion_job'] = True
-    try:
-        cm = ConfigMapSecrets(name=job_name, namespace="twincity", kind="configmap")
-        cm.delete()
-    except:
-        info['error_deletion_cm'] = True
-    try:
-        if pathlib.Path(path).is_dir():
-            shutil.rmtree(path)
-            info["file_delete"] = True
+async def delete_job(job_name: str):
+    """
+    Delete a job and its configmaps, prepared data and inputs
+    """
+    if not valid_name(job_name):
+        return {"status": "KO", "reason": "invalid job name", "code": 400}
+    try:
+        report = await kube_backend.run(collector.delete, [job_name])
     except Exception as f:
-        info['error_deletion_files'] = True
-    return info
+        return {"status": "KO", "reason": str(f), "code": 500}
+    return {"job_name": job_name,
+            "deleted": sorted(report["deleted"]),
+            "errors": report["errors"],
+            "code": 500 if report["errors"] else 200}
+
+
+@app.post('/delete')
+async def delete_jobs(request: DeleteRequest):
+    """
+    Delete many jobs at once, their resources are deleted concurrently
+    """
+    if len(request.names) > BATCH_MAX_ITEMS:
+        return {"status": "KO", "reason": f"at most {BATCH_MAX_ITEMS} jobs",
+                "code": 400}
+    invalid = [n for n in request.names if not valid_name(n)]
+    if invalid:
+        return {"status": "KO", "reason": f"invalid job names: {invalid}", "code": 400}
+    try:
+        report = await kube_backend.run(collector.delete, request.names)
+    except Exception as f:
+        return {"status": "KO", "reason": str(f), "code": 500}
+    return {**report, "code": 500 if report["errors"] else 200}
+
+
+@app.post('/gc')
+async def garbage_collect(dry_run: bool = False):
+    """
+    Delete orphan and expired resources of jobs now, with `dry_run` only
+    list them
+    """
+    try:
+        report = await kube_backend.run(collector.collect, dry_run)
+    except Exception as f:
+        return {"status": "KO", "reason": str(f), "code": 500}
+    if report is None:
+        return {"status": "KO", "reason": "garbage collection already running",
+                "code": 409}
+    return {**report, "code": 200}
+
+
+@app.get('/gc')
+async def garbage_collector_stats():
+    return collector.stats()
 
 
 @app.get('/status/{job_name}')
-def status_job(job_name: str):
-    try:
-        job = Job(name=job_name, namespace="twincity")
-        info = job.get_job_status()
-        if 'suceeded' in info:
-            if info["suceeded"] == 1:
-                return {'status': 'FINISHED',
-                       "code": 200,
-                       "url": f"https://{job_name}.s3-website.fr-par.scw.cloud",
-                       "job_name": job_name}
-            elif info["suceeded"] is None:
-                return {"code": 202,
-                        "status" : "WAITING",
-                        "url": f"https://{job_name}.s3-website.fr-par.scw.cloud",
-                       "job_name": job_name}
+async def status_job(job_name: str, wait: int = 0, version: int = 0):
+    """
+    Status of a job. With `wait` seconds, long poll until status changes
+    from `version` (returned by previous call)
+    """
+    try:
+        if informer.synced.is_set() and wait > 0:
+            info, version = await informer.async_wait(job_name, version, min(wait, 60))
+            if info is None:
+                info = await kube_backend.run(_unwatched_status, job_name)
+        else:
+            info, version = await kube_backend.run(job_status, job_name)
+        response = _status_response(job_name, info)
+        if response is None:
+            response = await disk_backend.run(_missing_response, job_name)
+        response["version"] = version
+        return response
     except Exception as f:
         return {'reason': f, 'code': 500}
 
 
+def job_status(name):
+    """
+    Get job status from the informer cache once synced, else from API server.
+    Return (status, version)
+    """
+    if informer.synced.is_set():
+        info, version = informer.get(name)
+        if info is not None:
+            return info, version
+        return _unwatched_status(name), version
+    return _read_job_status(name), None
+
+
+def _unwatched_status(name):
+    """
+    Status of a job missing from informer cache. Jobs created before they
+    were labelled are not watched: jobs launched, or prepared and unknown
+    jobs which may be legacy, are read from API server unless they were not
+    found recently. The catalog state of the others is their status
+    """
+    entry = catalog.get(name)
+    if entry is not None and entry["state"] not in ('LAUNCHED', 'PREPARED'):
+        return {}
+    now = time.time()
+    with _missing_lock:
+        if now - _missing.get(name, 0) < STATUS_MISSING_TTL:
+            return {}
+    info = _read_job_status(name)
+    if info.get("kind") == "Status" and info.get("code") == 404:
+        with _missing_lock:
+            if len(_missing) >= 10000:
+                for key in [k for k, t in _missing.items() if now - t >= STATUS_MISSING_TTL]:
+                    del _missing[key]
+            _missing[name] = now
+    return info
+
+
+def _read_job_status(name):
+    job = Job(name=name, namespace="twincity")
+    return job.get_job_status()
+
+
+def _failure_reason(info):
+    for condition in info.get("conditions") or []:
+        if condition["type"] == 'Failed' and condition["status"] == 'True':
+            return condition.get("message") or condition.get("reason")
+    return None
+
+
+def _status_response(name, info):
+    """
+    Response of an existing job from its status, None if it does not exist
+    """
+    stage = job_stage(info)
+    if stage is None:
+        return None
+    response = {"job_name": name,
+                "url": f"https://{name}.s3-website.fr-par.scw.cloud"}
+    if stage == 'done':
+        return {'status': 'FINISHED', "code": 200, **response}
+    if stage == 'failed':
+        return {'status': 'FAILED', "code": 500, "reason": _failure_reason(info),
+                **response}
+    if stage == 'running':
+        return {'status': 'RUNNING', "code": 202, **response}
+    return {'status': 'WAITING', "code": 202, **response}
+
+
+def _missing_response(name):
+    """
+    Response of a job without kubernetes job, from its catalog state
+    """
+    entry = catalog.get(name)
+    if entry is None:
+        return {"status": "NOT_FOUND", "code": 404, "job_name": name}
+    return {"status": entry["state"], "code": 200, "job_name": name,
+            "url": entry["url"], "reason": entry["error"]}
+
+
+# Stage of a job without kubernetes job, from its catalog state
+CATALOG_STAGES = {'QUEUED': 'queued', 'PREPARING': 'preparing', 'PREPARED': 'prepared',
+                  'LAUNCHED': 'pending', 'FINISHED': 'done', 'FAILED': 'failed'}
+
+
+@app.get('/events/{job_name}')
+async def job_events(job_name: str, request: Request, timeout: int = 3600):
+    """
+    Server-sent events of the stages of a job: queued, preparing, prepared,
+    scheduled, configmap, pending, running, building, uploading then done or
+    failed. Events of the current run are sent first, the stream ends once
+    the job is done or failed. Reconnecting clients get the events after
+    their `Last-Event-ID`
+    """
+    try:
+        since = int(request.headers.get('last-event-id') or 0)
+    except ValueError:
+        since = 0
+    if progress.stage(job_name) is None:
+        # Not followed since the backend started
+        info, _ = await kube_backend.run(job_status, job_name)
+        stage = job_stage(info)
+        if stage is None:
+            entry = await disk_backend.run(catalog.get, job_name)
+            stage = CATALOG_STAGES.get(entry["state"]) if entry is not None else None
+        if stage is None:
+            return {"status": "NOT_FOUND", "code": 404, "job_name": job_name}
+        progress.publish(job_name, stage)
+    if progress.stage(job_name) == 'running':
+        progress.tail(job_name, namespace="twincity")
+
+    async def _events():
+        async for event in progress.stream(job_name, since, min(timeout, 3600)):
+            if await request.is_disconnected():
+                break
+            if event is None:
+                yield ': keepalive\n\n'
+            else:
+                yield f'id: {event["id"]}\nevent: {event["stage"]}\n' \
+                      f'data: {json.dumps(event)}\n\n'
+
+    return StreamingResponse(_events(), media_type='text/event-stream',
+                             headers={"Cache-Control": "no-cache",
+                                      "X-Accel-Buffering": "no"})
+
+
+class BBox(BaseModel):
+    x1: float
+    y1: float
+    x2: float
+    y2: float
+    crs: Optional[str] = None
+
+
+class BatchRequest(BaseModel):
+    bboxes: List[BBox] = []
+    # Polygon (list of x, y points) to cover with tiles of the LAMBERT grid
+    polygon: Optional[List[Tuple[float, float]]] = None
+    crs: Optional[str] = None
+    job: bool = False
+    tiled: bool = False
+    # Launch one Indexed Job for all districts instead of one job each
+    indexed: bool = False
+    profile: Optional[str] = None
+
+
+def _job_names(items, tiled=False):
+    """
+    Names of many (x1, y1, x2, y2, crs) bboxes, validated and converted with
+    one transformation per CRS. Return (names, errors), a name is None and
+    its error set for an invalid bbox
+    """
+    errors = projection.validate_bboxes(items)
+    valid = [i for i, error in enumerate(errors) if error is None]
+    names = [None] * len(items)
+    if tiled:
+        converted = projection.to_lambert_bboxes([items[i] for i in valid])
+        for i, bbox in zip(valid, converted):
+            names[i] = tiles.bbox_name(tiles.snap(
+                tiles.canonical_bbox(*bbox, projection.LAMBERT)))
+    else:
+        for i in valid:
+            names[i] = _job_name(*items[i])
+    return names, errors
+
+
+def _job_name(x1, y1, x2, y2, crs, tiled=False):
+    if tiled:
+        # Canonical name of the bbox snapped on the LAMBERT tile grid
+        return tiles.bbox_name(tiles.snap(
+            tiles.canonical_bbox(x1, y1, x2, y2, crs)))
+    return hashlib.sha1(f'job-{y1}-{x1}-{y2}-{x2}'.encode()).hexdigest()
+
+
+def _profile_error(profile):
+    """
+    Reason why jobs can't be built with `profile`, None if they can
+    """
+    if profile not in PROFILES:
+        return f"profile must be one of {PROFILES}"
+    if profile == 'warm' and not UNITY_WARM_IMAGE:
+        return "UNITY_WARM_IMAGE must be set for the warm profile"
+    return None
+
+
 @app.get("/generate/")
-def generate(x1: float, y1: float, x2: float, y2: float, job: bool = False,
-             crs: Optional[str] = None):
-    # Convert to LAMBERT if needed
-    name = hashlib.sha1(f'job-{y1}-{x1}-{y2}-{x2}'.encode()).hexdigest()
+async def generate(x1: float, y1: float, x2: float, y2: float, job: bool = False,
+                   crs: Optional[str] = None, tiled: bool = False,
+                   profile: str = UNITY_PROFILE):
+    crs = crs if crs is not None else "EPSG:4326"
+    reason = _profile_error(profile)
+    if reason is not None:
+        return {"status": "KO", "reason": reason, "code": 400}
+    try:
+        # Bad inputs are rejected before any preparation, transformations
+        # are run off the event loop
+        await disk_backend.run(projection.validate, [x1, x2], [y1, y2], crs)
+        with metrics.timed('hash'):
+            name = await disk_backend.run(_job_name, x1, y1, x2, y2, crs, tiled)
+    except Exception as f:
+        return {"status": "KO", "reason": str(f), "code": 400}
+    return await _generate(name, x1, y1, x2, y2, job, crs, tiled, profile=profile)
+
+
+async def _generate(name, x1, y1, x2, y2, job, crs, tiled, exists=None,
+                    priority=INTERACTIVE, profile=UNITY_PROFILE):
+    """
+    Prepare data and launch job of a bbox named `name`. `exists` is the
+    existence of its bucket when already known, `priority` the priority of
+    the job on the GPU pool and `profile` its unity build environment
+    """
     # Test if a job with the same coordinates inputs had been already saved.
-    if s3.check_bucket(name):
+    if exists is None:
+        with metrics.timed('s3_check_bucket'):
+            exists = await s3_backend.run(s3.check_bucket, name)
+    if exists:
+        await disk_backend.run(catalog.update, name, state='FINISHED')
         return {'status': 'FINISHED',
                 "url": f"https://{name}.s3-website.fr-par.scw.cloud",
                 "code": 200}
-    """
-    if not pathlib.Path(f"/data/jobs/{name}").exists():
-        if crs:
-            inProj = Proj('+init='+crs, preserve_units=True)
-            outProj = Proj("+init=EPSG:2154")  # LAMBERT
-            x1, y1 = transform(inProj, outProj, y1, x1)
-            x2, y2 = transform(inProj, outProj, y2, x2)
-        # Convert to shapely polygon
-        try:
-            polygon = utils.convert2poly(x1, y1, x2, y2)
-            main(polygon, pathlib.Path(f'/data/jobs/{name}'))
-        except Exception as f:
-            return {"status": "KO", "reason": f}
-    """
-    if not pathlib.Path(f"/data/jobs/{name}").exists():
-        crs = crs if crs is not None else "EPSG:4326"
-        try:
-            subprocess.run(["python", "-m", "prepare_data.main",
-                            f"{x1}", f"{y1}", f"{x2}", f"{y2}",
-                            "--CRS", crs, "--path-to-save", f"/data/jobs/{name}"],
-                        shell=False)
-        except Exception as f:
-            return {"status": "KO", "reason": f, "code": 500}
+    prepared = pathlib.Path(f"{JOBS_PATH}/{name}").exists() or \
+        await disk_backend.run(store.materialize, name, f"{JOBS_PATH}/{name}")
+    metrics.cache('prepared', prepared)
+    if prepared:
+        await disk_backend.run(store.touch, name)
+    if not prepared:
+        await disk_backend.run(_catalog_bbox, name, x1, y1, x2, y2, crs)
+        callback = functools.partial(_on_prepared, name, job, priority=priority,
+                                     profile=profile)
+        if tiled:
+            try:
+                submitted = await disk_backend.run(
+                    tiles.prepare_tiled, prepare_queue, name, x1, y1, x2, y2, crs=crs,
+                    path=f"{JOBS_PATH}/{name}", callback=callback,
+                    errback=functools.partial(_on_prepare_failed, name))
+            except Exception as f:
+                await disk_backend.run(_on_prepare_failed, name, {"error": str(f)})
+                return {"status": "KO", "reason": str(f), "code": 500}
+        else:
+            info = prepare_queue.submit(
+                name, x1, y1, x2, y2, crs=crs, path=f"{JOBS_PATH}/{name}",
+                callback=callback)
+            submitted = [info] if info is not None else None
+        if submitted is None:
+            return {"status": "KO", "reason": "prepare queue is full", "code": 503}
+        # Nothing submitted when all tiles were already prepared, they are
+        # composed and recorded, the job is launched below
+        if submitted:
+            response = {"status": "QUEUED",
+                        "code": 202,
+                        "job_name": name,
+                        "job_id": submitted[0]["job_id"],
+                        "job_ids": [i["job_id"] for i in submitted],
+                        "poll_url": f"/prepare/{submitted[0]['job_id']}",
+                        "url": f'https://{name}.s3-website.fr-par.scw.cloud'}
+            if job:
+                # Wait for a GPU once prepared, if submitted now
+                response["estimated_wait"] = scheduler.estimate(priority)
+            return response
 
     # start job
     if job:
-        config.load_kube_config()
-        _ = ConfigMapSecrets(name=name,
-                            kind="configmap",
-                            namespace="twincity",
-                            from_path=f"/data/jobs/{name}")
-        #TODO: check if mounted volumes is availables
-        job_unity = Job(
-            name=name, image="ghcr.io/twin-city/unity-project:os-unix-urp",
-            cmd=["bash"],
-            namespace="twincity",
-            args=["-c",
-                  "git clone -b os/unix-urp https://github.com/twin-city/unity-project \
-                    && cd unity-project \
-                    && apt update && apt install -qy awscli python3-pip \
-                    && pip3 install awscli-plugin-endpoint \
-                    && mkdir /root/.aws \
-                    && cp /config/config /root/.aws/ \
-                    && cp /cred/credentials /root/.aws/ \
-                    && chmod +x Assets/CommandeCLI/Run.sh Assets/CommandeCLI/upload-webgl.sh \
-                    && Assets/CommandeCLI/Run.sh -d /unity-project \
-                    -j /input -l /licence/Unity_v2020_pro2xs.x.ulf -b /output \
-                    && Assets/CommandeCLI/upload-webgl.sh"],
-            env={"BUCKET_NAME": name},
-            config=[name, 'licence', 'aws-cred', 'aws-conf'],
-            mount_path=['/input', '/licence', '/cred', '/config'],
-            type_volume=["configmap", "confimap", "secret", "configmap"],
-            pool_name="pool-gpu-3070-s")
-
-        status = job_unity.get_job_status()
-        if 'suceeded' in status:
-            if status["suceeded"] == 1:
-                return {'status': 'FINISHED',
-                       "code": 200,
-                       "url": f"https://{name}.s3-website.fr-par.scw.cloud",
-                       "job_name": name}
-            elif status["suceeded"] is None:
-                return {"code": 202,
-                        "status" : "WAITING",
-                        "url": f"https://{name}.s3-website.fr-par.scw.cloud",
-                       "job_name": name}
-        try:
-            job_unity.start_job()
-        except Exception as e:
-            return {"status": "KO", "reason": e, "code": 500}
-        return {"status": "LAUNCHED", "code": 201, "job_name": name, "url": f'https://{name}.s3-website.fr-par.scw.cloud'}
+        return await kube_backend.run(launch_job, name, priority, profile)
 
     return {"status": "FINISHED",
             "job_name": name,
             "code": 200,
             "url": f'https://{name}.s3-website.fr-par.scw.cloud',
             "warning": "no job launched"}
+
+
+def _catalog_bbox(name, x1, y1, x2, y2, crs):
+    try:
+        xmin, ymin, xmax, ymax = tiles.canonical_bbox(x1, y1, x2, y2, crs)
+    except Exception:
+        xmin = ymin = xmax = ymax = None
+    catalog.upsert(name, x1=x1, y1=y1, x2=x2, y2=y2, crs=crs, state='QUEUED',
+                   xmin=xmin, ymin=ymin, xmax=xmax, ymax=ymax,
+                   url=f'https://{name}.s3-website.fr-par.scw.cloud')
+
+
+def _on_prepared(name, job, info, priority=INTERACTIVE, profile=UNITY_PROFILE):
+    """
+    Record prepared data in catalog and launch job if requested. Tiles
+    already cached are composed during the request, which launches the job.
+    Called by the prepare queue: storing and launching are handed to the
+    disk and kube backends so that the prepare worker is free
+    """
+    catalog.update(name, state='PREPARED', prepare_seconds=info.get("run_time"))
+    if job and not info.get("cached"):
+        kube_backend.submit(launch_job, name, priority, profile)
+    disk_backend.submit(_store_prepared, name)
+
+
+def _store_prepared(name):
+    """
+    Record sizes of prepared data in catalog and keep it in artifact store
+    """
+    files, size = dir_size(f"{JOBS_PATH}/{name}")
+    catalog.update(name, files=files, size_bytes=size)
+    try:
+        store.put(name, f"{JOBS_PATH}/{name}")
+    except Exception as f:
+        logger.error(f'{name} not stored in artifacts: {f}')
+
+
+def _on_prepare_failed(name, info):
+    """
+    Record a failed preparation of tiles or their composition
+    """
+    catalog.update(name, state='FAILED', error=info["error"])
+    progress.publish(name, 'failed', reason=info["error"])
+
+
+def _on_prepare_state(info):
+    # Tiles are not in catalog, their updates are ignored
+    if info["state"] == "RUNNING":
+        catalog.update(info["name"], state='PREPARING')
+    elif info["state"] == "FAILED":
+        catalog.update(info["name"], state='FAILED', error=info["error"])
+    stages = {"QUEUED": 'queued', "RUNNING": 'preparing', "DONE": 'prepared',
+              "FAILED": 'failed'}
+    details = {"reason": info["error"]} if info["state"] == "FAILED" \
+        else {"job_id": info["job_id"]}
+    progress.publish(info["name"], stages[info["state"]], **details)
+
+
+prepare_queue.add_listener(_on_prepare_state)
+
+
+@app.post("/generate/batch")
+async def generate_batch(request: BatchRequest):
+    """
+    Generate many districts: bboxes and/or tiles covering a polygon.
+    Duplicates are generated once, bucket existence is checked in bulk and
+    preparations/jobs are submitted in parallel. Return status per item
+    """
+    crs = request.crs if request.crs is not None else "EPSG:4326"
+    profile = request.profile if request.profile is not None else UNITY_PROFILE
+    reason = _profile_error(profile)
+    if reason is not None:
+        return {"status": "KO", "reason": reason, "code": 400}
+    items = [(b.x1, b.y1, b.x2, b.y2, b.crs or crs) for b in request.bboxes]
+    if request.polygon is not None:
+        try:
+            await disk_backend.run(projection.validate, [p[0] for p in request.polygon],
+                                   [p[1] for p in request.polygon], crs)
+            covering = await disk_backend.run(tiles.cover_polygon, request.polygon, crs)
+        except Exception as f:
+            return {"status": "KO", "reason": str(f), "code": 400}
+        items += [(*t["bounds"], "EPSG:2154") for t in covering]
+    if len(items) > BATCH_MAX_ITEMS:
+        return {"status": "KO", "code": 413,
+                "reason": f"{len(items)} items, at most {BATCH_MAX_ITEMS} allowed"}
+
+    with metrics.timed('hash'):
+        try:
+            names, errors = await disk_backend.run(_job_names, items, request.tiled)
+        except projection.ProjectionError as f:
+            return {"status": "KO", "reason": str(f), "code": 400}
+    unique = {}
+    for item, name in zip(items, names):
+        if name is not None:
+            unique.setdefault(name, item)
+
+    indexed = request.job and request.indexed
+    with metrics.timed('s3_check_bucket'):
+        exists = await s3_backend.run(s3.check_buckets, list(unique))
+    results = await asyncio.gather(*[
+        _generate(name, *item[:4], request.job and not indexed, item[4],
+                  request.tiled, exists=exists[name], priority=BATCH,
+                  profile=profile)
+        for name, item in unique.items()], return_exceptions=True)
+    results = {name: r if not isinstance(r, Exception)
+               else {"status": "KO", "reason": str(r), "code": 500}
+               for name, r in zip(unique, results)}
+
+    response = []
+    for item, name, error in zip(items, names, errors):
+        result = results[name] if name is not None \
+            else {"status": "KO", "reason": error or "invalid bbox", "code": 400}
+        response.append({"bbox": item[:4], "crs": item[4], **result})
+    batch = {"code": 200, "count": len(response), "unique": len(unique),
+             "items": response}
+    if indexed:
+        batch["indexed"] = _schedule_indexed(results, profile)
+    return batch
+
+
+def _schedule_indexed(results, profile=UNITY_PROFILE):
+    """
+    Launch an Indexed Job for districts of a batch not generated yet, once
+    their preparations are finished
+    """
+    names = [n for n, r in results.items()
+             if r.get("status") == "QUEUED" or "warning" in r]
+    if not names:
+        return None
+    job_ids = [i for n in names for i in results[n].get("job_ids", [])]
+    name = _indexed_name(names)
+    _spawn(_launch_indexed(name, names, job_ids, profile))
+    return {"job_name": name, "count": len(names), "status": "QUEUED"}
+
+
+async def _launch_indexed(name, names, job_ids, profile):
+    futures = [prepare_queue.future(i) for i in job_ids]
+    await asyncio.gather(*[asyncio.wrap_future(f) for f in futures if f is not None])
+    # Tiles are composed before their last future resolves
+    ready = [n for n in names
+             if await disk_backend.run(os.path.exists, f"{JOBS_PATH}/{n}") or
+             await disk_backend.run(store.materialize, n, f"{JOBS_PATH}/{n}")]
+    if len(ready) < len(names):
+        logger.warning(f"{name}: {len(names) - len(ready)} districts not prepared")
+    if ready:
+        slots = min(len(ready), INDEXED_PARALLELISM)
+        result = await kube_backend.run(
+            scheduler.submit, name, functools.partial(launch_indexed_job, ready, name, profile),
+            BATCH, slots)
+        logger.info(f"{name}: {result}")
+
+
+@app.get('/prepare/{job_id}')
+async def prepare_status(job_id: str):
+    info = prepare_queue.get(job_id)
+    if info is None:
+        return {"status": "KO", "reason": "unknown job id", "code": 404}
+    return info
+
+
+@app.get('/queue')
+async def queue_stats():
+    return prepare_queue.stats()
+
+
+@app.get('/cache')
+async def cache_stats():
+    return s3.cache_stats()
+
+
+@app.get('/artifacts')
+async def artifacts_stats():
+    return await disk_backend.run(store.stats)
+
+
+@app.get('/scheduler')
+async def scheduler_stats():
+    return scheduler.stats()
+
+
+@app.get('/backends')
+async def backends_stats():
+    return {b.name: b.stats() for b in (kube_backend, s3_backend, disk_backend)}
+
+
+def launch_job(name, priority=INTERACTIVE, profile=UNITY_PROFILE):
+    """
+    Create configmap from prepared data and start unity job once admitted on
+    the GPU pool. Concurrent launches of the same job share a single creation
+    """
+    store.touch(name)
+    response = scheduler.submit(
+        name, functools.partial(launches.do, name, _launch_job, name, profile),
+        priority)
+    if response.get("status") == "SCHEDULED":
+        progress.publish(name, 'scheduled', position=response.get("position"),
+                         estimated_wait=response.get("estimated_wait"))
+    return response
+
+
+def _input_mode(path):
+    if JOB_INPUT_MODE != 'auto':
+        return JOB_INPUT_MODE
+    files = ConfigMapSecrets._check_type(path) or []
+    size = sum(ConfigMapSecrets.payload_size(f) for f in files)
+    return 's3' if size > MAX_BYTES else 'configmap'
+
+
+# In an Indexed Job, the district of a pod is picked from `BUCKET_NAMES`
+# with its completion index
+SELECT_DISTRICT = ('if [ -n "$BUCKET_NAMES" ]; then set -- $BUCKET_NAMES; '
+                   'shift $JOB_COMPLETION_INDEX; export BUCKET_NAME=$1; fi')
+
+UNITY_COMMAND = " && ".join([
+    SELECT_DISTRICT,
+    "git clone -b os/unix-urp https://github.com/twin-city/unity-project",
+    "cd unity-project",
+    "apt update && apt install -qy awscli python3-pip",
+    "pip3 install awscli-plugin-endpoint",
+    "mkdir /root/.aws",
+    "cp /config/config /root/.aws/",
+    "cp /cred/credentials /root/.aws/",
+    "chmod +x Assets/CommandeCLI/Run.sh Assets/CommandeCLI/upload-webgl.sh",
+    f"echo '{MARKER}building'",
+    "Assets/CommandeCLI/Run.sh -d /unity-project "
+    "-j /input -l /licence/Unity_v2020_pro2xs.x.ulf -b /output",
+    f"echo '{MARKER}uploading'",
+    "Assets/CommandeCLI/upload-webgl.sh"])
+
+
+# A free checkout slot of the cache is locked for the life of the pod, the
+# project is cloned in the pod when every slot is busy
+WARM_COMMAND = "\n".join([
+    "set -e",
+    SELECT_DISTRICT,
+    "PROJECT=/tmp/unity-project",
+    f"for i in $(seq 0 {UNITY_CACHE_SLOTS - 1}); do exec 9>/cache/slot-$i.lock; "
+    "if flock -n 9; then PROJECT=/cache/slot-$i/unity-project; break; fi; done",
+    "if [ -d $PROJECT/.git ]; then "
+    "git -C $PROJECT fetch --depth 1 origin os/unix-urp && "
+    "git -C $PROJECT reset --hard FETCH_HEAD; "
+    "else git clone --depth 1 -b os/unix-urp "
+    "https://github.com/twin-city/unity-project $PROJECT; fi",
+    "cd $PROJECT",
+    "mkdir -p /root/.aws",
+    "cp /config/config /cred/credentials /root/.aws/",
+    "chmod +x Assets/CommandeCLI/Run.sh Assets/CommandeCLI/upload-webgl.sh",
+    f"echo '{MARKER}building'",
+    "Assets/CommandeCLI/Run.sh -d $PROJECT "
+    "-j /input -l /licence/Unity_v2020_pro2xs.x.ulf -b /output",
+    f"echo '{MARKER}uploading'",
+    "Assets/CommandeCLI/upload-webgl.sh"])
+
+
+@functools.lru_cache(maxsize=None)
+def unity_template(profile=UNITY_PROFILE):
+    """
+    Unity job of a profile built once, cloned for each district
+    """
+    config = ['input', 'licence', 'aws-cred', 'aws-conf']
+    mount_path = ['/input', '/licence', '/cred', '/config']
+    type_volume = ["emptydir", "confimap", "secret", "configmap"]
+    reason = _profile_error(profile)
+    if reason is not None:
+        raise ValueError(reason)
+    if profile == 'warm':
+        image, command = UNITY_WARM_IMAGE, WARM_COMMAND
+        config.append(UNITY_CACHE_HOSTPATH or UNITY_CACHE_CLAIM)
+        mount_path.append('/cache')
+        type_volume.append('hostpath' if UNITY_CACHE_HOSTPATH else 'pvc')
+    else:
+        image, command = "ghcr.io/twin-city/unity-project:os-unix-urp", UNITY_COMMAND
+    return JobTemplate(
+        image=image,
+        cmd=["bash"],
+        namespace="twincity",
+        args=["-c", command],
+        config=config,
+        mount_path=mount_path,
+        type_volume=type_volume,
+        pool_name=GPU_POOL,
+        labels={**MANAGED_BY, POOL_LABEL: GPU_POOL})
+
+
+def _download_input(env):
+    """
+    Init container copying input of district `BUCKET_NAME` (or picked in
+    `BUCKET_NAMES`) of `env` from object storage
+    """
+    return {"name": "download-input",
+            "image": JOB_INPUT_IMAGE,
+            "cmd": ["sh"],
+            "args": ["-c", f"{SELECT_DISTRICT}; aws --endpoint-url {s3.endpoint} "
+                           f"s3 cp --recursive s3://{JOB_INPUT_BUCKET}/inputs/$BUCKET_NAME "
+                           "/input"],
+            "env": {"AWS_SHARED_CREDENTIALS_FILE": "/cred/credentials",
+                    "AWS_CONFIG_FILE": "/config/config", **env},
+            "mount_path": ["/input", "/cred", "/config"]}
+
+
+def _prepared_path(name):
+    """
+    Directory of prepared data of a job, materialized from the artifact
+    store if it was pruned
+    """
+    path = f"{JOBS_PATH}/{name}"
+    if os.path.exists(path):
+        store.touch(name)
+    else:
+        store.materialize(name, path)
+    return path
+
+
+def _upload_input(name):
+    report = s3.upload(_prepared_path(name), recursive=True,
+                       bucket_name=JOB_INPUT_BUCKET, prefix=f"inputs/{name}/")
+    if report["failed"]:
+        raise RuntimeError(f"{len(report['failed'])} input files of {name} not uploaded")
+
+
+def _input_volume(name):
+    """
+    Upload prepared data in object storage or in a configmap.
+    Return (config, type_volume, init_containers) of the job input
+    """
+    path = _prepared_path(name)
+    if _input_mode(path) != 's3':
+        with metrics.timed('configmap'):
+            cm = ConfigMapSecrets(name=name,
+                                  kind="configmap",
+                                  namespace="twincity",
+                                  metadata={"labels": dict(MANAGED_BY)},
+                                  from_path=path)
+        return cm.names, "configmap", []
+
+    _upload_input(name)
+    return "input", "emptydir", [_download_input({"BUCKET_NAME": name})]
+
+
+def _launch_job(name, profile=UNITY_PROFILE):
+    # A job already running or finished is not handed its input again
+    status, _ = job_status(name)
+    response = _status_response(name, status)
+    if response is not None:
+        return response
+    progress.publish(name, 'configmap')
+    try:
+        input_config, input_type, init_containers = _input_volume(name)
+    except Exception as e:
+        progress.publish(name, 'failed', reason=str(e))
+        return {"status": "KO", "reason": str(e), "code": 500}
+    #TODO: check if mounted volumes is availables
+    job_unity = unity_template(profile).render(
+        name,
+        env={"BUCKET_NAME": name},
+        volumes={'/input': (input_config, input_type)},
+        init_containers=init_containers)
+    try:
+        status = job_unity.start_job()
+    except Exception as e:
+        progress.publish(name, 'failed', reason=str(e))
+        return {"status": "KO", "reason": str(e), "code": 500}
+    # Errors of the API server are returned as a Status
+    if isinstance(status, dict) and status.get("code", 201) >= 400:
+        progress.publish(name, 'failed', reason=status.get("message"))
+        return {"status": "KO", "reason": status.get("message"), "code": status["code"]}
+    catalog.update(name, state='LAUNCHED')
+    return {"status": "LAUNCHED", "code": 201, "job_name": name, "url": f'https://{name}.s3-website.fr-par.scw.cloud'}
+
+
+def _indexed_name(names):
+    return hashlib.sha1(f'batch-{"-".join(sorted(names))}'.encode()).hexdigest()
+
+
+def launch_indexed_job(names, name=None, profile=UNITY_PROFILE):
+    """
+    Start a single Indexed Job generating all `names`, one pod per district.
+    Inputs are always handed through object storage
+    """
+    name = name if name is not None else _indexed_name(names)
+    try:
+        for district in names:
+            _upload_input(district)
+    except Exception as e:
+        return {"status": "KO", "reason": str(e), "code": 500}
+    env = {"BUCKET_NAMES": " ".join(names)}
+    job_unity = unity_template(profile).render(
+        name,
+        env=env,
+        volumes={'/input': ("input", "emptydir")},
+        init_containers=[_download_input(env)],
+        completions=len(names),
+        parallelism=min(len(names), INDEXED_PARALLELISM))
+    status = job_unity.start_job()
+    if isinstance(status, dict) and status.get("code", 201) >= 400:
+        return {"status": "KO", "reason": status.get("message"), "code": status["code"]}
+    for district in names:
+        catalog.update(district, state='LAUNCHED')
+    return {"status": "LAUNCHED", "code": 201, "job_name": name, "count": len(names)}
+
+
+# Last statement of the module
+IMPORT_SECONDS = time.perf_counter() - START
+metrics.STARTUP_SECONDS.labels('import').set(IMPORT_SECONDS)
@@ -0,0 +1,87 @@
+import sys
+import json
+import time
+import logging
+import contextlib
+import contextvars
+
+from prometheus_client import Counter, Gauge, Histogram
+
+logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+logger = logging.getLogger('timing')
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60,
+           120, 300, 600, 1200, 3600)
+
+STAGE_SECONDS = Histogram('twincity_stage_seconds',
+                          'Duration of pipeline stages', ['stage', 'status'],
+                          buckets=BUCKETS)
+REQUEST_SECONDS = Histogram('twincity_request_seconds',
+                            'Duration of HTTP requests', ['route', 'method', 'code'],
+                            buckets=BUCKETS)
+CACHE = Counter('twincity_cache_total', 'Cache lookups', ['cache', 'result'])
+ERRORS = Counter('twincity_errors_total', 'Errors of backend calls',
+                 ['backend', 'operation'])
+JOBS = Counter('twincity_jobs_total', 'Finished unity jobs', ['result'])
+IN_FLIGHT = Gauge('twincity_in_flight', 'Jobs in flight', ['kind'])
+STARTUP_SECONDS = Gauge('twincity_startup_seconds',
+                        'Seconds from the first import of the app', ['phase'])
+GC_DELETED = Counter('twincity_gc_deleted_total', 'Resources deleted by garbage collection',
+                     ['kind'])
+
+# Stage durations of the current request, None outside of a request
+_timings = contextvars.ContextVar('timings', default=None)
+
+
+def observe(stage, seconds, status='ok'):
+    STAGE_SECONDS.labels(stage, status).observe(seconds)
+    timings = _timings.get()
+    if timings is not None:
+        timings[stage] = round(timings.get(stage, 0) + seconds, 4)
+
+
+@contextlib.contextmanager
+def timed(stage):
+    """
+    Measure a stage of the pipeline, in the stage histogram and in the timing
+    log of the current request
+
+    Usage example:
+        with timed('s3_check_bucket'):
+            s3.check_bucket('name')
+    """
+    start = time.perf_counter()
+    status = 'ok'
+    try:
+        yield
+    except Exception:
+        status = 'error'
+        raise
+    finally:
+        observe(stage, time.perf_counter() - start, status)
+
+
+def cache(name, hit):
+    CACHE.labels(name, 'hit' if hit else 'miss').inc()
+
+
+def error(backend, operation):
+    ERRORS.labels(backend, operation).inc()
+
+
+def start_request():
+    """
+    Start collecting stage durations of a request, return the context token
+    """
+    return _timings.set({})
+
+
+def end_request(token, route, method, code, seconds):
+    """
+    Observe a request and write its timing log line
+    """
+    timings = _timings.get()
+    _timings.reset(token)
+    REQUEST_SECONDS.labels(route, method, str(code)).observe(seconds)
+    logger.info(json.dumps({"route": route, "method": method, "code": code,
+                            "seconds": round(seconds, 4), "stages": timings}))
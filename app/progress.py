@@ -0,0 +1,191 @@
+import sys
+import time
+import asyncio
+import logging
+import threading
+from collections import Counter, OrderedDict
+
+import kube
+
+logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+logger = logging.getLogger('progress')
+
+STAGES = ('queued', 'preparing', 'prepared', 'scheduled', 'configmap', 'pending',
+          'running', 'building', 'uploading', 'done', 'failed')
+FINAL = ('done', 'failed')
+# Written in the log of unity jobs when a step starts, followed by the stage
+MARKER = '##twincity-stage '
+
+
+def job_stage(info):
+    """
+    Stage of a unity job from its status, None if the job does not exist
+    """
+    if not info or info.get("kind") == "Status":
+        return None
+    for condition in info.get("conditions") or []:
+        if condition["status"] == 'True' and condition["type"] == 'Complete':
+            return 'done'
+        if condition["status"] == 'True' and condition["type"] == 'Failed':
+            return 'failed'
+    if info.get("ready"):
+        return 'running'
+    return 'pending'
+
+
+class Progress:
+    def __init__(self, max_names=1000, history=50):
+        """
+        Stage transitions of jobs, from preparation to the end of the unity
+        build, published by the components running them and streamed to
+        clients. A run starts with the `queued` stage, which clears the
+        events of the previous run of a job.
+
+        Usage example:
+            progress = Progress()
+            progress.publish('name', 'queued')
+            async for event in progress.stream('name'):
+                print(event)
+
+        Parameters
+        ----------
+        max_names: int, jobs whose events are kept, least recently updated
+                   are forgotten
+        history: int, events kept per job
+        """
+        self.max_names = max_names
+        self.history = history
+        self.lock = threading.Lock()
+        self.events = OrderedDict()
+        self.version = 0
+        self.waiters = {}
+        self.subscribers = Counter()
+        self.tailing = set()
+
+    def publish(self, name, stage, **details):
+        """
+        Record a stage of a job. Stages of a run only move forward, a stage
+        before the current one is ignored unless it starts a new run (after
+        `queued` or once the previous run is done or failed)
+        """
+        if stage not in STAGES:
+            raise ValueError(f'stage must be one of {STAGES}')
+        with self.lock:
+            events = self.events.get(name, [])
+            last = events[-1]["stage"] if events else None
+            if last == stage:
+                return
+            if stage == 'queued' or last in FINAL:
+                events = []
+            elif last is not None and STAGES.index(stage) < STAGES.index(last):
+                return
+            self.version += 1
+            events.append({"id": self.version, "name": name, "stage": stage,
+                           "at": time.time(), **details})
+            self.events[name] = events[-self.history:]
+            self.events.move_to_end(name)
+            while len(self.events) > self.max_names:
+                self.events.popitem(last=False)
+            for loop, event in self.waiters.get(name, []):
+                loop.call_soon_threadsafe(event.set)
+
+    def get(self, name, since=0):
+        """
+        Events of the current run of a job after event id `since`
+        """
+        with self.lock:
+            return [e for e in self.events.get(name, []) if e["id"] > since]
+
+    def stage(self, name):
+        with self.lock:
+            events = self.events.get(name)
+            return events[-1]["stage"] if events else None
+
+    async def stream(self, name, since=0, timeout=3600, heartbeat=15):
+        """
+        Yield events of a job after event id `since` until it is done or
+        failed, at most `timeout` seconds. None is yielded after `heartbeat`
+        seconds without event, to keep the connection alive
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        with self.lock:
+            self.subscribers[name] += 1
+        try:
+            while loop.time() < deadline:
+                with self.lock:
+                    events = [e for e in self.events.get(name, []) if e["id"] > since]
+                    if not events:
+                        waiter = (loop, asyncio.Event())
+                        self.waiters.setdefault(name, []).append(waiter)
+                for event in events:
+                    since = event["id"]
+                    yield event
+                    if event["stage"] in FINAL:
+                        return
+                if events:
+                    continue
+                try:
+                    await asyncio.wait_for(waiter[1].wait(),
+                                           min(heartbeat, deadline - loop.time()))
+                except asyncio.TimeoutError:
+                    yield None
+                finally:
+                    with self.lock:
+                        self.waiters[name].remove(waiter)
+                        if not self.waiters[name]:
+                            del self.waiters[name]
+        finally:
+            with self.lock:
+                self.subscribers[name] -= 1
+                if self.subscribers[name] <= 0:
+                    del self.subscribers[name]
+
+    def watched(self, name):
+        """
+        Whether a client is streaming events of a job
+        """
+        with self.lock:
+            return self.subscribers.get(name, 0) > 0
+
+    def _tail(self, name, namespace):
+        """
+        Follow the log of the pod of a job and publish the stages it writes
+        """
+        try:
+            core = kube.core_api()
+            pods = core.list_namespaced_pod(
+                namespace=namespace, label_selector=f'job-name={name}').items
+            if not pods:
+                return
+            response = core.read_namespaced_pod_log(
+                name=pods[0].metadata.name, namespace=namespace, container=name,
+                follow=True, _preload_content=False)
+            buffer = b''
+            for chunk in response.stream(4096):
+                buffer += chunk
+                *lines, buffer = buffer.split(b'\n')
+                for line in lines:
+                    line = line.decode('utf-8', errors='replace').strip()
+                    if line.startswith(MARKER) and line[len(MARKER):] in STAGES:
+                        self.publish(name, line[len(MARKER):], source='log')
+            response.release_conn()
+        except kube.client.rest.ApiException as f:
+            # Pod not started yet or already removed
+            logger.info(f'Log of {name} not followed: {f.reason}')
+        except Exception as f:
+            logger.warning(f'Log of {name} not followed: {f}')
+        finally:
+            with self.lock:
+                self.tailing.discard(name)
+
+    def tail(self, name, namespace='default'):
+        """
+        Follow the log of a running job in background, once per job
+        """
+        with self.lock:
+            if name in self.tailing:
+                return
+            self.tailing.add(name)
+        threading.Thread(target=self._tail, args=(name, namespace),
+                         name=f'tail-{name[:8]}', daemon=True).start()
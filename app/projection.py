@@ -0,0 +1,129 @@
+import math
+import functools
+
+LAMBERT = "EPSG:2154"
+WGS84 = "EPSG:4326"
+
+
+class ProjectionError(ValueError):
+    pass
+
+
+def normalize(crs):
+    """
+    Normalized name of a CRS, None means LAMBERT
+    """
+    return LAMBERT if crs is None else crs.strip().upper()
+
+
+@functools.lru_cache(maxsize=64)
+def transformer(src, dst=LAMBERT):
+    """
+    Transformer between two CRS, created once per (src, dst). Coordinates are
+    in the axis order of each CRS (latitude first for EPSG:4326)
+    """
+    from pyproj import Transformer
+    from pyproj.exceptions import CRSError
+    try:
+        return Transformer.from_crs(src, dst)
+    except CRSError as f:
+        raise ProjectionError(f'unknown CRS {src if dst == LAMBERT else dst}: {f}')
+
+
+@functools.lru_cache(maxsize=64)
+def area_of_use(crs):
+    """
+    (south, west, north, east) in degrees where a CRS is valid, None if unknown
+    """
+    from pyproj import CRS
+    area = CRS.from_user_input(crs).area_of_use
+    if area is None:
+        return None
+    return area.south, area.west, area.north, area.east
+
+
+def transform(xs, ys, src, dst=LAMBERT):
+    """
+    Transform lists of coordinates from `src` to `dst` in one call.
+    Return (xs, ys) lists
+    """
+    src, dst = normalize(src), normalize(dst)
+    if src == dst:
+        return list(xs), list(ys)
+    xs, ys = transformer(src, dst).transform(list(xs), list(ys))
+    return list(xs), list(ys)
+
+
+def to_lambert(x1, y1, x2, y2, crs):
+    """
+    Convert bbox corners given in `crs` axis order to LAMBERT (EPSG:2154)
+    """
+    (x1, x2), (y1, y2) = transform([x1, x2], [y1, y2], crs)
+    return x1, y1, x2, y2
+
+
+def to_lambert_bboxes(bboxes):
+    """
+    Convert many (x1, y1, x2, y2, crs) bboxes to LAMBERT, with one
+    transformation per CRS. Return a list of (x1, y1, x2, y2)
+    """
+    by_crs = {}
+    for i, (x1, y1, x2, y2, crs) in enumerate(bboxes):
+        by_crs.setdefault(normalize(crs), []).append((i, x1, y1, x2, y2))
+    converted = [None] * len(bboxes)
+    for crs, items in by_crs.items():
+        xs = [v for _, x1, _, x2, _ in items for v in (x1, x2)]
+        ys = [v for _, _, y1, _, y2 in items for v in (y1, y2)]
+        xs, ys = transform(xs, ys, crs)
+        for k, (i, *_) in enumerate(items):
+            converted[i] = (xs[2 * k], ys[2 * k], xs[2 * k + 1], ys[2 * k + 1])
+    return converted
+
+
+def validate(xs, ys, crs, within=LAMBERT):
+    """
+    Check points given in `crs` are finite and in the area of use of both
+    `crs` and `within`, raise ProjectionError otherwise
+    """
+    xs, ys = list(xs), list(ys)
+    if not all(math.isfinite(v) for v in xs + ys):
+        raise ProjectionError('coordinates must be finite numbers')
+    lats, lons = transform(xs, ys, crs, WGS84)
+    if not all(math.isfinite(v) for v in lats + lons):
+        raise ProjectionError(f'coordinates can not be projected from {crs}')
+    for name in {normalize(crs), normalize(within)}:
+        area = area_of_use(name)
+        if area is None:
+            continue
+        south, west, north, east = area
+        if not all(south <= lat <= north and west <= lon <= east
+                   for lat, lon in zip(lats, lons)):
+            raise ProjectionError(f'coordinates are outside the area of use of {name} '
+                                  f'(lat {south}..{north}, lon {west}..{east}) '
+                                  f'in {normalize(crs)} axis order')
+
+
+def validate_bboxes(bboxes, within=LAMBERT):
+    """
+    Validate many (x1, y1, x2, y2, crs) bboxes with one transformation per
+    CRS. Return a list with None for valid bboxes, else the error message
+    """
+    by_crs = {}
+    for i, (x1, y1, x2, y2, crs) in enumerate(bboxes):
+        by_crs.setdefault(normalize(crs), []).append((i, x1, y1, x2, y2))
+    errors = [None] * len(bboxes)
+    for crs, items in by_crs.items():
+        xs = [v for _, x1, _, x2, _ in items for v in (x1, x2)]
+        ys = [v for _, _, y1, _, y2 in items for v in (y1, y2)]
+        try:
+            validate(xs, ys, crs, within)
+            continue
+        except ProjectionError:
+            pass
+        # Find the invalid ones
+        for i, x1, y1, x2, y2 in items:
+            try:
+                validate([x1, x2], [y1, y2], crs, within)
+            except ProjectionError as f:
+                errors[i] = str(f)
+    return errors
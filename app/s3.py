@@ -1,8 +1,20 @@
-import boto3
 from botocore.exceptions import ClientError
 import os
+import sys
+import json
+import time
+import logging
+import hashlib
 import pathlib
 import glob
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+
+logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+logger = logging.getLogger('s3')
 
 
 class S3:
@@ -11,22 +23,80 @@ class S3:
             aws_access_key_id=None,
             aws_secret_access_key=None,
             region_name=None,
-            endpoint=None):
+            endpoint=None,
+            positive_ttl=None,
+            negative_ttl=None,
+            max_entries=1000,
+            cache_path=None):
         """
-        Create S3 Connector
+        Create S3 Connector, its boto3 client is created on first use
+
+        Bucket existence checks are cached in memory, optionally on disk
+        with `cache_path` (default env `S3_CACHE_PATH`)
+
+        Parameters
+        ----------
+        positive_ttl: int, seconds an existing bucket is cached,
+                      default env `S3_CACHE_POSITIVE_TTL` or 300
+        negative_ttl: int, seconds a missing bucket is cached,
+                      default env `S3_CACHE_NEGATIVE_TTL` or 30
+        max_entries: int, maximum number of cached buckets, least recently
+                     used are evicted
+        cache_path: str, json file where the cache is persisted
+
+        Uploads use `S3_UPLOAD_WORKERS` (default 8) files in parallel, and
+        multipart transfers above `S3_MULTIPART_THRESHOLD` bytes (default 8MB)
+        by chunks of `S3_MULTIPART_CHUNKSIZE` bytes (default 8MB)
         """
-        self.endpoint = endpoint if os.getenv(
-            'ENDPOINT') is not None else os.getenv('ENDPOINT','https://s3.fr-par.scw.cloud')
+        self.endpoint = endpoint if endpoint is not None \
+            else os.getenv('ENDPOINT', 'https://s3.fr-par.scw.cloud')
 
-        self.client = boto3.client(
-            's3',
-            region_name=region_name,
-            endpoint_url=self.endpoint,
-            use_ssl=True,
-            aws_access_key_id=aws_access_key_id,
-            aws_secret_access_key=aws_secret_access_key
-        )
+        self.client_kwargs = {"region_name": region_name,
+                              "aws_access_key_id": aws_access_key_id,
+                              "aws_secret_access_key": aws_secret_access_key}
+        self.client_lock = threading.Lock()
+        self._client = None
+        self._transfer_config = None
+
+        self.positive_ttl = positive_ttl if positive_ttl is not None \
+            else int(os.getenv('S3_CACHE_POSITIVE_TTL', 300))
+        self.negative_ttl = negative_ttl if negative_ttl is not None \
+            else int(os.getenv('S3_CACHE_NEGATIVE_TTL', 30))
+        self.max_entries = max_entries
+        self.cache_path = cache_path if cache_path is not None \
+            else os.getenv('S3_CACHE_PATH')
+        self.cache_lock = threading.Lock()
+        self.cache = OrderedDict()
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self._load_cache()
+
+        self.upload_workers = int(os.getenv('S3_UPLOAD_WORKERS', 8))
+
+    @property
+    def client(self):
+        """
+        boto3 client created on first call, boto3 is slow to import and
+        credentials are only needed when object storage is used
+        """
+        if self._client is None:
+            with self.client_lock:
+                if self._client is None:
+                    import boto3
+                    self._client = boto3.client('s3', endpoint_url=self.endpoint,
+                                                use_ssl=True, **self.client_kwargs)
+        return self._client
 
+    @property
+    def transfer_config(self):
+        if self._transfer_config is None:
+            from boto3.s3.transfer import TransferConfig
+            self._transfer_config = TransferConfig(
+                multipart_threshold=int(os.getenv('S3_MULTIPART_THRESHOLD', 8 * 1024 ** 2)),
+                multipart_chunksize=int(os.getenv('S3_MULTIPART_CHUNKSIZE', 8 * 1024 ** 2)),
+                max_concurrency=4,
+                use_threads=True)
+        return self._transfer_config
 
     @staticmethod
     def _check_type(path, recursive=False):
@@ -40,28 +110,303 @@ class S3:
         elif isinstance(path, str):
             if os.path.isdir(path):
                 if recursive:
-                    return [f for f in glob.glob('f{path}/**/*', recursive=True) if pathlib.Path(f).is_file()]
+                    return [f for f in glob.glob(f'{path}/**/*', recursive=True) if pathlib.Path(f).is_file()]
                 else:
-                    return [os.path.join(path, i) for i in os.listdir(path) if pathlib.Path(i).is_file()]
+                    return [os.path.join(path, i) for i in os.listdir(path)
+                            if pathlib.Path(path, i).is_file()]
             return [path]
 
-    def upload(self, objet, recursive=False, bucket_name=None):
-        filename = self._check_type(objet, recursive=recursive)
-        for f in filename:
-            self.client.upload_file(Bucket=bucket_name,  Key=f,  Filename=f)
+    @staticmethod
+    def _root(objet, filenames):
+        """
+        Root directory from which object keys are built
+        """
+        if isinstance(objet, str) and os.path.isdir(objet):
+            return objet
+        if not filenames:
+            return '.'
+        return os.path.commonpath([os.path.dirname(os.path.abspath(f)) for f in filenames])
+
+    def _etag(self, filename):
+        """
+        Compute the ETag S3 gives to a file uploaded with our transfer config
+        """
+        chunksize = self.transfer_config.multipart_chunksize
+        size = os.path.getsize(filename)
+        with open(filename, 'rb') as f:
+            if size < self.transfer_config.multipart_threshold:
+                return f'"{hashlib.md5(f.read()).hexdigest()}"'
+            digests = [hashlib.md5(chunk).digest()
+                       for chunk in iter(lambda: f.read(chunksize), b'')]
+        return f'"{hashlib.md5(b"".join(digests)).hexdigest()}-{len(digests)}"'
+
+    def _objects(self, bucket_name, prefix=''):
+        """
+        Return {key: (size, ETag)} of the objects of a bucket under `prefix`,
+        listed by pages of 1000, empty if they can not be listed
+        """
+        objects = {}
+        try:
+            paginator = self.client.get_paginator('list_objects_v2')
+            for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+                for obj in page.get("Contents", []):
+                    objects[obj["Key"]] = (obj["Size"], obj["ETag"])
+        except ClientError as e:
+            logger.info(f"Objects of {bucket_name} not listed: {e}")
+            return {}
+        return objects
+
+    def _unchanged(self, filename, remote):
+        """
+        Check if the object already in bucket, as (size, ETag), has same
+        size and ETag
+        """
+        if remote is None or remote[0] != os.path.getsize(filename):
+            return False
+        return remote[1] == self._etag(filename)
+
+    def upload(self, objet, recursive=False, bucket_name=None, prefix='',
+               skip_unchanged=True, max_workers=None):
+        """
+        Upload a file, a list of files or a directory in parallel. Keys are
+        relative to the uploaded directory (or common parent of the files),
+        prefixed by `prefix`. Files already uploaded with same size and ETag
+        are skipped, so an interrupted upload can be run again to resume it.
+        Objects under `prefix` are listed once to find them.
+
+        Return a report with counts of uploaded and skipped files, failures,
+        bytes transferred and throughput
+        """
+        from boto3.exceptions import S3UploadFailedError
+        filenames = self._check_type(objet, recursive=recursive) or []
+        root = self._root(objet, filenames)
+        total = sum(os.path.getsize(f) for f in filenames)
+        report = {"files": len(filenames), "uploaded": 0, "skipped": 0,
+                  "failed": [], "bytes": 0, "total_bytes": total}
+        lock = threading.Lock()
+        remote = self._objects(bucket_name, prefix) if skip_unchanged and filenames else {}
+
+        def _progress(n):
+            with lock:
+                report["bytes"] += n
+
+        def _upload(filename):
+            key = prefix + pathlib.Path(os.path.relpath(filename, root)).as_posix()
+            try:
+                if skip_unchanged and self._unchanged(filename, remote.get(key)):
+                    with lock:
+                        report["skipped"] += 1
+                    return
+                self.client.upload_file(Bucket=bucket_name, Key=key, Filename=filename,
+                                        Config=self.transfer_config,
+                                        Callback=_progress)
+                with lock:
+                    report["uploaded"] += 1
+            except (ClientError, OSError, S3UploadFailedError) as e:
+                metrics.error('s3', 'upload')
+                logger.error(f"Upload of {filename} failed: {e}")
+                with lock:
+                    report["failed"].append(filename)
+
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=max_workers or self.upload_workers) as executor:
+            list(executor.map(_upload, filenames))
+        report["seconds"] = time.time() - start
+        report["throughput"] = report["bytes"] / report["seconds"] \
+            if report["seconds"] > 0 else None
+        metrics.observe('s3_upload', report["seconds"],
+                        'error' if report["failed"] else 'ok')
+        logger.info(f"{report['uploaded']} files uploaded, {report['skipped']} skipped, "
+                    f"{len(report['failed'])} failed to {bucket_name} "
+                    f"({report['bytes']} bytes in {report['seconds']:.1f}s)")
+        return report
+
+    def _load_cache(self):
+        """
+        Load still valid entries of the on-disk cache
+        """
+        if self.cache_path is None or not os.path.isfile(self.cache_path):
+            return
+        try:
+            with open(self.cache_path, 'r') as f:
+                entries = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Bucket cache {self.cache_path} not loaded: {e}")
+            return
+        now = time.time()
+        for name, (exists, expire) in entries.items():
+            if expire > now:
+                self.cache[name] = (exists, expire)
+
+    def save_cache(self):
+        """
+        Persist the cache on disk if `cache_path` is set
+        """
+        if self.cache_path is None:
+            return
+        with self.cache_lock:
+            entries = dict(self.cache)
+        tmp = f"{self.cache_path}.tmp"
+        with open(tmp, 'w') as f:
+            json.dump(entries, f)
+        os.replace(tmp, self.cache_path)
+
+    def _cache_get(self, bucket_name):
+        with self.cache_lock:
+            entry = self.cache.get(bucket_name)
+            if entry is not None and entry[1] > time.time():
+                self.cache.move_to_end(bucket_name)
+                self.cache_hits += 1
+                metrics.cache('bucket', True)
+                return entry[0]
+            if entry is not None:
+                del self.cache[bucket_name]
+            self.cache_misses += 1
+            metrics.cache('bucket', False)
+            return None
+
+    def _cache_set(self, bucket_name, exists):
+        ttl = self.positive_ttl if exists else self.negative_ttl
+        with self.cache_lock:
+            self.cache[bucket_name] = (exists, time.time() + ttl)
+            self.cache.move_to_end(bucket_name)
+            while len(self.cache) > self.max_entries:
+                self.cache.popitem(last=False)
+
+    def invalidate(self, bucket_name):
+        """
+        Forget cached existence of a bucket
+        """
+        with self.cache_lock:
+            self.cache.pop(bucket_name, None)
+
+    def list_keys(self, bucket_name, prefix=''):
+        """
+        Yield (key, last modified timestamp) of the objects of a bucket
+        under `prefix`
+        """
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+            for obj in page.get("Contents", []):
+                yield obj["Key"], obj["LastModified"].timestamp()
+
+    def delete_prefix(self, bucket_name, prefix):
+        """
+        Delete objects of a bucket under `prefix` by batches of 1000.
+        Return the number of deleted objects, 0 if the bucket does not exist
+        """
+        try:
+            keys = [key for key, _ in self.list_keys(bucket_name, prefix)]
+            for i in range(0, len(keys), 1000):
+                self.client.delete_objects(
+                    Bucket=bucket_name,
+                    Delete={"Objects": [{"Key": k} for k in keys[i:i + 1000]],
+                            "Quiet": True})
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'NoSuchBucket':
+                return 0
+            metrics.error('s3', 'delete_objects')
+            raise
+        return len(keys)
+
+    def delete_bucket(self, bucket_name):
+        """
+        Delete a bucket and its objects, return False if it does not exist
+        """
+        try:
+            self.delete_prefix(bucket_name, '')
+            self.client.delete_bucket(Bucket=bucket_name)
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('NoSuchBucket', '404'):
+                return False
+            metrics.error('s3', 'delete_bucket')
+            raise
+        finally:
+            self.invalidate(bucket_name)
+        logger.info(f"Bucket {bucket_name} deleted")
+        return True
+
+    def create_bucket(self, bucket_name):
+        """
+        Create a private bucket, return False if we already own it.
+        Raise ClientError if the name is taken by another account
+        """
+        try:
+            self.client.create_bucket(Bucket=bucket_name)
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'BucketAlreadyOwnedByYou':
+                self._cache_set(bucket_name, True)
+                return False
+            metrics.error('s3', 'create_bucket')
+            raise
+        self._cache_set(bucket_name, True)
+        logger.info(f"Bucket {bucket_name} created")
+        return True
+
+    def list_bucket_names(self):
+        with metrics.timed('s3_list_buckets'):
+            response = self.client.list_buckets()
+        return [b["Name"] for b in response.get("Buckets", [])]
+
+    def warm_up(self):
+        """
+        Populate the cache with all existing buckets in one call
+        """
+        buckets = self.list_bucket_names()
+        for name in buckets:
+            self._cache_set(name, True)
+        return len(buckets)
+
+    def check_buckets(self, bucket_names):
+        """
+        Check existence of many buckets: cached ones are answered from cache,
+        the others with a single list of our buckets.
+        Return a dict of existence by bucket name
+        """
+        results = {name: self._cache_get(name) for name in bucket_names}
+        missing = [name for name, exists in results.items() if exists is None]
+        if len(missing) == 1:
+            results[missing[0]] = self._head_bucket(missing[0])
+        elif missing:
+            listed = set(self.list_bucket_names())
+            for name in missing:
+                results[name] = name in listed
+                self._cache_set(name, results[name])
+        return results
+
+    def cache_stats(self):
+        with self.cache_lock:
+            return {"hits": self.cache_hits,
+                    "misses": self.cache_misses,
+                    "size": len(self.cache),
+                    "max_entries": self.max_entries}
 
     def check_bucket(self, bucket_name=None):
+        exists = self._cache_get(bucket_name)
+        if exists is not None:
+            return exists
+        return self._head_bucket(bucket_name)
+
+    def _head_bucket(self, bucket_name):
+        start = time.perf_counter()
         try:
             self.client.head_bucket(Bucket=bucket_name)
-            print("Bucket Exists!")
+            logger.info(f"Bucket {bucket_name} exists")
+            self._cache_set(bucket_name, True)
             return True
         except ClientError as e:
             # If a client error is thrown, then check that it was a 404 error.
             # If it was a 404 error, then the bucket does not exist.
             error_code = int(e.response['Error']['Code'])
             if error_code == 403:
-                print("Private Bucket. Forbidden Access!")
+                logger.info(f"Bucket {bucket_name} is private, forbidden access")
+                self._cache_set(bucket_name, True)
                 return True
             elif error_code == 404:
-                print("Bucket Does Not Exist!")
+                logger.info(f"Bucket {bucket_name} does not exist")
+                self._cache_set(bucket_name, False)
                 return False
+            metrics.error('s3', 'head_bucket')
+        finally:
+            # A missing bucket is an answer, not an error
+            metrics.observe('s3_head_bucket', time.perf_counter() - start)
@@ -0,0 +1,222 @@
+import os
+import sys
+import time
+import heapq
+import logging
+import threading
+import itertools
+
+logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+logger = logging.getLogger('scheduler')
+
+POOL_LABEL = 'twincity.fr/pool'
+
+# Interactive requests are launched before batch pre-renders
+INTERACTIVE = 0
+BATCH = 1
+
+
+def finished(info):
+    """
+    Whether a job status (from informer) is completed or failed
+    """
+    if info is None:
+        return True
+    return any(c["type"] in ('Complete', 'Failed') and c["status"] == 'True'
+               for c in info.get("conditions") or [])
+
+
+class PoolScheduler:
+    def __init__(self, pool_name, informer=None, executor=None, max_running=None,
+                 job_seconds=None, lost_after=120):
+        """
+        Admission control of jobs on a node pool: at most `max_running` jobs
+        of the pool are running or pending, others wait in a priority queue
+        and are launched as slots are released. Jobs of the pool are tracked
+        with the `informer`, by their `POOL_LABEL` label.
+
+        Usage example:
+            scheduler = PoolScheduler('pool-gpu-3070-s', informer, max_running=4)
+            scheduler.submit('name', launch, priority=INTERACTIVE)
+            scheduler.estimate(BATCH)
+
+        Parameters
+        ----------
+        pool_name: str, name of node pool
+        informer: JobInformer, cache of jobs status, slots are released when
+                  jobs finish
+        executor: Executor, where launches of queued jobs are run,
+                  default the thread releasing a slot
+        max_running: int, jobs of the pool at the same time,
+                     default env `{POOL_NAME}_MAX_JOBS` or 4
+        job_seconds: float, initial estimate of a job duration, refined with
+                     finished jobs, default env `{POOL_NAME}_JOB_SECONDS` or 900
+        lost_after: float, seconds after which a launched job unknown to the
+                    synced informer releases its slot
+        """
+        prefix = pool_name.upper().replace('-', '_')
+        self.pool_name = pool_name
+        self.informer = informer
+        self.executor = executor
+        self.max_running = max_running if max_running is not None \
+            else int(os.getenv(f'{prefix}_MAX_JOBS', 4))
+        self.job_seconds = job_seconds if job_seconds is not None \
+            else float(os.getenv(f'{prefix}_JOB_SECONDS', 900))
+        self.lost_after = lost_after
+        self.lock = threading.Lock()
+        self.queue = []
+        self.queued = {}
+        self.running = {}
+        self.counter = itertools.count()
+        if informer is not None:
+            informer.add_listener(self._on_status)
+
+    @property
+    def used(self):
+        return sum(slots for slots, _ in self.running.values())
+
+    def _on_status(self, name, info):
+        """
+        Track jobs of the pool from informer events
+        """
+        if info is not None and info["labels"].get(POOL_LABEL) != self.pool_name:
+            return
+        with self.lock:
+            if not finished(info):
+                # Jobs launched by another replica or before a restart count too
+                self.running.setdefault(name, (1, time.time()))
+                return
+            if self.running.pop(name, None) is None:
+                return
+            self._learn(info)
+        self._dispatch()
+
+    def _learn(self, info):
+        """
+        Moving average of job durations
+        """
+        if not info or not info.get("start_time") or not info.get("completion_time"):
+            return
+        seconds = (info["completion_time"] - info["start_time"]).total_seconds()
+        self.job_seconds = 0.8 * self.job_seconds + 0.2 * seconds
+
+    def _reconcile(self):
+        """
+        Release slots of jobs finished or lost while no event was received
+        """
+        if self.informer is None or not self.informer.synced.is_set():
+            return
+        now = time.time()
+        for name, (_, since) in list(self.running.items()):
+            info, _ = self.informer.get(name)
+            if (info is not None and finished(info)) or \
+                    (info is None and now - since > self.lost_after):
+                del self.running[name]
+
+    def _position(self, priority, seq=None):
+        """
+        Number of queued jobs launched before a job of `priority`,
+        queued with `seq` or submitted now
+        """
+        return sum(1 for p, s, _ in self.queued.values()
+                   if p < priority or (p == priority and (seq is None or s < seq)))
+
+    def _wait(self, ahead, slots=1):
+        """
+        Estimated seconds before a job with `ahead` queued jobs before it
+        gets its slots
+        """
+        needed = self.used + ahead + slots - self.max_running
+        if needed <= 0:
+            return 0
+        return -(-needed // self.max_running) * self.job_seconds
+
+    def estimate(self, priority=INTERACTIVE):
+        """
+        Estimated seconds before a job of `priority` submitted now is launched
+        """
+        with self.lock:
+            self._reconcile()
+            return self._wait(self._position(priority))
+
+    def submit(self, name, launch, priority=INTERACTIVE, slots=1):
+        """
+        Launch a job now if the pool has `slots` free, else queue it.
+        `launch` is called without arguments and returns a response dict,
+        the slots are kept while the job exists.
+        Return the launch response, or a `SCHEDULED` response with position
+        and estimated wait of the job
+        """
+        with self.lock:
+            self._reconcile()
+            if name in self.running:
+                return {"status": "LAUNCHED", "code": 200, "job_name": name}
+            if name in self.queued:
+                priority, seq, slots = self.queued[name]
+                position = self._position(priority, seq)
+            elif self.queue or (self.running and self.used + slots > self.max_running):
+                # A job is always admitted on an idle pool, even if larger
+                position, seq = self._position(priority), next(self.counter)
+                heapq.heappush(self.queue, (priority, seq, name, launch, slots))
+                self.queued[name] = (priority, seq, slots)
+                logger.info(f'{name} queued for {self.pool_name} at {position}')
+            else:
+                self.running[name] = (slots, time.time())
+                position = None
+            if position is not None:
+                response = {"status": "SCHEDULED", "code": 202, "job_name": name,
+                            "position": position,
+                            "estimated_wait": self._wait(position, slots)}
+        if position is None:
+            return self._launch(name, launch)
+        # Slots may have been released by reconciliation
+        self._dispatch()
+        return response
+
+    def _launch(self, name, launch):
+        try:
+            response = launch()
+        except Exception as f:
+            response = {"status": "KO", "reason": str(f), "code": 500}
+        if response.get("status") not in ('LAUNCHED', 'WAITING', 'RUNNING'):
+            # Not running on the pool: failed, or already finished
+            with self.lock:
+                self.running.pop(name, None)
+            self._dispatch()
+        return response
+
+    def _dispatch(self):
+        """
+        Launch queued jobs while slots are free
+        """
+        while True:
+            with self.lock:
+                if not self.queue:
+                    return
+                _, _, name, launch, slots = self.queue[0]
+                if self.running and self.used + slots > self.max_running:
+                    return
+                heapq.heappop(self.queue)
+                del self.queued[name]
+                self.running[name] = (slots, time.time())
+            logger.info(f'{name} launched on {self.pool_name}')
+            if self.executor is not None:
+                self.executor.submit(self._launch, name, launch)
+            else:
+                self._launch(name, launch)
+
+    def names(self):
+        """
+        Names of jobs queued or running on the pool
+        """
+        with self.lock:
+            return set(self.queued) | set(self.running)
+
+    def stats(self):
+        with self.lock:
+            self._reconcile()
+            return {"pool_name": self.pool_name,
+                    "max_running": self.max_running,
+                    "running": self.used,
+                    "queued": len(self.queue),
+                    "job_seconds": self.job_seconds}
@@ -0,0 +1,46 @@
+import threading
+from concurrent.futures import Future
+
+
+class SingleFlight:
+    def __init__(self):
+        """
+        Coalesce concurrent calls sharing the same key: only the first caller
+        runs the function, the others wait and get the same result (or error)
+
+        Usage example:
+            flight = SingleFlight()
+            flight.do('key', print, 'run once for concurrent callers')
+        """
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def do(self, key, fn, *args, **kwargs):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = Future()
+        if not leader:
+            return call.result()
+        try:
+            result = fn(*args, **kwargs)
+            call.set_result(result)
+            return result
+        except BaseException as f:
+            call.set_exception(f)
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+
+    def in_flight(self, key):
+        with self.lock:
+            return key in self.calls
+
+    def keys(self):
+        """
+        Keys of the calls running now
+        """
+        with self.lock:
+            return set(self.calls)
@@ -0,0 +1,262 @@
+import os
+import sys
+import math
+import uuid
+import json
+import shutil
+import hashlib
+import logging
+import pathlib
+import threading
+from concurrent.futures import Future
+
+from worker import temp_path
+from artifacts import file_hash
+from projection import to_lambert, transform
+import metrics
+
+logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+logger = logging.getLogger('tiles')
+
+TILE_SIZE = float(os.getenv('TILE_SIZE', 500))
+TILES_PATH = os.getenv('TILES_PATH', '/data/tiles')
+
+
+def canonical_bbox(x1, y1, x2, y2, crs=None):
+    """
+    Normalize a bbox given in `crs` axis order into LAMBERT (EPSG:2154)
+    (xmin, ymin, xmax, ymax)
+    """
+    x1, y1, x2, y2 = to_lambert(x1, y1, x2, y2, crs)
+    return min(x1, x2), min(y1, y2), max(x1, x2), max(y1, y2)
+
+
+def snap(bbox, tile_size=TILE_SIZE):
+    """
+    Indexes (ix0, iy0, ix1, iy1) of the tiles covering a LAMBERT bbox,
+    end indexes excluded
+    """
+    xmin, ymin, xmax, ymax = bbox
+    ix0, iy0 = math.floor(xmin / tile_size), math.floor(ymin / tile_size)
+    ix1 = max(ix0 + 1, math.ceil(xmax / tile_size))
+    iy1 = max(iy0 + 1, math.ceil(ymax / tile_size))
+    return ix0, iy0, ix1, iy1
+
+
+def bbox_name(indexes, tile_size=TILE_SIZE):
+    """
+    Job name of a tile-snapped bbox
+    """
+    ix0, iy0, ix1, iy1 = indexes
+    return hashlib.sha1(
+        f'job-EPSG:2154-{tile_size:g}-{ix0}-{iy0}-{ix1}-{iy1}'.encode()).hexdigest()
+
+
+def tile_name(ix, iy, tile_size=TILE_SIZE):
+    return hashlib.sha1(f'tile-EPSG:2154-{tile_size:g}-{ix}-{iy}'.encode()).hexdigest()
+
+
+def cover(indexes, tile_size=TILE_SIZE):
+    """
+    List tiles of snapped indexes as dicts with name and LAMBERT bounds
+    """
+    ix0, iy0, ix1, iy1 = indexes
+    return [{"name": tile_name(ix, iy, tile_size),
+             "bounds": (ix * tile_size, iy * tile_size,
+                        (ix + 1) * tile_size, (iy + 1) * tile_size)}
+            for ix in range(ix0, ix1) for iy in range(iy0, iy1)]
+
+
+def _read_features(file):
+    """
+    Return GeoJSON content of a file if it is a FeatureCollection, else None
+    """
+    if pathlib.Path(file).suffix not in ('.json', '.geojson'):
+        return None
+    try:
+        with open(file, 'r') as f:
+            content = json.load(f)
+    except (ValueError, UnicodeDecodeError):
+        return None
+    if isinstance(content, dict) and isinstance(content.get("features"), list):
+        return content
+    return None
+
+
+def compose(tile_paths, path):
+    """
+    Compose prepared tiles into a single job directory: features of GeoJSON
+    files with the same name are merged (features crossing tiles are kept
+    once), other files are kept once and must be identical in every tile.
+    The directory is written aside and renamed into `path` once complete.
+    Tiles are marked as used, see `Collector`.
+    Raise ValueError if other files differ between tiles
+    """
+    if os.path.exists(path):
+        return
+    for tile_path in tile_paths:
+        os.utime(tile_path)
+    tmp = temp_path(path, uuid.uuid4().hex)
+    os.makedirs(tmp, exist_ok=True)
+    try:
+        for filename, (collection, _) in _merge(tile_paths, tmp).items():
+            with open(os.path.join(tmp, filename), 'w') as f:
+                json.dump(collection, f)
+    except Exception:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+    if os.path.exists(path):
+        shutil.rmtree(tmp, ignore_errors=True)
+    else:
+        os.rename(tmp, path)
+
+
+def _merge(tile_paths, tmp):
+    """
+    Copy files of tiles other than GeoJSON in `tmp`, return GeoJSON
+    collections by filename with the keys of their features
+    """
+    merged, copied = {}, {}
+    for tile_path in tile_paths:
+        for filename in sorted(os.listdir(tile_path)):
+            file = os.path.join(tile_path, filename)
+            if not os.path.isfile(file):
+                continue
+            content = _read_features(file)
+            if content is None:
+                sha = file_hash(file)
+                if filename not in copied:
+                    shutil.copyfile(file, os.path.join(tmp, filename))
+                    copied[filename] = sha
+                elif copied[filename] != sha:
+                    raise ValueError(f'{filename} differs between tiles, '
+                                     'it cannot be composed')
+                continue
+            features = content["features"]
+            if filename not in merged:
+                content["features"] = []
+                merged[filename] = (content, set())
+            collection, seen = merged[filename]
+            for feature in features:
+                key = json.dumps(feature, sort_keys=True)
+                if key not in seen:
+                    seen.add(key)
+                    collection["features"].append(feature)
+    return merged
+
+
+def prepare_tiled(queue, name, x1, y1, x2, y2, crs, path,
+                  tile_size=TILE_SIZE, tiles_path=TILES_PATH, callback=None,
+                  errback=None):
+    """
+    Prepare a bbox by tiles snapped on a LAMBERT grid of `tile_size` meters.
+    Tiles are cached in `tiles_path` and shared between requests, only
+    missing ones are submitted to the `queue`. Once all tiles are prepared
+    they are composed in `path` and `callback` is called with
+    {name, tiles, cached}. When every tile is already cached, they are
+    composed and `callback` is called before returning, with `cached` True.
+    If a tile or the composition fails, `errback` is called with
+    {name, error}.
+    Return the list of submitted tile job infos, or None if the queue is full
+    """
+    indexes = snap(canonical_bbox(x1, y1, x2, y2, crs), tile_size)
+    tiles = cover(indexes, tile_size)
+    tile_paths = [os.path.join(tiles_path, t["name"]) for t in tiles]
+    os.makedirs(tiles_path, exist_ok=True)
+
+    submitted = []
+    for tile, tile_path in zip(tiles, tile_paths):
+        cached = os.path.exists(tile_path)
+        metrics.cache('tile', cached)
+        if cached:
+            continue
+        info = queue.submit(tile["name"], *tile["bounds"], crs="EPSG:2154",
+                            path=tile_path)
+        if info is None:
+            return None
+        submitted.append(info)
+
+    if not submitted:
+        compose(tile_paths, path)
+        if callback is not None:
+            callback({"name": name, "tiles": len(tiles), "cached": True})
+        return submitted
+
+    lock = threading.Lock()
+    remaining = [len(submitted)]
+    failed = []
+
+    def _failed(error):
+        logger.error(f'{name} not composed: {error}')
+        if errback is not None:
+            errback({"name": name, "error": error})
+
+    def _tile_done(future):
+        info = future.result()
+        with lock:
+            remaining[0] -= 1
+            if info["state"] != "DONE":
+                failed.append(info["name"])
+            last = remaining[0] == 0
+        if not last:
+            return
+        if failed:
+            _failed(f'tiles failed: {failed}')
+            return
+        try:
+            compose(tile_paths, path)
+        except Exception as f:
+            _failed(f'composition failed: {f}')
+            return
+        logger.info(f'{name} composed from {len(tiles)} tiles')
+        if callback is not None:
+            callback({"name": name, "tiles": len(tiles), "cached": False})
+
+    for info in submitted:
+        future = queue.future(info["job_id"])
+        if future is None:
+            # Already finished
+            future = Future()
+            future.set_result(queue.get(info["job_id"]))
+        future.add_done_callback(_tile_done)
+    return submitted
+
+
+def _point_in_polygon(x, y, ring):
+    inside = False
+    for (xa, ya), (xb, yb) in zip(ring, ring[1:] + ring[:1]):
+        if (ya > y) != (yb > y) and x < xa + (y - ya) * (xb - xa) / (yb - ya):
+            inside = not inside
+    return inside
+
+
+def _segments_intersect(p1, p2, q1, q2):
+    def orientation(a, b, c):
+        return (b[0] - a[0]) * (c[1] - a[1]) - (b[1] - a[1]) * (c[0] - a[0])
+    d1, d2 = orientation(q1, q2, p1), orientation(q1, q2, p2)
+    d3, d4 = orientation(p1, p2, q1), orientation(p1, p2, q2)
+    return d1 * d2 <= 0 and d3 * d4 <= 0
+
+
+def _box_intersects_polygon(bounds, ring):
+    xmin, ymin, xmax, ymax = bounds
+    corners = [(xmin, ymin), (xmax, ymin), (xmax, ymax), (xmin, ymax)]
+    if any(_point_in_polygon(x, y, ring) for x, y in corners):
+        return True
+    if any(xmin <= x <= xmax and ymin <= y <= ymax for x, y in ring):
+        return True
+    box_edges = list(zip(corners, corners[1:] + corners[:1]))
+    return any(_segments_intersect(a, b, c, d) for a, b in box_edges
+               for c, d in zip(ring, ring[1:] + ring[:1]))
+
+
+def cover_polygon(points, crs=None, tile_size=TILE_SIZE):
+    """
+    List tiles of the LAMBERT grid intersecting a polygon given as a list
+    of (x, y) points in `crs` axis order
+    """
+    xs, ys = transform([p[0] for p in points], [p[1] for p in points], crs)
+    ring = list(zip(xs, ys))
+    indexes = snap((min(xs), min(ys), max(xs), max(ys)), tile_size)
+    return [t for t in cover(indexes, tile_size)
+            if _box_intersects_polygon(t["bounds"], ring)]
@@ -0,0 +1,325 @@
+import os
+import sys
+import time
+import uuid
+import queue
+import shutil
+import pathlib
+import logging
+import threading
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import metrics
+from projection import to_lambert
+
+logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+logger = logging.getLogger('worker')
+
+
+def temp_path(path, job_id):
+    """
+    Hidden sibling of `path` where data is written before being committed
+    """
+    path = pathlib.Path(path)
+    return str(path.parent / f'.{path.name}.{job_id}.tmp')
+
+
+def _serve(conn, max_jobs):
+    """
+    Loop of a warm worker process: the geospatial stack is imported once,
+    then bboxes received on `conn` are prepared until `max_jobs` is reached.
+    For each task, None is sent back on success, else the error message
+    """
+    load_error = None
+    try:
+        from prepare_data import utils
+        from prepare_data.main import main
+    except Exception as f:
+        load_error = f"prepare_data can not be loaded: {f!r}"
+
+    for _ in range(max_jobs):
+        task = conn.recv()
+        if task is None:
+            break
+        if load_error is not None:
+            conn.send(load_error)
+            continue
+        x1, y1, x2, y2, crs, path = task
+        try:
+            polygon = utils.convert2poly(*to_lambert(x1, y1, x2, y2, crs))
+            main(polygon, pathlib.Path(path))
+            conn.send(None)
+        except Exception as f:
+            conn.send(repr(f))
+    conn.close()
+
+
+class WarmWorker:
+    def __init__(self, max_jobs, context):
+        """
+        Long-lived process with `prepare_data` already imported,
+        recycled after `max_jobs` jobs
+        """
+        self.max_jobs = max_jobs
+        self.jobs = 0
+        self.conn, child = context.Pipe()
+        self.process = context.Process(target=_serve, args=(child, max_jobs),
+                                       daemon=True)
+        self.process.start()
+        child.close()
+
+    def run(self, params):
+        """
+        Prepare a bbox, return None on success else the error message
+        """
+        self.jobs += 1
+        try:
+            self.conn.send(params)
+            return self.conn.recv()
+        except (EOFError, OSError) as f:
+            return f"worker {self.process.pid} died: {f!r}"
+
+    @property
+    def expired(self):
+        return self.jobs >= self.max_jobs or not self.process.is_alive()
+
+    def stop(self):
+        try:
+            if self.process.is_alive():
+                self.conn.send(None)
+        except (EOFError, OSError):
+            pass
+        self.process.join(timeout=5)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.conn.close()
+
+
+class PrepareQueue:
+    def __init__(self, max_workers=None, max_queue=None, max_jobs=None,
+                 history=1000):
+        """
+        Bounded local pool running `prepare_data` outside of the request thread
+
+        Jobs are run in a pool of `max_workers` warm processes which import
+        `prepare_data` once and are recycled after `max_jobs` jobs to bound
+        memory growth. Other jobs wait in the queue, and new submissions are
+        refused once `max_queue` jobs are waiting.
+
+        Usage example:
+            queue = PrepareQueue(max_workers=2)
+            queue.start()
+            info = queue.submit('name', 48.8644, 2.3977, 48.8655, 2.3994,
+                                crs='EPSG:4326', path='/data/jobs/name')
+            queue.get(info['job_id'])
+
+        Parameters
+        ----------
+        max_workers: int, number of jobs prepared in parallel,
+                     default env `PREPARE_WORKERS` or 2
+        max_queue: int, number of jobs allowed to wait for a worker,
+                   default env `PREPARE_MAX_QUEUE` or 100
+        max_jobs: int, number of jobs before a worker process is replaced,
+                  default env `PREPARE_MAX_JOBS_PER_WORKER` or 50
+        history: int, number of finished jobs kept for polling
+        """
+        self.max_workers = max_workers if max_workers is not None \
+            else int(os.getenv('PREPARE_WORKERS', 2))
+        self.max_queue = max_queue if max_queue is not None \
+            else int(os.getenv('PREPARE_MAX_QUEUE', 100))
+        self.max_jobs = max_jobs if max_jobs is not None \
+            else int(os.getenv('PREPARE_MAX_JOBS_PER_WORKER', 50))
+        self.history = history
+        self.context = multiprocessing.get_context(
+            os.getenv('PREPARE_START_METHOD', 'spawn'))
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                           thread_name_prefix='prepare')
+        self.lock = threading.Lock()
+        self.jobs = OrderedDict()
+        self.inflight = {}
+        self.callbacks = {}
+        self.futures = {}
+        self.listeners = []
+        self.workers = None
+
+    def start(self):
+        """
+        Pre-fork the warm worker processes
+        """
+        with self.lock:
+            if self.workers is not None:
+                return
+            self.workers = queue.Queue()
+            for _ in range(self.max_workers):
+                self.workers.put(WarmWorker(self.max_jobs, self.context))
+        logger.info(f'{self.max_workers} prepare workers started')
+
+    def _prepare(self, params):
+        """
+        Run a job on an idle warm worker, replace the worker when expired
+        """
+        worker = self.workers.get()
+        try:
+            return worker.run(params)
+        finally:
+            if worker.expired:
+                worker.stop()
+                worker = WarmWorker(self.max_jobs, self.context)
+            self.workers.put(worker)
+
+    def add_listener(self, listener):
+        """
+        Call `listener` with job info on each state change of a job
+        """
+        self.listeners.append(listener)
+
+    def _notify(self, info):
+        for listener in self.listeners:
+            try:
+                listener(dict(info))
+            except Exception as f:
+                logger.error(f'Listener failed for {info["name"]}: {f}')
+
+    def _count(self, state):
+        return sum(1 for j in self.jobs.values() if j["state"] == state)
+
+    def _prune(self):
+        """
+        Forget oldest finished jobs above history size
+        """
+        finished = [k for k, j in self.jobs.items()
+                    if j["state"] in ('DONE', 'FAILED')]
+        for k in finished[:max(0, len(finished) - self.history)]:
+            del self.jobs[k]
+
+    def submit(self, name, x1, y1, x2, y2, crs, path, callback=None):
+        """
+        Enqueue preparation of a bbox in `path`. `callback` is called with the
+        job info once data is successfully prepared.
+        A job already queued or running with the same `name` is shared: its
+        info is returned and `callback` is attached to it.
+        Return job info or None if the queue is full
+        """
+        with self.lock:
+            if name in self.inflight:
+                job_id = self.inflight[name]
+                if callback is not None:
+                    self.callbacks[job_id].append(callback)
+                logger.info(f'{name} already in flight, attached to {job_id}')
+                return dict(self.jobs[job_id])
+            if self._count('QUEUED') >= self.max_queue:
+                logger.warning(f'Prepare queue is full, {name} refused')
+                return None
+            job_id = uuid.uuid4().hex
+            info = {"job_id": job_id,
+                    "name": name,
+                    "state": "QUEUED",
+                    "submitted_at": time.time(),
+                    "started_at": None,
+                    "finished_at": None,
+                    "wait_time": None,
+                    "run_time": None,
+                    "error": None}
+            self.jobs[job_id] = info
+            self.inflight[name] = job_id
+            self.callbacks[job_id] = [callback] if callback is not None else []
+            self.futures[job_id] = Future()
+            self._prune()
+        self._notify(info)
+        self.executor.submit(self._run, info, [x1, y1, x2, y2, crs, path])
+        return dict(info)
+
+    @staticmethod
+    def _commit(tmp, path):
+        """
+        Move prepared data from `tmp` to `path` in one rename so that a
+        partially written directory is never visible under `path`
+        """
+        if not os.path.isdir(tmp):
+            return f"prepare_data did not write any data in {tmp}"
+        if os.path.exists(path):
+            shutil.rmtree(tmp, ignore_errors=True)
+            return None
+        os.rename(tmp, path)
+        return None
+
+    def _run(self, info, params):
+        self.start()
+        with self.lock:
+            info["state"] = "RUNNING"
+            info["started_at"] = time.time()
+            info["wait_time"] = info["started_at"] - info["submitted_at"]
+        self._notify(info)
+        path = params[-1]
+        tmp = temp_path(path, info["job_id"])
+        try:
+            error = self._prepare(params[:-1] + [tmp])
+            if error is None:
+                error = self._commit(tmp, path)
+        except Exception as f:
+            error = repr(f)
+        if error is not None:
+            shutil.rmtree(tmp, ignore_errors=True)
+        with self.lock:
+            info["finished_at"] = time.time()
+            info["run_time"] = info["finished_at"] - info["started_at"]
+            info["state"] = "FAILED" if error else "DONE"
+            info["error"] = error
+            del self.inflight[info["name"]]
+            callbacks = self.callbacks.pop(info["job_id"])
+            future = self.futures.pop(info["job_id"])
+        metrics.observe('prepare_wait', info["wait_time"])
+        metrics.observe('prepare', info["run_time"], 'error' if error else 'ok')
+        logger.info(f'{info["name"]} prepared in {info["run_time"]:.1f}s '
+                    f'(waited {info["wait_time"]:.1f}s): {info["state"]}')
+        self._notify(info)
+        if error is None:
+            for callback in callbacks:
+                try:
+                    callback(dict(info))
+                except Exception as f:
+                    logger.error(f'Callback failed for {info["name"]}: {f}')
+        future.set_result(dict(info))
+
+    def names(self):
+        """
+        Names of jobs queued or running
+        """
+        with self.lock:
+            return set(self.inflight)
+
+    def future(self, job_id):
+        """
+        Get a future resolved with the job info once it is finished,
+        whatever its state. Return None for unknown or already finished jobs
+        """
+        with self.lock:
+            return self.futures.get(job_id)
+
+    def get(self, job_id):
+        """
+        Get info and timings of a job
+        """
+        with self.lock:
+            info = self.jobs.get(job_id)
+            return dict(info) if info is not None else None
+
+    def stats(self):
+        """
+        Get queue depth and number of running jobs
+        """
+        with self.lock:
+            return {"max_workers": self.max_workers,
+                    "max_queue": self.max_queue,
+                    "queued": self._count('QUEUED'),
+                    "running": self._count('RUNNING'),
+                    "done": self._count('DONE'),
+                    "failed": self._count('FAILED')}
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
+        if self.workers is not None:
+            while not self.workers.empty():
+                self.workers.get().stop()
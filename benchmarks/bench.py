@@ -0,0 +1,265 @@
+"""
+Load test of the backend request path against local stand-ins: a moto S3
+server, an in-memory kubernetes API and a `prepare_data` stub sleeping
+`--prepare-seconds`. `/generate/`, `/status` and `/list` are called by
+`--clients` concurrent clients and latency percentiles and throughput are
+written as a JSON report. With `--baseline`, the run fails when a scenario
+is slower than the baseline report by more than `--tolerance`.
+
+Usage example:
+    python benchmarks/bench.py --clients 16 --requests 500 --output report.json
+    python benchmarks/bench.py --baseline report.json --tolerance 0.2
+"""
+import os
+import sys
+import json
+import time
+import random
+import socket
+import asyncio
+import logging
+import argparse
+import tempfile
+import threading
+import platform
+
+import httpx
+import uvicorn
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'app'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fakes import FakeBatchApi, FakeCoreApi, write_prepare_data
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    k = (len(values) - 1) * q
+    f = int(k)
+    c = min(f + 1, len(values) - 1)
+    return values[f] + (values[c] - values[f]) * (k - f)
+
+
+def summary(latencies, errors, seconds):
+    stats = {"requests": len(latencies),
+             "errors": errors,
+             "seconds": round(seconds, 3),
+             "throughput": round(len(latencies) / seconds, 2) if seconds else None}
+    if latencies:
+        stats["mean"] = round(sum(latencies) / len(latencies), 5)
+        for q in (0.5, 0.9, 0.99):
+            stats[f"p{int(q * 100)}"] = round(percentile(latencies, q), 5)
+        stats["max"] = round(max(latencies), 5)
+    return stats
+
+
+async def load(client, urls, clients):
+    """
+    Call `urls` with `clients` concurrent clients.
+    Return (latencies, number of errors, seconds, json responses)
+    """
+    latencies, responses, errors = [], [], [0]
+    pending = iter(urls)
+
+    async def _client():
+        for url in pending:
+            start = time.perf_counter()
+            try:
+                response = await client.get(url)
+                body = response.json()
+                ok = response.status_code == 200 and \
+                    (not isinstance(body, dict) or body.get("code", 200) < 500)
+            except (httpx.HTTPError, ValueError):
+                body, ok = None, False
+            latencies.append(time.perf_counter() - start)
+            responses.append(body)
+            errors[0] += not ok
+
+    start = time.perf_counter()
+    await asyncio.gather(*[_client() for _ in range(clients)])
+    return latencies, errors[0], time.perf_counter() - start, responses
+
+
+def start_stand_ins(args, workdir):
+    """
+    Start moto S3 server and set the environment of the app to use it
+    """
+    from moto.server import ThreadedMotoServer
+
+    port = _free_port()
+    s3_server = ThreadedMotoServer(ip_address='127.0.0.1', port=port)
+    s3_server.start()
+    os.environ.update({
+        "ENDPOINT": f"http://127.0.0.1:{port}",
+        "AWS_ACCESS_KEY_ID": "bench",
+        "AWS_SECRET_ACCESS_KEY": "bench",
+        "AWS_DEFAULT_REGION": "us-east-1",
+        "JOBS_PATH": os.path.join(workdir, 'jobs'),
+        "TILES_PATH": os.path.join(workdir, 'tiles'),
+        "CATALOG_PATH": os.path.join(workdir, 'catalog.sqlite'),
+        "ARTIFACTS_PATH": os.path.join(workdir, 'artifacts'),
+        "JOB_INPUT_MODE": "configmap",
+        "BENCH_PREPARE_SECONDS": str(args.prepare_seconds),
+        "PREPARE_WORKERS": str(args.prepare_workers),
+        "PREPARE_MAX_QUEUE": str(max(100, args.distinct))})
+    os.makedirs(os.environ["JOBS_PATH"], exist_ok=True)
+    # Spawned prepare workers inherit sys.path
+    sys.path.insert(0, write_prepare_data(os.path.join(workdir, 'stub')))
+    return s3_server
+
+
+def start_app(args):
+    """
+    Import the app with fake kubernetes clients and serve it with uvicorn
+    """
+    import kube
+    import main
+
+    kube._clients.update({
+        "api": None,
+        "BatchV1Api": FakeBatchApi(main.informer, args.job_seconds, args.kube_latency),
+        "CoreV1Api": FakeCoreApi(args.kube_latency)})
+    # The fake API pushes job status to the informer cache
+    main.informer.start = main.informer.synced.set
+    # A few districts already generated in object storage
+    for i in range(0, args.distinct, 10):
+        main.s3.client.create_bucket(Bucket=main._job_name(*bbox(i), "EPSG:2154"))
+
+    port = _free_port()
+    server = uvicorn.Server(uvicorn.Config(main.app, host='127.0.0.1', port=port,
+                                           log_level='warning', access_log=False))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+    return server, thread, f'http://127.0.0.1:{port}'
+
+
+def bbox(i):
+    """
+    i-th distinct bbox of 300m in LAMBERT around Paris
+    """
+    x, y = 649000 + (i % 50) * 300, 6860000 + (i // 50) * 300
+    return x, y, x + 300, y + 300
+
+
+async def run(args, base_url):
+    report = {}
+    limits = httpx.Limits(max_connections=args.clients)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits,
+                                 timeout=args.timeout) as client:
+        rng = random.Random(args.seed)
+        indexes = [rng.randrange(args.distinct) for _ in range(args.requests)]
+        urls = ['/generate/?x1={}&y1={}&x2={}&y2={}&crs=EPSG:2154&job={}'.format(
+            *bbox(i), str(args.job).lower()) for i in indexes]
+        latencies, errors, seconds, responses = await load(client, urls, args.clients)
+        report["generate"] = summary(latencies, errors, seconds)
+
+        # Time until every preparation is finished
+        start = time.perf_counter()
+        while True:
+            queue = (await client.get('/queue')).json()
+            if queue["queued"] + queue["running"] == 0:
+                break
+            await asyncio.sleep(0.1)
+        report["prepare_drain"] = {"seconds": round(time.perf_counter() - start, 3),
+                                   **queue}
+
+        names = [r["job_name"] for r in responses if isinstance(r, dict) and "job_name" in r]
+        if names:
+            urls = [f'/status/{rng.choice(names)}' for _ in range(args.requests)]
+            latencies, errors, seconds, _ = await load(client, urls, args.clients)
+            report["status"] = summary(latencies, errors, seconds)
+
+        urls = [f'/list?limit=100&offset={rng.randrange(max(1, args.distinct))}'
+                for _ in range(args.requests)]
+        latencies, errors, seconds, _ = await load(client, urls, args.clients)
+        report["list"] = summary(latencies, errors, seconds)
+    return report
+
+
+def compare(report, baseline, tolerance):
+    """
+    List regressions of p50/p99 latency and throughput against a baseline
+    """
+    regressions = []
+    for scenario, stats in report["scenarios"].items():
+        base = baseline.get("scenarios", {}).get(scenario)
+        if not base or "throughput" not in stats:
+            continue
+        for key in ('p50', 'p99'):
+            if base.get(key) and stats.get(key) and stats[key] > base[key] * (1 + tolerance):
+                regressions.append(f'{scenario} {key} {stats[key]}s > {base[key]}s')
+        if base.get("throughput") and stats.get("throughput") and \
+                stats["throughput"] < base["throughput"] * (1 - tolerance):
+            regressions.append(f'{scenario} throughput {stats["throughput"]}/s '
+                               f'< {base["throughput"]}/s')
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--clients', type=int, default=16, help='concurrent clients')
+    parser.add_argument('--requests', type=int, default=200, help='requests per scenario')
+    parser.add_argument('--distinct', type=int, default=50, help='distinct bboxes')
+    parser.add_argument('--prepare-seconds', type=float, default=0.5,
+                        help='duration of the prepare_data stub')
+    parser.add_argument('--prepare-workers', type=int, default=2)
+    parser.add_argument('--job', action='store_true', help='launch unity jobs')
+    parser.add_argument('--job-seconds', type=float, default=2.0,
+                        help='duration of fake unity jobs')
+    parser.add_argument('--kube-latency', type=float, default=0.01,
+                        help='seconds per fake kubernetes API call')
+    parser.add_argument('--timeout', type=float, default=60)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='JSON report file, default stdout')
+    parser.add_argument('--baseline', help='JSON report to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.disable(logging.INFO)
+    with tempfile.TemporaryDirectory(prefix='bench-') as workdir:
+        s3_server = start_stand_ins(args, workdir)
+        server, thread, base_url = start_app(args)
+        try:
+            scenarios = asyncio.run(run(args, base_url))
+        finally:
+            server.should_exit = True
+            thread.join(timeout=10)
+            s3_server.stop()
+    report = {"config": {k: v for k, v in vars(args).items()
+                         if k not in ('output', 'baseline')},
+              "python": platform.python_version(),
+              "created_at": time.time(),
+              "scenarios": scenarios}
+
+    content = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(content)
+    else:
+        print(content)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f'REGRESSION {regression}', file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
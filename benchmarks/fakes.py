@@ -0,0 +1,172 @@
+import os
+import copy
+import json
+import time
+import datetime
+import threading
+from kubernetes import client
+
+PREPARE_DATA = {
+    "__init__.py": "",
+    "utils.py": '''
+def convert2poly(x1, y1, x2, y2):
+    return [(x1, y1), (x2, y1), (x2, y2), (x1, y2), (x1, y1)]
+''',
+    "main.py": '''
+import os
+import json
+import time
+
+SECONDS = float(os.getenv("BENCH_PREPARE_SECONDS", 1))
+
+
+def main(polygon, path):
+    time.sleep(SECONDS)
+    path.mkdir(parents=True, exist_ok=True)
+    feature = {"type": "Feature", "properties": {},
+               "geometry": {"type": "Polygon", "coordinates": [polygon]}}
+    with open(path / "buildings.geojson", "w") as f:
+        json.dump({"type": "FeatureCollection", "features": [feature]}, f)
+'''}
+
+
+def write_prepare_data(directory):
+    """
+    Write a `prepare_data` package in `directory` whose `main` sleeps
+    env `BENCH_PREPARE_SECONDS` and writes one GeoJSON file
+    """
+    package = os.path.join(directory, 'prepare_data')
+    os.makedirs(package, exist_ok=True)
+    for filename, content in PREPARE_DATA.items():
+        with open(os.path.join(package, filename), 'w') as f:
+            f.write(content.lstrip())
+    return directory
+
+
+def _error(status, reason, kind, name):
+    error = client.rest.ApiException(status=status, reason=reason)
+    error.body = json.dumps({"kind": "Status", "status": "Failure", "reason": reason,
+                             "message": f'{kind} "{name}" {reason}', "code": status})
+    return error
+
+
+class FakeCoreApi:
+    def __init__(self, latency=0.0):
+        """
+        In-memory kubernetes CoreV1Api for configmaps, each call takes `latency`
+        seconds like a round trip to the API server
+        """
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.configmaps = {}
+
+    def read_namespaced_config_map(self, name, namespace):
+        time.sleep(self.latency)
+        with self.lock:
+            if (namespace, name) not in self.configmaps:
+                raise _error(404, 'NotFound', 'configmaps', name)
+            return copy.deepcopy(self.configmaps[namespace, name])
+
+    def create_namespaced_config_map(self, namespace, body):
+        time.sleep(self.latency)
+        with self.lock:
+            if (namespace, body.metadata.name) in self.configmaps:
+                raise _error(409, 'AlreadyExists', 'configmaps', body.metadata.name)
+            self.configmaps[namespace, body.metadata.name] = body
+            return body
+
+    def patch_namespaced_config_map(self, name, namespace, body):
+        time.sleep(self.latency)
+        with self.lock:
+            if (namespace, name) not in self.configmaps:
+                raise _error(404, 'NotFound', 'configmaps', name)
+            obj = self.configmaps[namespace, name]
+            obj.metadata.annotations = {**(obj.metadata.annotations or {}),
+                                        **body["metadata"]["annotations"]}
+            for attr, key in (('data', 'data'), ('binary_data', 'binaryData')):
+                values = {**(getattr(obj, attr) or {}), **(body.get(key) or {})}
+                setattr(obj, attr, {k: v for k, v in values.items() if v is not None})
+            return obj
+
+    def delete_namespaced_config_map(self, name, namespace, **kwargs):
+        time.sleep(self.latency)
+        with self.lock:
+            if self.configmaps.pop((namespace, name), None) is None:
+                raise _error(404, 'NotFound', 'configmaps', name)
+
+    def list_namespaced_config_map(self, namespace, label_selector=None,
+                                   field_selector=None):
+        time.sleep(self.latency)
+        with self.lock:
+            items = [o for (ns, _), o in self.configmaps.items() if ns == namespace]
+        if label_selector:
+            key, _, value = label_selector.partition('=')
+            items = [o for o in items if (o.metadata.labels or {}).get(key) == value]
+        return client.V1ConfigMapList(items=items, metadata=client.V1ListMeta())
+
+
+class FakeBatchApi:
+    def __init__(self, informer=None, job_seconds=1.0, latency=0.0):
+        """
+        In-memory kubernetes BatchV1Api: created jobs are active then complete
+        after `job_seconds`. Status changes are pushed to the `informer` cache
+        as its watch would do
+        """
+        self.informer = informer
+        self.job_seconds = job_seconds
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.jobs = {}
+
+    def _notify(self, job):
+        if self.informer is not None:
+            self.informer._set(job.metadata.name, self.informer._status(job))
+
+    def _complete(self, namespace, name):
+        with self.lock:
+            job = self.jobs.get((namespace, name))
+            if job is None:
+                return
+            now = datetime.datetime.now(datetime.timezone.utc)
+            job.status = client.V1JobStatus(
+                succeeded=1, start_time=job.status.start_time, completion_time=now,
+                conditions=[client.V1JobCondition(type='Complete', status='True')])
+        self._notify(job)
+
+    def create_namespaced_job(self, body, namespace):
+        time.sleep(self.latency)
+        name = body.metadata.name
+        with self.lock:
+            if (namespace, name) in self.jobs:
+                raise _error(409, 'AlreadyExists', 'jobs', name)
+            body.status = client.V1JobStatus(
+                active=1, start_time=datetime.datetime.now(datetime.timezone.utc))
+            self.jobs[namespace, name] = body
+        self._notify(body)
+        timer = threading.Timer(self.job_seconds, self._complete, [namespace, name])
+        timer.daemon = True
+        timer.start()
+        return body
+
+    def read_namespaced_job_status(self, name, namespace):
+        time.sleep(self.latency)
+        with self.lock:
+            if (namespace, name) not in self.jobs:
+                raise _error(404, 'NotFound', 'jobs', name)
+            return self.jobs[namespace, name]
+
+    def delete_namespaced_job(self, name, namespace, body=None):
+        time.sleep(self.latency)
+        with self.lock:
+            if self.jobs.pop((namespace, name), None) is None:
+                raise _error(404, 'NotFound', 'jobs', name)
+        if self.informer is not None:
+            self.informer._set(name, None)
+        return client.V1Status(status='Success')
+
+    def list_namespaced_job(self, namespace, label_selector=None, **kwargs):
+        time.sleep(self.latency)
+        with self.lock:
+            items = [j for (ns, _), j in self.jobs.items() if ns == namespace]
+        return client.V1JobList(items=items,
+                                metadata=client.V1ListMeta(resource_version='1'))
@@ -0,0 +1,61 @@
+import os
+import time
+
+import artifacts
+from artifacts import ArtifactStore
+
+
+def _job(path, content):
+    os.makedirs(path)
+    (path / 'shared.json').write_text('{"type": "FeatureCollection"}' * 100)
+    (path / 'own.bin').write_bytes(content)
+    return path
+
+
+def test_dedupe_and_materialize(tmp_path):
+    store = ArtifactStore(str(tmp_path / 'store'), grace=0)
+    store.put('a', str(_job(tmp_path / 'a', b'\x00a')))
+    report = store.put('b', str(_job(tmp_path / 'b', b'\x00b')))
+    assert (report["files"], report["new_files"]) == (2, 1)
+    assert store.stats()["blobs"] == 3
+
+    assert store.materialize('b', str(tmp_path / 'copy'))
+    assert (tmp_path / 'copy' / 'own.bin').read_bytes() == b'\x00b'
+    assert not store.materialize('c', str(tmp_path / 'none'))
+
+    store.delete('a')
+    assert store.stats()["blobs"] == 2
+    # Index rebuilt from disk
+    assert ArtifactStore(str(tmp_path / 'store')).has('b')
+
+
+def test_evict_least_recently_used(tmp_path, monkeypatch):
+    monkeypatch.setattr(artifacts, 'zstandard', None)
+    store = ArtifactStore(str(tmp_path / 'store'), grace=0)
+    for name in ('a', 'b', 'c'):
+        store.put(name, str(_job(tmp_path / name, os.urandom(1000))))
+    past = time.time() - 100
+    os.utime(store._manifest_path('b'), (past, past))
+    store.max_bytes = store.size() - 1
+    assert store.evict() == ['b']
+    assert store.has('a') and store.has('c')
+
+
+def test_prune_by_last_use(tmp_path):
+    store = ArtifactStore(str(tmp_path / 'store'), grace=0)
+    jobs = tmp_path / 'jobs'
+    for name in ('stored', 'used', 'unstored', 'launching'):
+        _job(jobs / name, name.encode())
+    for name in ('stored', 'used', 'launching'):
+        store.put(name, str(jobs / name))
+    past = time.time() - 100
+    for name in ('stored', 'unstored', 'launching'):
+        os.utime(jobs / name, (past, past))
+        if name != 'unstored':
+            os.utime(store._manifest_path(name), (past, past))
+    # Directory untouched but job stored long ago, then used recently
+    os.utime(jobs / 'used', (past, past))
+    store.touch('used')
+    # Not in store, it could not be materialized again
+    assert store.prune(str(jobs), 10, in_use={'launching'}) == ['stored']
+    assert sorted(os.listdir(jobs)) == ['launching', 'unstored', 'used']
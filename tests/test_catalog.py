@@ -0,0 +1,20 @@
+from catalog import Catalog
+
+
+def test_catalog():
+    catalog = Catalog(':memory:')
+    catalog.upsert('a', state='QUEUED', xmin=0, ymin=0, xmax=100, ymax=100)
+    catalog.upsert('b', state='PREPARED', xmin=50, ymin=50, xmax=200, ymax=200)
+    assert catalog.update('a', state='PREPARED', size_bytes=10)
+    assert not catalog.update('c', state='PREPARED')
+
+    total, items = catalog.list(limit=1, state='PREPARED', order='name', desc=False)
+    assert total == 2 and [i["name"] for i in items] == ['a']
+
+    assert [j["name"] for j in catalog.covering(10, 10, 10, 10)] == ['a']
+    assert len(catalog.covering(60, 60, 70, 70)) == 2
+    assert len(catalog.covering(90, 90, 250, 250)) == 0
+    assert len(catalog.covering(90, 90, 250, 250, contains=False)) == 2
+
+    assert catalog.delete('a')
+    assert catalog.covering(10, 10, 10, 10) == []
@@ -0,0 +1,66 @@
+import time
+
+import pytest
+
+from catalog import Catalog
+from collector import Collector, RateLimiter, valid_name
+
+
+def test_plan():
+    collector = Collector('twincity', '/nonexistent', None, ttl=1000, grace=60,
+                          tiles_ttl=100, temp_ttl=600)
+    now = time.time()
+    snapshot = {
+        "jobs": {'running', 'batch'},
+        "in_use": {'running', 'batch', 'a', 'b'},
+        "configmaps": {'running': ('running', now - 100, True),
+                       'gone': ('gone', now - 100, True),
+                       'gone-0': ('gone', now - 100, True),
+                       'new': ('new', now - 10, True),
+                       'old': ('old', now - 100, False),
+                       'licence': ('licence', now - 10000, False)},
+        "directories": {'old': now - 2000, '.old.x.tmp': now - 1000,
+                        '.new.x.tmp': now - 100, '.preparing.y.tmp': now - 1000},
+        "tiles": {'unused': now - 1000, 'used': now - 10},
+        "preparing": {'preparing'},
+        "inputs": {'a': now - 100, 'c': now - 100},
+        "buckets": {'old', 'other'},
+        "catalog": {'old': ('FINISHED', now - 2000), 'queued': ('QUEUED', now - 2000),
+                    'gone': ('PREPARED', now - 10), 'lost': ('LAUNCHED', now - 2000),
+                    'running': ('LAUNCHED', now - 2000)}}
+    plan = collector.plan(snapshot, now)
+    assert plan["configmap"] == ['gone', 'gone-0', 'old']
+    assert plan["input"] == ['c']
+    assert plan["directory"] == ['old', '.old.x.tmp']
+    assert plan["bucket"] == ['old'] and plan["catalog"] == ['lost', 'old']
+    assert plan["tile"] == ['unused']
+
+
+def test_delete_local(tmp_path):
+    catalog = Catalog(':memory:')
+    catalog.upsert('a', state='PREPARED')
+    (tmp_path / 'a').mkdir()
+    collector = Collector('twincity', str(tmp_path), catalog)
+    report = collector.execute({"directory": ['a', 'b'], "catalog": ['a']})
+    assert report == {"deleted": {"directory": ['a'], "catalog": ['a']}, "errors": []}
+    assert not (tmp_path / 'a').exists() and catalog.get('a') is None
+
+
+def test_delete_invalid_names(tmp_path):
+    (tmp_path / 'jobs').mkdir()
+    (tmp_path / 'data').mkdir()
+    collector = Collector('twincity', str(tmp_path / 'jobs'), Catalog(':memory:'))
+    assert valid_name('a' * 40) and valid_name('batch-1')
+    assert not valid_name('../data') and not valid_name('A/b')
+    with pytest.raises(ValueError):
+        collector.delete(['../data'])
+    assert not collector._delete_directory('../data')
+    assert (tmp_path / 'data').exists()
+
+
+def test_rate_limiter():
+    limiter = RateLimiter(50)
+    start = time.monotonic()
+    for _ in range(6):
+        limiter.acquire()
+    assert time.monotonic() - start >= 0.09
@@ -0,0 +1,28 @@
+import base64
+
+from configmap import ConfigMapSecrets
+
+
+def test_read_binary_data(tmp_path):
+    (tmp_path / 'a.json').write_text('{"type": "FeatureCollection"}')
+    (tmp_path / 'b.bin').write_bytes(b'\x00\xff' * 10)
+    data, binary_data = ConfigMapSecrets.read_data_from_file(str(tmp_path))
+    assert data == {'a.json': '{"type": "FeatureCollection"}'}
+    assert base64.b64decode(binary_data['b.bin']) == b'\x00\xff' * 10
+
+
+def test_plan_shards(tmp_path):
+    for i in range(4):
+        (tmp_path / f'{i}.txt').write_text('x' * 100)
+    files = ConfigMapSecrets._check_type(str(tmp_path))
+    assert len(ConfigMapSecrets.plan_shards(files, 1000)) == 1
+    assert len(ConfigMapSecrets.plan_shards(files, 250)) == 2
+
+
+def test_payload_size_binary_after_head(tmp_path):
+    file = tmp_path / 'late.bin'
+    file.write_bytes(b'x' * 9000 + b'\xff')
+    assert ConfigMapSecrets.payload_size(str(file)) == 4 * -(-9001 // 3) + len('late.bin')
+    _, binary_data = ConfigMapSecrets.read_data_from_file(str(file))
+    assert len(binary_data['late.bin']) + len('late.bin') == \
+        ConfigMapSecrets.payload_size(str(file))
@@ -0,0 +1,41 @@
+import threading
+
+from informer import JobInformer
+
+
+def test_wait_status_change():
+    informer = JobInformer(namespace='twincity')
+    informer._set('name', {'name': 'name', 'active': 1})
+    status, version = informer.get('name')
+    assert status['active'] == 1
+
+    threading.Timer(0.1, informer._set, ['name', {'name': 'name', 'succeeded': 1}]).start()
+    status, new_version = informer.wait('name', version, timeout=5)
+    assert new_version > version
+    assert status['succeeded'] == 1
+
+    status, _ = informer.wait('name', new_version, timeout=0.1)
+    assert status['succeeded'] == 1
+
+
+def test_async_wait_status_change():
+    import asyncio
+
+    async def _wait():
+        informer = JobInformer(namespace='twincity')
+        asyncio.get_running_loop().call_later(
+            0.1, informer._set, 'name', {'name': 'name', 'active': 1})
+        return await informer.async_wait('name', 0, timeout=5)
+
+    status, version = asyncio.run(_wait())
+    assert status['active'] == 1 and version == 1
+
+
+def test_wait_deletion():
+    informer = JobInformer(namespace='twincity')
+    informer._set('name', {'name': 'name', 'active': 1})
+    _, version = informer.get('name')
+    threading.Timer(0.1, informer._set, ['name', None]).start()
+    status, new_version = informer.wait('name', version, timeout=5)
+    assert status is None and new_version == 0
+    assert informer.versions == {}
@@ -0,0 +1,49 @@
+from job import Job, JobTemplate
+
+
+def _template():
+    return JobTemplate(image='busybox', cmd='sh', args=['-c', 'ls /input'],
+                       config=['input', 'licence'],
+                       mount_path=['/input', '/licence'],
+                       type_volume=['emptydir', 'secret'],
+                       init_containers=[{"name": "init", "image": "busybox",
+                                         "cmd": "true", "mount_path": ["/input"]}],
+                       pool_name='pool', env={"A": "1"})
+
+
+def test_render_matches_job():
+    template = _template()
+    rendered = template.render('name', env={"B": "2"},
+                               volumes={'/input': (['name-0', 'name-1'], 'configmap')})
+    job = Job('name', image='busybox', cmd='sh', args=['-c', 'ls /input'],
+              config=[['name-0', 'name-1'], 'licence'],
+              mount_path=['/input', '/licence'],
+              type_volume=['configmap', 'secret'],
+              init_containers=[{"name": "init", "image": "busybox",
+                                "cmd": "true", "mount_path": ["/input"]}],
+              pool_name='pool', env={"A": "1", "B": "2"})
+    assert rendered.job.to_dict() == job.job.to_dict()
+    # Template is left untouched
+    assert template.job.metadata.name == 'template'
+    assert template.job.spec.template.spec.volumes[0].empty_dir is not None
+
+
+def test_render_indexed():
+    rendered = _template().render('batch', completions=3, parallelism=2)
+    spec = rendered.job.spec
+    assert (spec.completion_mode, spec.completions, spec.parallelism) == ('Indexed', 3, 2)
+    assert spec.template.spec.containers[0].name == 'batch'
+    assert (spec.backoff_limit_per_index, spec.backoff_limit) == (1, 3)
+
+
+def test_cache_volumes():
+    job = Job('name', image='busybox', cmd='sh', args=['-c', 'true'],
+              config=['unity-cache', '/var/cache/unity'],
+              mount_path=['/cache', '/library'],
+              type_volume=['pvc', 'hostpath'], read_only=True)
+    volumes = job.job.spec.template.spec.volumes
+    mounts = job.job.spec.template.spec.containers[0].volume_mounts
+    assert volumes[0].persistent_volume_claim.claim_name == 'unity-cache'
+    assert volumes[1].host_path.path == '/var/cache/unity'
+    assert [m.name for m in mounts] == ['volume-unity-cache', 'volume-var-cache-unity']
+    assert [m.read_only for m in mounts] == [None, None]
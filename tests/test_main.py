@@ -16,3 +16,39 @@ def test_generate():
     crs = 'EPSG:4326'
     response = client.get(f"/generate/?x1={x1}&y1={y1}&x2={x2}&y2={y2}&job=false&crs={crs}")
     response.json() == {'status': 'OK', 'job_name': '6cc135f46b8a4116edbadbaefe1333197dd8110a', 'url': 'https://6cc135f46b8a4116edbadbaefe1333197dd8110a.s3-website.fr-par.scw.cloud', 'warning': 'no job launched'}
+
+def test_input_volume_s3(tmp_path, monkeypatch):
+    import main
+    name = 'a' * 40
+    (tmp_path / name).mkdir()
+    (tmp_path / name / 'data.geojson').write_text('{}')
+    uploads = []
+    monkeypatch.setattr(main, 'JOBS_PATH', str(tmp_path))
+    monkeypatch.setattr(main, 'JOB_INPUT_MODE', 's3')
+    monkeypatch.setattr(main.s3, 'upload', lambda path, **kwargs: uploads.append(
+        (path, kwargs)) or {"failed": []})
+    config, type_volume, init_containers = main._input_volume(name)
+    assert (config, type_volume) == ("input", "emptydir")
+    assert uploads == [(f"{tmp_path}/{name}",
+                        {"recursive": True, "bucket_name": main.JOB_INPUT_BUCKET,
+                         "prefix": f"inputs/{name}/"})]
+
+    job = main.unity_template('cold').render(
+        name, env={"BUCKET_NAME": name}, volumes={'/input': (config, type_volume)},
+        init_containers=init_containers)
+    pod = job.job.spec.template.spec
+    init = pod.init_containers[0]
+    assert init.name == 'download-input'
+    assert f"s3://{main.JOB_INPUT_BUCKET}/inputs/$BUCKET_NAME /input" in init.args[-1]
+    assert {e.name: e.value for e in init.env}["BUCKET_NAME"] == name
+    mount = next(m for m in init.volume_mounts if m.mount_path == '/input')
+    volume = next(v for v in pod.volumes if v.name == mount.name)
+    assert volume.empty_dir is not None
+    assert any(m.name == mount.name for m in pod.containers[0].volume_mounts)
+
+def test_warm_profile_needs_image(monkeypatch):
+    import main
+    monkeypatch.setattr(main, 'UNITY_WARM_IMAGE', None)
+    response = client.get("/generate/?x1=48.8644&y1=2.3977&x2=48.8655&y2=2.3994&profile=warm")
+    assert response.json() == {"status": "KO", "code": 400,
+                               "reason": "UNITY_WARM_IMAGE must be set for the warm profile"}
@@ -0,0 +1,17 @@
+import pytest
+
+import metrics
+
+
+def test_timed_stages():
+    token = metrics.start_request()
+    with metrics.timed('stage'):
+        pass
+    with pytest.raises(ValueError):
+        with metrics.timed('failing'):
+            raise ValueError()
+    timings = metrics._timings.get()
+    metrics.end_request(token, '/route', 'GET', 200, 0.1)
+    assert set(timings) == {'stage', 'failing'}
+    assert metrics.STAGE_SECONDS.labels('failing', 'error')._sum.get() >= 0
+    assert metrics._timings.get() is None
@@ -0,0 +1,38 @@
+import asyncio
+
+from progress import Progress, job_stage
+
+
+def test_job_stage():
+    assert job_stage({}) is None
+    assert job_stage({"kind": "Status", "code": 404}) is None
+    assert job_stage({"active": 1, "ready": 0}) == 'pending'
+    assert job_stage({"active": 1, "ready": 1}) == 'running'
+    assert job_stage({"conditions": [{"type": "Failed", "status": "True"}]}) == 'failed'
+    assert job_stage({"succeeded": 1,
+                      "conditions": [{"type": "Complete", "status": "True"}]}) == 'done'
+
+
+def test_publish_moves_forward():
+    progress = Progress()
+    for stage in ('queued', 'preparing', 'prepared', 'running', 'building', 'running'):
+        progress.publish('a', stage)
+    assert [e["stage"] for e in progress.get('a')] == \
+        ['queued', 'preparing', 'prepared', 'running', 'building']
+    progress.publish('a', 'done')
+    # A new run after the end of the previous one
+    progress.publish('a', 'scheduled')
+    assert [e["stage"] for e in progress.get('a')] == ['scheduled']
+
+
+def test_stream():
+    async def _stream():
+        progress = Progress()
+        progress.publish('a', 'queued')
+        loop = asyncio.get_running_loop()
+        loop.call_later(0.05, progress.publish, 'a', 'preparing')
+        loop.call_later(0.35, progress.publish, 'a', 'failed')
+        return [e and e["stage"] async for e in progress.stream('a', heartbeat=0.2)]
+
+    # The stream ends on failure, with a heartbeat while nothing happens
+    assert asyncio.run(_stream()) == ['queued', 'preparing', None, 'failed']
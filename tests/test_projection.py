@@ -0,0 +1,32 @@
+import pytest
+
+import projection
+
+
+def test_transform_cached_and_vectorized():
+    xs, ys = projection.transform([48.8644, 48.8655], [2.3977, 2.3994], 'epsg:4326')
+    assert projection.transformer.cache_info().currsize >= 1
+    x1, y1, x2, y2 = projection.to_lambert(48.8644, 2.3977, 48.8655, 2.3994, 'EPSG:4326')
+    assert (xs, ys) == ([x1, x2], [y1, y2])
+    assert 649000 < x1 < 660000 and 6860000 < y1 < 6870000
+
+
+def test_to_lambert_bboxes():
+    bboxes = [(48.8644, 2.3977, 48.8655, 2.3994, 'EPSG:4326'),
+              (649985, 6864006, 650266, 6864226, 'EPSG:2154')]
+    converted = projection.to_lambert_bboxes(bboxes)
+    assert converted[0] == projection.to_lambert(*bboxes[0])
+    assert converted[1] == bboxes[1][:4]
+
+
+def test_validate():
+    projection.validate([48.8644], [2.3977], 'EPSG:4326')
+    # Longitude first is out of France
+    with pytest.raises(projection.ProjectionError):
+        projection.validate([2.3977], [48.8644], 'EPSG:4326')
+    with pytest.raises(projection.ProjectionError):
+        projection.validate([float('nan')], [0], 'EPSG:2154')
+    errors = projection.validate_bboxes([(649985, 6864006, 650266, 6864226, 'EPSG:2154'),
+                                         (0, 0, 10, 10, 'EPSG:2154'),
+                                         (1, 2, 3, 4, 'EPSG:0')])
+    assert errors[0] is None and errors[1] and 'unknown CRS' in errors[2]
@@ -6,3 +6,12 @@ def test_bucket_exists():
     bucket_name = 'webgl-lp'
     print(bucket_name)
     assert s3.check_bucket(bucket_name)
+
+def test_bucket_cache():
+    s3 = S3(positive_ttl=60, negative_ttl=60, max_entries=1)
+    s3._cache_set('a', True)
+    assert s3.check_bucket('a')
+    s3._cache_set('b', False)
+    assert s3.cache_stats()["size"] == 1
+    assert not s3.check_bucket('b')
+    assert s3.cache_stats()["hits"] == 2
@@ -0,0 +1,27 @@
+from informer import JobInformer
+from scheduler import PoolScheduler, POOL_LABEL, INTERACTIVE, BATCH
+
+
+def test_priority_and_release():
+    informer = JobInformer(namespace='twincity')
+    scheduler = PoolScheduler('pool', informer, max_running=1, job_seconds=60)
+    launched = []
+
+    def launch(name):
+        launched.append(name)
+        return {"status": "LAUNCHED"}
+
+    assert scheduler.submit('a', lambda: launch('a'))["status"] == 'LAUNCHED'
+    batch = scheduler.submit('b', lambda: launch('b'), priority=BATCH)
+    assert (batch["status"], batch["position"], batch["estimated_wait"]) == \
+        ('SCHEDULED', 0, 60)
+    interactive = scheduler.submit('c', lambda: launch('c'), priority=INTERACTIVE)
+    assert interactive["position"] == 0
+    assert scheduler.submit('b', None)["position"] == 1
+
+    labels = {POOL_LABEL: 'pool'}
+    informer._set('a', {'name': 'a', 'labels': labels, 'active': 1})
+    informer._set('a', {'name': 'a', 'labels': labels,
+                        'conditions': [{'type': 'Complete', 'status': 'True'}]})
+    assert launched == ['a', 'c']
+    assert scheduler.stats()["queued"] == 1
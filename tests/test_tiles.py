@@ -0,0 +1,53 @@
+import pytest
+
+import tiles
+
+
+def test_near_identical_bbox_same_name():
+    x1, y1, x2, y2 = 48.86440000000001, 2.3977, 48.865500000000004, 2.3994
+    a = tiles.snap(tiles.canonical_bbox(x1, y1, x2, y2, 'EPSG:4326'))
+    b = tiles.snap(tiles.canonical_bbox(x1, 2.39770000001, x2, y2, 'EPSG:4326'))
+    assert tiles.bbox_name(a) == tiles.bbox_name(b)
+
+
+def test_same_bbox_other_crs_same_name():
+    bbox = tiles.canonical_bbox(48.8644, 2.3977, 48.8655, 2.3994, 'EPSG:4326')
+    lambert = tiles.canonical_bbox(*bbox, 'EPSG:2154')
+    assert tiles.snap(bbox) == tiles.snap(lambert)
+
+
+def test_cover():
+    assert len(tiles.cover(tiles.snap((0, 0, 1000, 500), 500), 500)) == 2
+    assert len(tiles.cover(tiles.snap((10, 10, 20, 20), 500), 500)) == 1
+
+
+def test_cover_polygon():
+    triangle = [(0, 0), (900, 0), (0, 900)]
+    assert len(tiles.cover_polygon(triangle, 'EPSG:2154', 500)) == 3
+
+
+def test_prepare_tiled_cached(tmp_path):
+    indexes = tiles.snap((0, 0, 1000, 500), 500)
+    for tile in tiles.cover(indexes, 500):
+        (tmp_path / 'tiles' / tile["name"]).mkdir(parents=True)
+        (tmp_path / 'tiles' / tile["name"] / 'a.geojson').write_text(
+            '{"type": "FeatureCollection", "features": [{"id": "%s"}]}' % tile["name"])
+    done = []
+    submitted = tiles.prepare_tiled(None, 'job', 0, 0, 1000, 500, 'EPSG:2154',
+                                    str(tmp_path / 'job'), tile_size=500,
+                                    tiles_path=str(tmp_path / 'tiles'),
+                                    callback=done.append)
+    assert submitted == []
+    assert done == [{"name": 'job', "tiles": 2, "cached": True}]
+    assert (tmp_path / 'job' / 'a.geojson').exists()
+
+
+def test_compose_other_files(tmp_path):
+    for tile, content in (('t1', 'same'), ('t2', 'same'), ('t3', 'other')):
+        (tmp_path / tile).mkdir()
+        (tmp_path / tile / 'data.csv').write_text(content)
+    tiles.compose([str(tmp_path / 't1'), str(tmp_path / 't2')], str(tmp_path / 'a'))
+    assert (tmp_path / 'a' / 'data.csv').read_text() == 'same'
+    with pytest.raises(ValueError):
+        tiles.compose([str(tmp_path / 't1'), str(tmp_path / 't3')], str(tmp_path / 'b'))
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['a', 't1', 't2', 't3']
@@ -0,0 +1,106 @@
+import os
+import threading
+
+import pytest
+
+from worker import PrepareQueue
+from singleflight import SingleFlight
+
+# Stub of `prepare_data`: each call is logged next to the jobs, a bbox with
+# a negative x writes a partial file then fails
+PREPARE_DATA = {
+    "__init__.py": "",
+    "utils.py": '''
+def convert2poly(x1, y1, x2, y2):
+    return [(x1, y1), (x2, y1), (x2, y2), (x1, y2), (x1, y1)]
+''',
+    "main.py": '''
+import time
+
+
+def main(polygon, path):
+    with open(path.parent / "calls", "a") as f:
+        f.write(f"{path.name}\\n")
+    time.sleep(0.5)
+    path.mkdir(parents=True, exist_ok=True)
+    with open(path / "buildings.geojson", "w") as f:
+        f.write('{"type": "FeatureCollection", "features": []}')
+    if polygon[0][0] < 0:
+        raise ValueError("failed after a partial write")
+'''}
+
+
+@pytest.fixture
+def prepare_data(tmp_path, monkeypatch):
+    package = tmp_path / 'lib' / 'prepare_data'
+    package.mkdir(parents=True)
+    for filename, content in PREPARE_DATA.items():
+        (package / filename).write_text(content.lstrip())
+    # Worker processes are spawned with the path of the test process
+    monkeypatch.syspath_prepend(str(tmp_path / 'lib'))
+    jobs = tmp_path / 'jobs'
+    jobs.mkdir()
+    queue = PrepareQueue(max_workers=2, max_queue=10)
+    yield queue, jobs
+    queue.shutdown()
+
+
+def test_queue_full():
+    queue = PrepareQueue(max_workers=1, max_queue=0)
+    assert queue.submit('name', 0, 0, 1, 1, crs='EPSG:2154', path='/tmp/name') is None
+    assert queue.stats()["queued"] == 0
+
+
+def test_duplicate_submits_share_one_preparation(prepare_data):
+    queue, jobs = prepare_data
+    infos, done = [], []
+
+    def _submit():
+        infos.append(queue.submit('name', 0, 0, 100, 100, crs='EPSG:2154',
+                                  path=str(jobs / 'name'), callback=done.append))
+
+    threads = [threading.Thread(target=_submit) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len({info["job_id"] for info in infos}) == 1
+    result = queue.future(infos[0]["job_id"]).result(timeout=60)
+    assert result["state"] == 'DONE'
+    assert len((jobs / 'calls').read_text().splitlines()) == 1
+    assert done == [result] * 5
+    assert (jobs / 'name' / 'buildings.geojson').exists()
+
+
+def test_failure_leaves_no_partial_path(prepare_data):
+    queue, jobs = prepare_data
+    info = queue.submit('name', -100, 0, 100, 100, crs='EPSG:2154',
+                        path=str(jobs / 'name'))
+    result = queue.future(info["job_id"]).result(timeout=60)
+    assert result["state"] == 'FAILED' and 'partial write' in result["error"]
+    assert os.listdir(jobs) == ['calls']
+
+
+def test_single_flight_shares_result():
+    flight, calls, results = SingleFlight(), [], []
+    started = threading.Event()
+
+    def _launch():
+        calls.append(1)
+        started.set()
+        threading.Event().wait(0.2)
+        return object()
+
+    def _do():
+        results.append(flight.do('name', _launch))
+
+    leader = threading.Thread(target=_do)
+    leader.start()
+    started.wait(5)
+    followers = [threading.Thread(target=_do) for _ in range(4)]
+    for thread in followers:
+        thread.start()
+    for thread in [leader] + followers:
+        thread.join()
+    assert len(calls) == 1
+    assert len(results) == 5 and all(r is results[0] for r in results)